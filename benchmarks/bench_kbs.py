@@ -0,0 +1,283 @@
+#!/usr/bin/python
+#bench_kbs.py
+'''
+Benchmarks for TUBDUCK knowledge base processing and loading.
+
+Generates synthetic inputs (see synthetic.py) at each requested scale,
+then times each stage and measures its peak memory use with tracemalloc:
+processing each KB, parsing MEDLINE documents into the input database,
+loading the processed KBs into the graph DB, streaming KBs into it,
+importing annotated documents into the instance graph, and
+normalizing mentions.
+Everything runs in a temporary directory laid out like a TUBDUCK
+checkout, so the stages run unchanged on their usual relative paths.
+
+The graph load needs no server by default: it goes to the in-memory
+graph backend (see tubduck_graph). Use --neo4j to load into the
+configured Neo4j server instead (this empties it first).
+
+Results are compared with a JSON baseline, and any stage slower or
+larger than the baseline by more than the tolerance is reported as
+a regression.
+
+Run with: python3 benchmarks/bench_kbs.py [--scales 1000 10000] [--save-baseline]
+'''
+
+import argparse
+from contextlib import redirect_stderr, redirect_stdout
+from datetime import datetime
+import io
+import json
+import os
+from pathlib import Path
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import synthetic
+
+BENCH_PATH = Path(__file__).resolve().parent
+TUBDUCK_PATH = BENCH_PATH.parent / "tubduck"
+sys.path.insert(0, str(TUBDUCK_PATH))
+
+import tubduck_brat as tbrat
+import tubduck_graph as tgraph
+import tubduck_input as tinput
+import tubduck_normalize as tnorm
+import tubduck_start as tstart
+import tubduck_stream as tstream
+
+## Constants
+BASELINE_PATH = BENCH_PATH / "baseline.json"
+
+SCALES = [1000, 10000, 100000, 1000000] #Records per synthetic input
+
+STAGES = ["process_diseaseontology", "process_mesh", "process_icd10cm", "process_icd11mms",
+			"process_reactome", "parse_docs", "graph_load", "stream_load",
+			"import_annotations", "normalize_mentions"]
+'''
+Stages in the order they run. The graph load needs the
+output of all five KB processing stages. The streaming load reads
+the KBs that can be streamed straight from the synthetic inputs,
+with no processing stage (see tubduck_stream). Annotations are
+imported from synthetic brat files, sized in entities (see tubduck_brat).
+Mentions are normalized against the processed KBs, with an empty memo.
+'''
+
+TOLERANCE = 1.25 #Slowdown or growth (as a ratio) counted as a regression
+
+## Functions
+def setup_workdir(workdir):
+	'''Creates a TUBDUCK directory layout under workdir.
+	Returns a dict of the Paths used by the stages.'''
+
+	paths = {"tubduck": workdir / "tubduck",
+				"kbs": workdir / "working" / "kbs",
+				"processed": workdir / "working" / "kbs" / "processed",
+				"medline": workdir / "input" / "medline",
+				"annotations": workdir / "input" / "annotations"}
+	for path in paths.values():
+		path.mkdir(parents=True, exist_ok=True)
+
+	return paths
+
+def generate_inputs(paths, size, seed):
+	'''Writes synthetic versions of every input at one scale.'''
+
+	kb_path = paths["kbs"]
+	synthetic.make_obo(kb_path / tstart.KB_NAMES["don"], size, seed)
+	synthetic.make_mesh(kb_path / tstart.KB_NAMES["m19"], size, seed)
+	synthetic.make_icd10cm_xml(kb_path / tstart.KB_NAMES["i10"], size, seed)
+	synthetic.make_icd11_zip(kb_path / tstart.KB_NAMES["i11"], size, seed)
+	synthetic.make_reactome(kb_path / tstart.KB_NAMES["reactome1"],
+							kb_path / tstart.KB_NAMES["reactome2"], size, seed)
+	synthetic.make_medline(paths["medline"] / "synthetic.txt", size, seed)
+	synthetic.make_brat(paths["annotations"], size, seed)
+	with (paths["medline"].parent / "mentions.txt").open("w") as outfile:
+		outfile.write("\n".join(synthetic.make_mentions(size, seed)) + "\n")
+
+def run_stage(stage, paths, use_neo4j):
+	'''Runs one stage. Returns a tuple of its status and any extra
+	values to report.'''
+
+	inpath, outpath = paths["kbs"], paths["processed"]
+	extra = {}
+
+	if stage == "process_diseaseontology":
+		status = tstart.process_diseaseontology(tstart.KB_NAMES["don"], inpath, outpath)
+	elif stage == "process_mesh":
+		status = tstart.process_mesh(tstart.KB_NAMES["m19"], inpath, outpath)
+	elif stage == "process_icd10cm":
+		status = tstart.process_icd10cm(tstart.KB_NAMES["i10"], inpath, outpath)
+	elif stage == "process_icd11mms":
+		status = tstart.process_icd11mms(tstart.KB_NAMES["i11"], inpath, outpath)
+	elif stage == "process_reactome":
+		status = tstart.process_reactome(tstart.KB_NAMES["reactome1"], inpath, outpath)
+	elif stage == "parse_docs":
+		tinput.setup()
+		tinput.parse_docs(tinput.get_local_docs())
+		status = True
+	elif stage == "graph_load":
+		backend = tgraph.get_backend("neo4j" if use_neo4j else "memory")
+		tstart.empty_graphdb(backend)
+		status = tstart.populate_graphdb(False, backend)
+		extra["nodes"] = backend.count_nodes()
+		extra["edges"] = backend.count_edges()
+	elif stage == "stream_load":
+		backend = tgraph.get_backend("neo4j" if use_neo4j else "memory")
+		tstart.empty_graphdb(backend)
+		status = tstream.stream_kbs(local=True, backend=backend)
+		extra["nodes"] = backend.count_nodes()
+		extra["edges"] = backend.count_edges()
+	elif stage == "import_annotations":
+		backend = tgraph.get_backend("neo4j" if use_neo4j else "memory")
+		tstart.empty_graphdb(backend)
+		status = tbrat.import_annotations([paths["annotations"]], backend)
+		extra["nodes"] = backend.count_nodes()
+		extra["edges"] = backend.count_edges()
+	elif stage == "normalize_mentions":
+		normalizer = tnorm.Normalizer()
+		mentions = (paths["medline"].parent / "mentions.txt").read_text().splitlines()
+		results = normalizer.resolve(mentions)
+		normalizer.close()
+		status = True
+		extra["resolved"] = sum(1 for result in results if result is not None)
+
+	return (status, extra)
+
+def measure_stage(stage, paths, use_neo4j, memory, verbose):
+	'''Times one stage and, if memory is True, measures its peak
+	traced memory. Returns a dict of results.'''
+
+	output = sys.stdout if verbose else io.StringIO()
+	if memory:
+		tracemalloc.start()
+	start = time.perf_counter()
+	with redirect_stdout(output), redirect_stderr(output):
+		status, extra = run_stage(stage, paths, use_neo4j)
+	seconds = time.perf_counter() - start
+
+	result = {"status": bool(status), "seconds": round(seconds, 4)}
+	if memory:
+		result["peak_mb"] = round(tracemalloc.get_traced_memory()[1] / 1048576, 2)
+		tracemalloc.stop()
+	result.update(extra)
+
+	return result
+
+def run_benchmarks(scales, stages, seed=0, use_neo4j=False, memory=True, verbose=False):
+	'''Runs the chosen stages at each scale.
+	Returns a report as a dict.'''
+
+	report = {"date": datetime.now().isoformat(timespec="seconds"),
+				"python": platform.python_version(),
+				"machine": platform.machine(),
+				"memory": memory,
+				"graph": "neo4j" if use_neo4j else "memory",
+				"results": {}}
+
+	origin = os.getcwd()
+	for size in scales:
+		workdir = Path(tempfile.mkdtemp(prefix="tubduck-bench-"))
+		try:
+			paths = setup_workdir(workdir)
+			print("Generating synthetic inputs with %s records..." % size)
+			start = time.perf_counter()
+			generate_inputs(paths, size, seed)
+			print("Generated in %.1f s." % (time.perf_counter() - start))
+
+			os.chdir(str(paths["tubduck"])) #TUBDUCK paths are relative to its module directory
+			for stage in STAGES:
+				if stage not in stages:
+					continue
+				result = measure_stage(stage, paths, use_neo4j, memory, verbose)
+				result["records_per_s"] = round(size / result["seconds"], 1) if result["seconds"] > 0 else None
+				report["results"].setdefault(stage, {})[str(size)] = result
+				print("%-24s %9s records %9.3f s %10s MB%s" % (stage, size, result["seconds"],
+						result.get("peak_mb", "-"), "" if result["status"] else "  FAILED"))
+		finally:
+			os.chdir(origin)
+			shutil.rmtree(str(workdir), ignore_errors=True)
+
+	return report
+
+def compare_reports(baseline, report, tolerance=TOLERANCE):
+	'''Compares a benchmark report with a baseline.
+	Only stages and scales present in both are compared.
+	Returns a list of strings describing regressions.'''
+
+	regressions = []
+
+	for stage, scales in report["results"].items():
+		for size, result in scales.items():
+			old = baseline.get("results", {}).get(stage, {}).get(size)
+			if old is None:
+				continue
+			if old["status"] and not result["status"]:
+				regressions.append("%s at %s records now fails" % (stage, size))
+			for measure, unit in [("seconds", "s"), ("peak_mb", "MB")]:
+				if measure not in old or measure not in result:
+					continue
+				if result[measure] > old[measure] * tolerance:
+					regressions.append("%s at %s records: %s went from %s %s to %s %s"
+										% (stage, size, measure, old[measure], unit,
+											result[measure], unit))
+
+	return regressions
+
+def main():
+	parser = argparse.ArgumentParser(description="Benchmark TUBDUCK KB processing and loading on synthetic inputs.")
+	parser.add_argument("--scales", help="numbers of records to generate for each input (default: %s)"
+						% " ".join(str(size) for size in SCALES), type=int, nargs="+", default=SCALES)
+	parser.add_argument("--stages", help="stages to run (default: all)", nargs="+",
+						choices=STAGES, default=STAGES)
+	parser.add_argument("--seed", help="random seed for the synthetic inputs", type=int, default=0)
+	parser.add_argument("--neo4j", help="load into the configured Neo4j server, after emptying it",
+						action="store_true")
+	parser.add_argument("--no-memory", help="don't trace memory use (tracing slows every stage)",
+						action="store_true")
+	parser.add_argument("--baseline", help="baseline file to compare against", type=Path,
+						default=BASELINE_PATH)
+	parser.add_argument("--save-baseline", help="save the results as the new baseline",
+						action="store_true")
+	parser.add_argument("--tolerance", help="ratio of time or memory to the baseline counted as a regression",
+						type=float, default=TOLERANCE)
+	parser.add_argument("--output", help="also write the results to this file", type=Path)
+	parser.add_argument("--verbose", help="show output from each stage", action="store_true")
+	args = parser.parse_args()
+
+	report = run_benchmarks(args.scales, args.stages, args.seed, args.neo4j,
+							not args.no_memory, args.verbose)
+
+	if args.output:
+		with args.output.open("w") as outfile:
+			json.dump(report, outfile, indent=2)
+		print("Wrote results to %s" % args.output)
+
+	if args.save_baseline:
+		with args.baseline.open("w") as outfile:
+			json.dump(report, outfile, indent=2)
+		print("Saved results as baseline in %s" % args.baseline)
+		return 0
+
+	if not args.baseline.exists():
+		print("No baseline at %s to compare with." % args.baseline)
+		return 0
+
+	with args.baseline.open() as infile:
+		baseline = json.load(infile)
+	regressions = compare_reports(baseline, report, args.tolerance)
+	if len(regressions) > 0:
+		print("Regressions compared to baseline from %s:" % baseline["date"])
+		for regression in regressions:
+			print("  " + regression)
+		return 1
+	print("No regressions compared to baseline from %s." % baseline["date"])
+
+	return 0
+
+if __name__ == "__main__":
+	sys.exit(main())
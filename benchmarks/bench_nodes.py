@@ -0,0 +1,103 @@
+#!/usr/bin/python
+#bench_nodes.py
+'''
+Memory benchmark for the node records used in KB processing.
+
+Builds the same synthetic ICD-style hierarchy (URIs, codes, titles,
+chapters and parents) as a dict of per-node dicts, as KB processing
+used to hold it, and as a NodeTable (see tubduck_nodes), then
+compares the memory each holds, as traced by tracemalloc. Strings
+are created anew for each node in both, as a parser would.
+Fails if the NodeTable doesn't use at most 1/MIN_RATIO as much.
+
+Run with: python3 benchmarks/bench_nodes.py [--sizes 10000 100000]
+'''
+
+import argparse
+import gc
+from pathlib import Path
+import sys
+import tracemalloc
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "tubduck"))
+
+import tubduck_nodes as tnodes
+
+## Constants
+SIZES = [10000, 100000, 1000000]
+MIN_RATIO = 2.0 #Dict records must take at least this many times the memory
+PER_CHAPTER = 1000 #Nodes in each chapter
+
+## Functions
+def node_code(number):
+	'''Returns the code of a node.'''
+
+	return "C%05d.%s" % (number // 13, number % 13)
+
+def node_values(size):
+	'''Yields (number, code, title, chapter, parent number) for
+	size nodes, in groups of 13 with the first as the others' parent.'''
+
+	for i in range(size):
+		parent = None if i % 13 == 0 else i - i % 13
+		yield (i, node_code(i), "Synthetic condition %s of type %s" % (i, i % 7),
+				str(i // PER_CHAPTER + 1), parent)
+
+def build_dicts(size):
+	'''Returns nodes as a dict of dicts, keyed by code, with
+	parents as codes.'''
+
+	all_nodes = {}
+	for number, code, title, chapter, parent in node_values(size):
+		all_nodes[code] = {"uri": "ICD10CM:" + str(number), "code": code, "title": title,
+							"chapter": chapter,
+							"parent": "None" if parent is None else node_code(parent)}
+	return all_nodes
+
+def build_table(size):
+	'''Returns nodes as a NodeTable, with parents as rows.'''
+
+	nodes = tnodes.NodeTable()
+	for number, code, title, chapter, parent in node_values(size):
+		nodes.add("ICD10CM:", number, code, title, chapter,
+					tnodes.NO_PARENT if parent is None else parent)
+	return nodes
+
+def measure(build, size):
+	'''Builds nodes with a function and returns the bytes they hold
+	and the peak bytes traced while building them.'''
+
+	gc.collect()
+	tracemalloc.start()
+	nodes = build(size)
+	current, peak = tracemalloc.get_traced_memory()
+	tracemalloc.stop()
+	del nodes
+
+	return (current, peak)
+
+def main():
+	parser = argparse.ArgumentParser(description="Compare memory use of node records for KB processing.")
+	parser.add_argument("--sizes", help="numbers of nodes to build", type=int, nargs="+",
+						default=SIZES)
+	parser.add_argument("--min-ratio", help="lowest acceptable ratio of dict to table memory (default: %s)" % MIN_RATIO,
+						type=float, default=MIN_RATIO)
+	args = parser.parse_args()
+
+	status = 0
+	for size in args.sizes:
+		dict_bytes, dict_peak = measure(build_dicts, size)
+		table_bytes, table_peak = measure(build_table, size)
+		ratio = dict_bytes / table_bytes
+		print("%9s nodes: dicts %8.1f MB (%4.0f B/node), table %8.1f MB (%4.0f B/node), %.1fx smaller; "
+				"peaks %.1f MB and %.1f MB"
+				% (size, dict_bytes / 1048576, dict_bytes / size, table_bytes / 1048576,
+					table_bytes / size, ratio, dict_peak / 1048576, table_peak / 1048576))
+		if ratio < args.min_ratio:
+			print("Table uses more than 1/%s of the memory of dicts." % args.min_ratio)
+			status = 1
+
+	return status
+
+if __name__ == "__main__":
+	sys.exit(main())
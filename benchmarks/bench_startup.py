@@ -0,0 +1,86 @@
+#!/usr/bin/python
+#bench_startup.py
+'''
+Startup time benchmark for the TUBDUCK command line.
+
+Runs "tubduck_core.py --help" in fresh processes and compares the
+median time with that of an interpreter doing nothing. If the
+difference, i.e., the time TUBDUCK itself adds, is over the budget,
+the slowest imports are listed and the benchmark fails. Heavy modules
+belong inside the commands that need them (see tubduck_core).
+
+Run with: python3 benchmarks/bench_startup.py [--budget 0.15]
+'''
+
+import argparse
+from pathlib import Path
+import statistics
+import subprocess
+import sys
+import time
+
+## Constants
+TUBDUCK_PATH = Path(__file__).resolve().parent.parent / "tubduck"
+
+BUDGET = 0.15 #Seconds --help may take beyond bare interpreter startup
+REPEATS = 10 #Processes started for each measurement
+TOP_IMPORTS = 15 #Slowest imports listed when over budget
+
+## Functions
+def time_command(command, repeats):
+	'''Runs a command repeats times, each in a new process.
+	Returns the median wall time in seconds.'''
+
+	times = []
+	for _ in range(repeats):
+		start = time.perf_counter()
+		subprocess.run(command, cwd=str(TUBDUCK_PATH), stdout=subprocess.DEVNULL,
+						stderr=subprocess.DEVNULL, check=True)
+		times.append(time.perf_counter() - start)
+
+	return statistics.median(times)
+
+def slowest_imports(command, count):
+	'''Runs a command with -X importtime.
+	Returns a list of (cumulative microseconds, module) tuples
+	for the slowest top-level imports.'''
+
+	result = subprocess.run([command[0], "-X", "importtime"] + command[1:],
+							cwd=str(TUBDUCK_PATH), stdout=subprocess.DEVNULL,
+							stderr=subprocess.PIPE, universal_newlines=True)
+	imports = []
+	for line in result.stderr.splitlines():
+		if not line.startswith("import time:") or "cumulative" in line:
+			continue
+		_, cumulative, module = line.split("|")
+		if not module.startswith("  "): #Only those imported directly
+			imports.append((int(cumulative), module.strip()))
+
+	return sorted(imports, reverse=True)[:count]
+
+def main():
+	parser = argparse.ArgumentParser(description="Check TUBDUCK command line startup time.")
+	parser.add_argument("--budget", help="seconds allowed beyond interpreter startup (default: %s)" % BUDGET,
+						type=float, default=BUDGET)
+	parser.add_argument("--repeats", help="processes started per measurement", type=int,
+						default=REPEATS)
+	args = parser.parse_args()
+
+	command = [sys.executable, "tubduck_core.py", "--help"]
+	interpreter = time_command([sys.executable, "-c", "pass"], args.repeats)
+	startup = time_command(command, args.repeats)
+	added = startup - interpreter
+
+	print("Interpreter startup: %.3f s" % interpreter)
+	print("tubduck_core.py --help: %.3f s (%.3f s added, budget %.3f s)" % (startup, added, args.budget))
+
+	if added > args.budget:
+		print("Over budget. Slowest imports:")
+		for cumulative, module in slowest_imports(command, TOP_IMPORTS):
+			print("  %8.1f ms  %s" % (cumulative / 1000, module))
+		return 1
+
+	return 0
+
+if __name__ == "__main__":
+	sys.exit(main())
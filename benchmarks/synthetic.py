@@ -0,0 +1,320 @@
+#!/usr/bin/python
+#synthetic.py
+'''
+Synthetic knowledge base and document generators for TUBDUCK benchmarks.
+
+Each generator writes files in the same format as the original source,
+with the filenames TUBDUCK expects (see KB_NAMES in tubduck_start),
+so the processing functions can be run on them unchanged.
+Output is deterministic for a given size and seed, and no network
+access is needed.
+'''
+
+import random
+from xml.sax.saxutils import escape
+from zipfile import ZipFile, ZIP_DEFLATED
+
+## Constants
+WORDS = ["mitochondrial", "cardiac", "syndrome", "disease", "disorder",
+			"protein", "import", "metabolism", "acute", "chronic",
+			"congenital", "infection", "deficiency", "pathway", "signaling",
+			"receptor", "kinase", "transport", "type", "familial",
+			"myopathy", "encephalopathy", "neuropathy", "arrhythmia", "failure"]
+
+BRANCHING = 8 #Children per parent in generated hierarchies
+
+ANNOTATIONS_PER_DOC = 20 #Entities in each generated annotated document
+
+ENTITY_TYPES = ["Sign_symptom", "Disease_disorder", "Medication", "Diagnostic_procedure",
+				"Lab_value", "Biological_structure", "Severity", "Age", "Sex", "Subject"]
+EVENT_TYPES = {"Sign_symptom", "Disease_disorder", "Medication", "Diagnostic_procedure"}
+RELATION_TYPES = ["MODIFY", "BEFORE", "AFTER", "OVERLAP"]
+
+## Functions
+def make_name(rng, words=4):
+	'''Returns a random name of some words.'''
+
+	return " ".join(rng.choice(WORDS) for _ in range(words)).capitalize()
+
+def parent_index(i):
+	'''Returns the index of the parent of the ith item in a
+	hierarchy with BRANCHING children per parent, or None for the root.'''
+
+	if i == 0:
+		return None
+	return (i - 1) // BRANCHING
+
+def make_obo(path, size, seed=0):
+	'''Writes a Disease Ontology-style OBO file with size terms.
+	Some terms have a second parent, as in DO, and some have
+	relationships with trailing modifiers or are obsolete.'''
+
+	rng = random.Random(seed)
+	with path.open("w") as outfile:
+		outfile.write("format-version: 1.2\n"
+						"data-version: synthetic\n"
+						"ontology: doid\n\n")
+		for i in range(size):
+			name = make_name(rng)
+			outfile.write("[Term]\n")
+			outfile.write("id: DOID:%s\n" % i)
+			outfile.write("name: %s\n" % name)
+			outfile.write("def: \"%s.\" [url:http://example.org/%s]\n" % (make_name(rng, 12), i))
+			if i % 3 == 0:
+				outfile.write("synonym: \"%s\" EXACT []\n" % make_name(rng))
+			outfile.write("xref: ICD10CM:X%s\n" % i)
+			parent = parent_index(i)
+			if parent is not None:
+				outfile.write("is_a: DOID:%s ! %s\n" % (parent, "parent"))
+				if i % 10 == 0 and parent > 0:
+					outfile.write("is_a: DOID:%s ! %s\n" % (parent - 1, "parent"))
+				if i % 7 == 0:
+					outfile.write("relationship: has_material_basis_in DOID:%s "
+									"{source=\"synthetic\"} ! parent\n" % parent)
+			if i % 50 == 49:
+				outfile.write("is_obsolete: true\n")
+			outfile.write("\n")
+		outfile.write("[Typedef]\nid: has_material_basis_in\nname: has_material_basis_in\n")
+
+def make_mesh(path, size, seed=0):
+	'''Writes a MeSH ASCII descriptor file with size descriptors.
+	Tree numbers follow the same hierarchy as the other generators,
+	with some descriptors in two places in the tree. Some have
+	pharmacological actions, named by the first descriptor.'''
+
+	rng = random.Random(seed)
+	names = []
+	tree_numbers = []
+	with path.open("w") as outfile:
+		for i in range(size):
+			name = make_name(rng, 2) if i > 0 else "Synthetic agents"
+			if name in names: #Descriptor names are unique
+				name = "%s %s" % (name, i)
+			names.append(name)
+			parent = parent_index(i)
+			if parent is None:
+				numbers = ["C01"]
+			else:
+				numbers = ["%s.%03d" % (tree_numbers[parent][0], (i - 1) % BRANCHING + 1)]
+				if i % 10 == 0 and parent > 0:
+					numbers.append("%s.%03d" % (tree_numbers[parent - 1][0], 100 + i % 1000))
+			tree_numbers.append(numbers)
+			outfile.write("*NEWRECORD\n")
+			outfile.write("RECTYPE = D\n")
+			outfile.write("MH = %s\n" % name)
+			outfile.write("AQ = AE DT TU\n")
+			outfile.write("ENTRY = %s|T047|NON|EQV|NLM (2019)|180101|abdef\n" % make_name(rng))
+			for number in numbers:
+				outfile.write("MN = %s\n" % number)
+			if i % 5 == 4:
+				outfile.write("PA = %s\n" % names[0])
+			outfile.write("MS = %s.\n" % make_name(rng, 12))
+			outfile.write("UI = D%06d\n\n" % (i + 1))
+
+def make_icd10cm_xml(path, size, seed=0):
+	'''Writes an ICD-10-CM tabular XML file with size codes,
+	grouped into chapters and sections as in the original.
+	Children are nested inside their parent diag elements.
+	Element contents are separated by whitespace, as process_icd10cm
+	expects.'''
+
+	rng = random.Random(seed)
+	per_section = 50
+	per_chapter = 20 * per_section
+
+	def write_diag(outfile, code, depth, remaining):
+		'''Writes a diag and up to two levels of children.
+		Returns the number of codes written.'''
+		indent = "\t" * (depth + 3)
+		outfile.write("%s<diag>\n%s<name>%s</name>\n%s<desc>%s</desc>\n"
+						% (indent, indent, code, indent, escape(make_name(rng))))
+		written = 1
+		if depth < 2:
+			for child in range(min(3, remaining - written)):
+				written = written + write_diag(outfile, "%s%s%s" % (code, "." if depth == 0 else "", child),
+												depth + 1, remaining - written)
+		outfile.write("%s</diag>\n" % indent)
+		return written
+
+	with path.open("w") as outfile:
+		outfile.write("<?xml version=\"1.0\" encoding=\"utf-8\"?>\n<ICD10CM.tabular>\n")
+		outfile.write("<version>synthetic</version>\n")
+		written = 0
+		chapter = 0
+		while written < size:
+			chapter = chapter + 1
+			outfile.write("<chapter>\n\t<name>%s</name>\n\t<desc>Chapter %s</desc>\n" % (chapter, chapter))
+			chapter_end = written + per_chapter
+			section = 0
+			while written < min(size, chapter_end):
+				section = section + 1
+				section_id = "S%02d%02d-S%02d%02d" % (chapter % 100, section, chapter % 100, section)
+				outfile.write("\t<section id=\"%s\">\n\t\t<desc>%s (%s)</desc>\n"
+								% (section_id, escape(make_name(rng)), section_id))
+				section_end = min(size, written + per_section)
+				block = 0
+				while written < section_end:
+					code = "%s%02d%s" % (chr(65 + chapter % 26), section % 100, block)
+					written = written + write_diag(outfile, code, 0, section_end - written)
+					block = block + 1
+				outfile.write("\t</section>\n")
+			outfile.write("</chapter>\n")
+		outfile.write("</ICD10CM.tabular>\n")
+
+def xlsx_cell(ref, value):
+	'''Returns the XML for one inline string cell of a worksheet.'''
+
+	return "<c r=\"%s\" t=\"inlineStr\"><is><t xml:space=\"preserve\">%s</t></is></c>" % (ref, escape(value))
+
+def make_icd11_zip(path, size, seed=0):
+	'''Writes a ZIP-compressed XLSX file like the ICD-11 MMS
+	simple tabulation, with a header row and size entries.
+	Levels are indicated by dashes before each title.
+	The XLSX is written directly, so no spreadsheet library is needed.'''
+
+	rng = random.Random(seed)
+	columns = "ABCDEFGHIJ"
+	header = ["Foundation URI", "Linearization URI", "Code", "BlockId", "Title",
+				"ClassKind", "DepthInKind", "IsResidual", "ChapterNo", "BrowserLink"]
+
+	rows = []
+	rows.append("<row r=\"1\">%s</row>" % "".join(xlsx_cell("%s1" % col, value)
+												for col, value in zip(columns, header)))
+	levels = {}
+	for i in range(size):
+		parent = parent_index(i)
+		level = 0 if parent is None else levels[parent] + 1
+		levels[i] = level
+		title = "- " * level + make_name(rng)
+		code = "%s%s" % (chr(65 + i % 26), i) if i % 4 else ""
+		values = ["http://id.who.int/icd/entity/%s" % i,
+					"http://id.who.int/icd/release/11/mms/%s" % i,
+					code, "", title, "category", str(level), "False",
+					str(i % 26 + 1), ""]
+		rownum = i + 2
+		rows.append("<row r=\"%s\">%s</row>" % (rownum, "".join(xlsx_cell("%s%s" % (col, rownum), value)
+												for col, value in zip(columns, values))))
+
+	xlsx_name = path.name.split(".")[0] + ".xlsx"
+	xlsx_path = path.parent / ("synthetic-" + xlsx_name)
+	with ZipFile(xlsx_path, "w", ZIP_DEFLATED) as xlsx:
+		xlsx.writestr("[Content_Types].xml",
+			"<?xml version=\"1.0\" encoding=\"UTF-8\" standalone=\"yes\"?>"
+			"<Types xmlns=\"http://schemas.openxmlformats.org/package/2006/content-types\">"
+			"<Default Extension=\"rels\" ContentType=\"application/vnd.openxmlformats-package.relationships+xml\"/>"
+			"<Default Extension=\"xml\" ContentType=\"application/xml\"/>"
+			"<Override PartName=\"/xl/workbook.xml\" ContentType=\"application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml\"/>"
+			"<Override PartName=\"/xl/worksheets/sheet1.xml\" ContentType=\"application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml\"/>"
+			"</Types>")
+		xlsx.writestr("_rels/.rels",
+			"<?xml version=\"1.0\" encoding=\"UTF-8\" standalone=\"yes\"?>"
+			"<Relationships xmlns=\"http://schemas.openxmlformats.org/package/2006/relationships\">"
+			"<Relationship Id=\"rId1\" Type=\"http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument\" Target=\"xl/workbook.xml\"/>"
+			"</Relationships>")
+		xlsx.writestr("xl/workbook.xml",
+			"<?xml version=\"1.0\" encoding=\"UTF-8\" standalone=\"yes\"?>"
+			"<workbook xmlns=\"http://schemas.openxmlformats.org/spreadsheetml/2006/main\" "
+			"xmlns:r=\"http://schemas.openxmlformats.org/officeDocument/2006/relationships\">"
+			"<sheets><sheet name=\"Sheet1\" sheetId=\"1\" r:id=\"rId1\"/></sheets></workbook>")
+		xlsx.writestr("xl/_rels/workbook.xml.rels",
+			"<?xml version=\"1.0\" encoding=\"UTF-8\" standalone=\"yes\"?>"
+			"<Relationships xmlns=\"http://schemas.openxmlformats.org/package/2006/relationships\">"
+			"<Relationship Id=\"rId1\" Type=\"http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet\" Target=\"worksheets/sheet1.xml\"/>"
+			"</Relationships>")
+		xlsx.writestr("xl/worksheets/sheet1.xml",
+			"<?xml version=\"1.0\" encoding=\"UTF-8\" standalone=\"yes\"?>"
+			"<worksheet xmlns=\"http://schemas.openxmlformats.org/spreadsheetml/2006/main\">"
+			"<sheetData>%s</sheetData></worksheet>" % "".join(rows))
+
+	with ZipFile(path, "w", ZIP_DEFLATED) as outzip:
+		outzip.write(xlsx_path, xlsx_name)
+	xlsx_path.unlink()
+
+def make_reactome(pathways_path, relations_path, size, seed=0):
+	'''Writes a pair of Reactome files: pathways (ID, name, species)
+	and pathway relations (parent ID, child ID), with size pathways.'''
+
+	rng = random.Random(seed)
+	with pathways_path.open("w") as pathways, relations_path.open("w") as relations:
+		for i in range(size):
+			pathways.write("R-HSA-%s\t%s\tHomo sapiens\n" % (i, make_name(rng)))
+			parent = parent_index(i)
+			if parent is not None:
+				relations.write("R-HSA-%s\tR-HSA-%s\n" % (parent, i))
+
+def make_medline(path, size, seed=0):
+	'''Writes a MEDLINE format text file with size records.'''
+
+	rng = random.Random(seed)
+	with path.open("w") as outfile:
+		for i in range(size):
+			pmid = 10000000 + i
+			outfile.write("PMID- %s\n" % pmid)
+			outfile.write("OWN - NLM\n")
+			outfile.write("STAT- MEDLINE\n")
+			outfile.write("DP  - %s\n" % (1990 + i % 30))
+			outfile.write("TI  - %s.\n" % make_name(rng, 10))
+			abstract = " ".join(make_name(rng, 12) + "." for _ in range(6))
+			lines = [abstract[start:start+70] for start in range(0, len(abstract), 70)]
+			outfile.write("AB  - %s\n" % lines[0])
+			for line in lines[1:]:
+				outfile.write("      %s\n" % line)
+			for author in range(3):
+				outfile.write("AU  - %s %s\n" % (rng.choice(WORDS).capitalize(), "AB"[author % 2]))
+			outfile.write("LA  - eng\n")
+			outfile.write("PT  - Case Reports\n")
+			outfile.write("TA  - Synth J\n")
+			for heading in range(4):
+				outfile.write("MH  - %s\n" % make_name(rng, 2))
+			outfile.write("SO  - Synth J. %s;1(1):1-10.\n\n" % (1990 + i % 30))
+
+def make_brat(path, size, seed=0):
+	'''Writes brat annotated documents (.txt and .ann files) to the
+	directory at path, with size entities in all, ANNOTATIONS_PER_DOC
+	to a document. Event types also get events, and each entity is
+	related to the one before it.'''
+
+	rng = random.Random(seed)
+	path.mkdir(parents=True, exist_ok=True)
+	for doc in range(max(1, size // ANNOTATIONS_PER_DOC)):
+		text = []
+		lines = []
+		offset = 0
+		previous = None
+		for i in range(1, ANNOTATIONS_PER_DOC + 1):
+			ann_type = rng.choice(ENTITY_TYPES)
+			name = make_name(rng, rng.randint(1, 3))
+			lines.append("T%s\t%s %s %s\t%s" % (i, ann_type, offset, offset + len(name), name))
+			ann_id = "T%s" % i
+			if ann_type in EVENT_TYPES:
+				lines.append("E%s\t%s:T%s" % (i, ann_type, i))
+				ann_id = "E%s" % i
+				if rng.random() < 0.3:
+					lines.append("A%s\tPolarity E%s NEG" % (i, i))
+			if previous is not None:
+				lines.append("R%s\t%s Arg1:%s Arg2:%s" % (i, rng.choice(RELATION_TYPES),
+															ann_id, previous))
+			previous = ann_id
+			text.append(name)
+			offset = offset + len(name) + 2
+		with (path / ("%s.txt" % (20000000 + doc))).open("w") as outfile:
+			outfile.write(". ".join(text) + ".\n")
+		with (path / ("%s.ann" % (20000000 + doc))).open("w") as outfile:
+			outfile.write("\n".join(lines) + "\n")
+
+def make_mentions(size, seed=0):
+	'''Returns a list of size mentions of generated names, as
+	written in text: in any case, often plural, and sometimes
+	misspelled.'''
+
+	rng = random.Random(seed)
+	mentions = []
+	for _ in range(size):
+		mention = make_name(rng, rng.randint(2, 4))
+		if rng.random() < 0.3:
+			mention = mention + "s"
+		if rng.random() < 0.3:
+			i = rng.randrange(len(mention))
+			mention = mention[:i] + mention[i+1:]
+		mentions.append(mention.lower() if rng.random() < 0.5 else mention)
+	return mentions
@@ -2,4 +2,19 @@
 #tests.py
 '''
 Mitochondrial protein and disease-specific tests for TUBDUCK.
+Runs the test queries in evaluation/mito.json against the graph DB
+and reports correctness and latency (see tubduck_process).
 '''
+
+import os
+import sys
+
+TUBDUCK_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "tubduck")
+
+if __name__ == "__main__":
+	os.chdir(TUBDUCK_PATH) #TUBDUCK paths are relative to its module directory
+	sys.path.insert(0, TUBDUCK_PATH)
+	import tubduck_process as tproc
+	report = tproc.run_evaluation("mito")
+	if report is None or report["failed"] > 0:
+		sys.exit(1)
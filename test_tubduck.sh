@@ -1,2 +1,2 @@
 echo "Testing TUBDUCK."
-(cd tubduck/ && python3 tubduck_core.py --test_load_db)
+(cd tubduck/ && python3 tubduck_core.py run --test_load_db)
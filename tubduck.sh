@@ -1,2 +1,2 @@
 echo "Running TUBDUCK."
-(cd tubduck/ && python3 tubduck_core.py)
+(cd tubduck/ && python3 tubduck_core.py run)
@@ -0,0 +1,431 @@
+#!/usr/bin/python
+#tubduck_brat.py
+'''
+Annotation import for TUBDUCK.
+
+Loads sets of documents annotated in the brat standoff format, e.g.,
+the ACROBAT annotations of case reports, into the instance graph.
+Each document is a pair of files: its text (.txt) and its annotations
+(.ann), one per line, as:
+T1	Age 8 19	58-year-old - a text-bound entity, with its spans
+E1	Sign_symptom:T2 - an event, with its trigger entity
+R1	MODIFY Arg1:T3 Arg2:E1 - a relation between two annotations
+*	IDENTICAL T4 T5 - an equivalence between annotations
+A1	Polarity E1 NEG - an attribute of an annotation
+Other lines (notes and normalizations) are skipped.
+
+ACROBAT types are mapped to schema types by the table in
+schemas/acrobat_to_tubduck_maps.txt (see read_type_map()): entity
+and event types to classes, whose labels the annotations' nodes get,
+attribute types to node properties, and relation types to slots,
+which become edge types. Types the table leaves unmapped fall back to
+DEFAULT_CLASS and DEFAULT_RELATION, keeping their ACROBAT type.
+
+As with other instance graph output (see tubduck_output), a document
+is a Publication node, keyed by its PMID if its file is named for one,
+and its patient is a Case node. Subject annotations are that Case
+node; the Case node mentions each other annotation. Other documents
+are keyed by their annotation set as well as their name, and so are
+all annotation nodes: as [set]/[document]-[annotation ID], e.g.,
+1a2b3c4d/15939911-T3. A set is the directory holding a document's
+files, identified by a hash of its path (see set_id()), so documents
+with the same name in different sets are kept apart.
+Files are parsed in parallel processes, and the nodes and edges of
+many documents are written together in batches. Annotations of the
+NORMALIZED_CLASSES may also be resolved to concepts of the KBs (see
+tubduck_normalize), which the Case node then mentions, too.
+'''
+
+from concurrent.futures import ProcessPoolExecutor
+import hashlib
+from pathlib import Path
+
+import sqlite3
+
+import neobolt.exceptions
+
+from tqdm import *
+
+import tubduck_graph as tgraph
+import tubduck_metrics as tmetrics
+import tubduck_output as toutput
+import tubduck_schema as tschema
+
+## Constants
+MAP_PATH = Path(__file__).resolve().parent.parent / "schemas" / "acrobat_to_tubduck_maps.txt" #Ships with the code
+
+MAP_SECTIONS = {"#Events": "entities", "#Entities": "entities",
+				"#Properties": "properties", "#Relations": "relations"}
+'''
+Headings of the sections of the type map, and what their types are.
+'''
+
+DEFAULT_CLASS = "named thing"
+DEFAULT_RELATION = "related to"
+
+INVERSE_RELATIONS = {"AFTER": "BEFORE"}
+'''
+Relation types written as another type, with their arguments swapped.
+'''
+
+CASE_CLASS = "case" #Annotations of this class are the document's patient
+
+FILES_PER_TASK = 50 #Documents each parsing process takes at a time
+
+NORMALIZED_CLASSES = {"disease", "sign or symptom", "drug", "diagnostic procedure",
+						"therapeutic procedure", "anatomical entity", "gene", "protein"}
+'''
+Classes of annotations resolved to concepts, if normalizing.
+'''
+
+## Functions
+def read_type_map(path=MAP_PATH):
+	'''Reads the table mapping ACROBAT types to schema types.
+	Returns a dict of dicts, each keyed by ACROBAT type:
+	"entities", of lists of schema class names, "properties" and
+	"relations", of slot names. Types mapped to nothing aren't
+	included.'''
+
+	type_map = {"entities": {}, "properties": {}, "relations": {}}
+	section = "entities"
+
+	with Path(path).open(encoding="utf-8") as mapfile:
+		for line in mapfile:
+			line = line.strip()
+			if line.startswith("#"):
+				section = MAP_SECTIONS.get(line, section)
+				continue
+			parts = [part.strip() for part in line.split("\t") if part.strip()]
+			if len(parts) < 2:
+				continue
+			if section == "entities":
+				type_map[section][parts[0]] = parts[1].split(";")
+			else:
+				type_map[section][parts[0]] = parts[1]
+
+	return type_map
+
+def compile_type_map(type_map):
+	'''Compiles the table from read_type_map() into what import
+	needs for each ACROBAT type: for "entities", a tuple of the node
+	label and the list of schema class names; for "properties", the
+	node property name; for "relations", a tuple of the edge type
+	and whether the arguments are swapped (see INVERSE_RELATIONS).
+	Returns a dict of dicts.'''
+
+	compiled = {"entities": {}, "properties": {}, "relations": {}}
+
+	for acrobat_type, class_names in type_map["entities"].items():
+		compiled["entities"][acrobat_type] = (tschema.class_label(class_names[0]), class_names)
+	for acrobat_type, slot_name in type_map["properties"].items():
+		compiled["properties"][acrobat_type] = tschema.slot_property(slot_name)
+	for acrobat_type, slot_name in type_map["relations"].items():
+		compiled["relations"][acrobat_type] = (tschema.slot_property(slot_name), False)
+	for acrobat_type, inverse_type in INVERSE_RELATIONS.items():
+		if acrobat_type not in compiled["relations"] and inverse_type in compiled["relations"]:
+			compiled["relations"][acrobat_type] = (compiled["relations"][inverse_type][0], True)
+
+	return compiled
+
+def map_labels(compiled):
+	'''Returns list of the node labels annotations may be written
+	with, given a compiled type map.'''
+
+	labels = ["Publication", "Case", tschema.class_label(DEFAULT_CLASS)]
+	for label, class_names in compiled["entities"].values():
+		if label not in labels:
+			labels.append(label)
+	return labels
+
+def parse_spans(text):
+	'''Parses the spans of a text-bound annotation, e.g., "8 19;20 25".
+	Returns list of (start, end) tuples.'''
+
+	spans = []
+	for span in text.split(";"):
+		start, end = span.split()
+		spans.append((int(start), int(end)))
+	return spans
+
+def parse_ann(lines):
+	'''Parses the lines of a brat .ann file.
+	Returns a dict of "entities" (dicts of "type", "spans" and "text"
+	by ID), "events" (dicts of "type", "trigger" and list of (role, ID)
+	"args" by ID), and lists of (type, ID, ID) "relations" and
+	(type, ID, value) "attributes". Attributes without values have
+	True as their value. Malformed lines are skipped.'''
+
+	ann = {"entities": {}, "events": {}, "relations": [], "attributes": []}
+
+	for line in lines:
+		fields = line.rstrip("\n").split("\t")
+		ann_id = fields[0]
+		if len(fields) < 2 or ann_id == "":
+			continue
+		parts = fields[1].split()
+		try:
+			first = ann_id[0]
+			if first == "T":
+				ann_type, _, spans = fields[1].partition(" ")
+				ann["entities"][ann_id] = {"type": ann_type, "spans": parse_spans(spans),
+											"text": fields[2] if len(fields) > 2 else ""}
+			elif first == "E":
+				ann_type, _, trigger = parts[0].partition(":")
+				ann["events"][ann_id] = {"type": ann_type, "trigger": trigger,
+											"args": [tuple(arg.split(":", 1)) for arg in parts[1:] if ":" in arg]}
+			elif first == "R":
+				ann["relations"].append((parts[0], parts[1].split(":", 1)[1],
+											parts[2].split(":", 1)[1]))
+			elif first == "*":
+				for other_id in parts[2:]:
+					ann["relations"].append((parts[0], parts[1], other_id))
+			elif first == "A" or first == "M":
+				ann["attributes"].append((parts[0], parts[1],
+											parts[2] if len(parts) > 2 else True))
+		except (IndexError, ValueError): #Discard this line
+			pass
+
+	return ann
+
+def set_id(filepath):
+	'''Returns the ID of the annotation set a brat file is in:
+	the start of a hash of its directory's absolute path.'''
+
+	directory = str(Path(filepath).resolve().parent)
+	return hashlib.sha1(directory.encode("utf-8")).hexdigest()[:8]
+
+def parse_ann_file(filepath):
+	'''Parses a brat .ann file (see parse_ann()). If the document's
+	.txt file is alongside it, entity text is taken from its spans
+	there, and entities whose text differs from the .ann are counted.
+	Returns a tuple of the document's set ID (see set_id()), its name
+	(the file stem), the parsed annotations and the number of
+	mismatched entities.'''
+
+	filepath = Path(filepath)
+	with filepath.open(encoding="utf-8") as annfile:
+		ann = parse_ann(annfile)
+
+	mismatches = 0
+	textpath = filepath.with_suffix(".txt")
+	if textpath.exists():
+		with textpath.open(encoding="utf-8", newline="") as textfile:
+			text = textfile.read()
+		for entity in ann["entities"].values():
+			span_text = " ".join(text[start:end] for start, end in entity["spans"])
+			if span_text != entity["text"]:
+				mismatches = mismatches + 1
+				entity["text"] = span_text
+
+	return (set_id(filepath), filepath.stem, ann, mismatches)
+
+def parse_ann_files(filepaths):
+	'''Parses a list of brat .ann files (see parse_ann_file()).
+	Returns a list of results.'''
+
+	return [parse_ann_file(filepath) for filepath in filepaths]
+
+def doc_key(set_name, name):
+	'''Returns the key of an annotated document, given its set ID
+	and name: its name, if that's a PMID, or else [set]/[name].'''
+
+	if name.isdigit():
+		return name
+	return "%s/%s" % (set_name, name)
+
+def doc_ids(set_name, name):
+	'''Returns a tuple of the Publication and Case node IDs and the
+	PMID (or None) of an annotated document, given its set ID and name.'''
+
+	key = doc_key(set_name, name)
+	if name.isdigit():
+		return (toutput.doc_node_id(name), toutput.case_node_id(key, 1), name)
+	return ("BRAT:" + key, toutput.case_node_id(key, 1), None)
+
+def annotation_rows(set_name, name, ann, compiled):
+	'''Converts the annotations of one document to graph rows,
+	given its set ID and name and a compiled type map
+	(see compile_type_map()).
+	Returns a tuple of a dict of node row lists, keyed by label,
+	a dict of edge row lists, keyed by (edge type, source label,
+	target label), and the document's Publication and Case rows.'''
+
+	doc_id, case_id, pmid = doc_ids(set_name, name)
+	doc_row = {"id": doc_id}
+	if pmid is not None:
+		doc_row["pmid"] = pmid
+	case_row = {"id": case_id, "pmid": doc_key(set_name, name), "doc": doc_id}
+
+	node_rows = {}
+	edge_rows = {}
+	nodes = {} #Node label and ID for each annotation ID
+	default_class = (tschema.class_label(DEFAULT_CLASS), [DEFAULT_CLASS])
+
+	entity_types = {ann_id: entity["type"] for ann_id, entity in ann["entities"].items()}
+	for event in ann["events"].values(): #Events type their triggers
+		if event["trigger"] in entity_types:
+			entity_types[event["trigger"]] = event["type"]
+
+	props = {}
+	for ann_id, entity in ann["entities"].items():
+		acrobat_type = entity_types[ann_id]
+		label, class_names = compiled["entities"].get(acrobat_type, default_class)
+		if CASE_CLASS in class_names:
+			nodes[ann_id] = ("Case", case_id)
+			continue
+		node_id = "%s/%s-%s" % (set_name, name, ann_id)
+		nodes[ann_id] = (label, node_id)
+		props[node_id] = {"id": node_id, "name": entity["text"], "category": class_names,
+							"acrobatType": acrobat_type,
+							"spans": ";".join("%s %s" % span for span in entity["spans"])}
+		node_rows.setdefault(label, []).append(props[node_id])
+		edge_rows.setdefault(("mentions", "Case", label), []).append(
+			{"source": case_id, "target": node_id, "props": {"text": entity["text"]}})
+	for ann_id, event in ann["events"].items():
+		if event["trigger"] in nodes:
+			nodes[ann_id] = nodes[event["trigger"]]
+
+	for acrobat_type, ann_id, value in ann["attributes"]:
+		if ann_id in nodes and nodes[ann_id][1] in props:
+			prop = compiled["properties"].get(acrobat_type, acrobat_type)
+			props[nodes[ann_id][1]][prop] = value
+
+	relations = list(ann["relations"])
+	for ann_id, event in ann["events"].items():
+		for role, arg_id in event["args"]:
+			relations.append((role.rstrip("0123456789"), ann_id, arg_id))
+	default_relation = (tschema.slot_property(DEFAULT_RELATION), False)
+	for acrobat_type, source, target in relations:
+		if source not in nodes or target not in nodes:
+			continue
+		edge_type, inverse = compiled["relations"].get(acrobat_type, default_relation)
+		if inverse:
+			source, target = target, source
+		(source_label, source_id), (target_label, target_id) = nodes[source], nodes[target]
+		if source_id == target_id:
+			continue
+		edge_rows.setdefault((edge_type, source_label, target_label), []).append(
+			{"source": source_id, "target": target_id,
+				"props": {"acrobatType": acrobat_type}})
+
+	return (node_rows, edge_rows, doc_row, case_row)
+
+def concept_mentions(key, node_rows, normalizer):
+	'''Resolves the annotations of one document, with the given key
+	(see doc_key()), as node rows from annotation_rows(), to concepts,
+	through a Normalizer. Only those
+	of the NORMALIZED_CLASSES are resolved.
+	Returns list of mention dicts (see mention_rows() in
+	tubduck_output), from the document's patient.'''
+
+	texts = [row["name"] for rows in node_rows.values() for row in rows
+				if NORMALIZED_CLASSES.intersection(row["category"])]
+	return [{"pmid": key, "patient": 1, "concept": result["concept"], "text": text}
+			for text, result in zip(texts, normalizer.resolve(texts))
+			if result is not None]
+
+def write_annotation_rows(backend, node_rows, edge_rows, doc_rows, case_rows, mentions=None):
+	'''Writes the rows of a batch of documents (see annotation_rows()),
+	nodes before the edges between them, then any concept mentions.'''
+
+	toutput.write_batches(doc_rows, lambda batch: backend.upsert_nodes("Publication", batch))
+	toutput.write_cases(backend, case_rows)
+	for label, rows in node_rows.items():
+		toutput.write_batches(rows, lambda batch: backend.upsert_nodes(label, batch))
+	for (edge_type, source_label, target_label), rows in edge_rows.items():
+		toutput.write_batches(rows, lambda batch: backend.upsert_edges(edge_type, source_label,
+																		target_label, batch,
+																		create_nodes=False))
+	if mentions:
+		toutput.write_mentions(backend, mentions)
+
+def find_ann_files(paths):
+	'''Returns sorted list of the .ann files given, or in the given
+	directories and their subdirectories.'''
+
+	filepaths = []
+	for path in paths:
+		path = Path(path)
+		if path.is_dir():
+			filepaths.extend(path.glob("**/*.ann"))
+		elif path.suffix == ".ann":
+			filepaths.append(path)
+	return sorted(filepaths)
+
+def import_annotations(paths, backend=None, workers=None, map_path=MAP_PATH, normalizer=None):
+	'''Loads brat annotation sets into the instance graph.
+	Takes a list of .ann files or directories holding them.
+	If a Normalizer is given (see tubduck_normalize), annotations
+	are linked to the concepts they resolve to.
+	Files are parsed in parallel processes, FILES_PER_TASK at a time;
+	workers sets the number of processes (default is one per CPU).
+	Rows are written once at least toutput.BATCH_SIZE nodes have
+	been collected, through the given graph backend, or the one set
+	by GRAPH_BACKEND (see tubduck_graph).
+	Returns True if all files were loaded without error.'''
+
+	status = False
+
+	filepaths = find_ann_files(paths)
+	if len(filepaths) == 0:
+		print("No annotation files found.")
+		return status
+
+	compiled = compile_type_map(read_type_map(map_path))
+	if backend is None:
+		backend = tgraph.get_backend()
+
+	print("Loading annotations from %s document(s)..." % len(filepaths))
+	counts = {"entities": 0, "relations": 0, "mismatches": 0, "concepts": 0}
+	pending = ({}, {}, [], [], [])
+	pending_count = 0
+
+	with tmetrics.stage("import_annotations"):
+		try:
+			tschema.provision(backend, map_labels(compiled))
+			tasks = [filepaths[i:i+FILES_PER_TASK]
+						for i in range(0, len(filepaths), FILES_PER_TASK)]
+			pbar = tqdm(unit=" documents", total=len(filepaths))
+			with ProcessPoolExecutor(max_workers=workers) as executor:
+				for results in executor.map(parse_ann_files, tasks):
+					for set_name, name, ann, mismatches in results:
+						node_rows, edge_rows, doc_row, case_row = annotation_rows(set_name, name,
+																				ann, compiled)
+						for label, rows in node_rows.items():
+							pending[0].setdefault(label, []).extend(rows)
+							pending_count = pending_count + len(rows)
+						for key, rows in edge_rows.items():
+							pending[1].setdefault(key, []).extend(rows)
+						pending[2].append(doc_row)
+						pending[3].append(case_row)
+						if normalizer is not None:
+							mentions = concept_mentions(doc_key(set_name, name), node_rows,
+														normalizer)
+							pending[4].extend(mentions)
+							counts["concepts"] = counts["concepts"] + len(mentions)
+						counts["entities"] = counts["entities"] + len(ann["entities"])
+						counts["relations"] = counts["relations"] + len(ann["relations"])
+						counts["mismatches"] = counts["mismatches"] + mismatches
+						tmetrics.add(records_in=1)
+					if pending_count >= toutput.BATCH_SIZE:
+						write_annotation_rows(backend, *pending)
+						pending = ({}, {}, [], [], [])
+						pending_count = 0
+					pbar.update(len(results))
+			write_annotation_rows(backend, *pending)
+			pbar.close()
+			tmetrics.add(records_out=counts["entities"])
+			status = True
+		except (OSError, UnicodeDecodeError, sqlite3.Error,
+				neobolt.exceptions.DatabaseError, neobolt.exceptions.ClientError,
+				neobolt.exceptions.ServiceUnavailable) as e:
+			print("Encountered an error while loading annotations: %s" % e)
+
+	print("Loaded %s entities and %s relations." % (counts["entities"], counts["relations"]))
+	if normalizer is not None:
+		print("Linked %s annotations to concepts." % counts["concepts"])
+	if counts["mismatches"] > 0:
+		print("Text of %s entities didn't match their spans; took it from the documents."
+				% counts["mismatches"])
+
+	return status
@@ -0,0 +1,183 @@
+#!/usr/bin/python
+#tubduck_cache.py
+'''
+Query result caching for TUBDUCK.
+
+Results of graph DB reads are cached under a key combining the
+normalized Cypher statement, its parameters, and the graph generation:
+a counter that the Neo4j graph backend increases after every write
+or delete (see tubduck_graph), as do the functions that load the graph.
+Once the graph changes, older entries no longer match any key,
+so nothing needs to be invalidated explicitly.
+Entries are evicted when the cache is full (least recently used first)
+or when they are older than their time to live. A cache may also be
+stored in an SQLite file so it survives restarts until the graph changes.
+'''
+
+from collections import OrderedDict
+import hashlib
+import json
+import os
+from pathlib import Path
+import threading
+import time
+
+import sqlite3
+
+## Constants
+WORKING_PATH = Path('../working')
+GENERATION_PATH = Path('../working/graph_generation')
+CACHE_DB_PATH = Path('../working/query_cache.sqlite')
+
+MAX_ENTRIES = 10000 #Default maximum number of entries held in memory
+TTL = 86400 #Default time to live for entries, in seconds
+
+## Functions
+def get_generation():
+	'''Returns the current graph generation, or 0 if
+	the graph has never been written to.'''
+
+	try:
+		return int(GENERATION_PATH.read_text().strip())
+	except (FileNotFoundError, ValueError):
+		return 0
+
+def bump_generation():
+	'''Increases the graph generation, so all cached results
+	from before are no longer used. Call whenever the graph changes.
+	Returns the new generation.'''
+
+	WORKING_PATH.mkdir(parents=True, exist_ok=True)
+	generation = get_generation() + 1
+	temppath = GENERATION_PATH.with_suffix(".tmp")
+	temppath.write_text(str(generation))
+	os.replace(str(temppath), str(GENERATION_PATH)) #So readers never see a partial write
+
+	return generation
+
+def normalize_cypher(statement):
+	'''Collapses whitespace in a Cypher statement so differently
+	formatted copies of the same statement share cache entries.
+	Values belong in parameters, not literals, for this to be safe.'''
+
+	return " ".join(statement.split())
+
+def make_key(statement, params, generation):
+	'''Returns the cache key for a statement with parameters
+	at a given graph generation.'''
+
+	key_data = json.dumps([normalize_cypher(statement), params or {}, generation],
+							sort_keys=True, default=str)
+
+	return hashlib.sha1(key_data.encode("utf-8")).hexdigest()
+
+## Classes
+class QueryCache:
+	'''A cache of graph DB query results.
+	Results are stored as lists of dicts, as from Record.data(),
+	with values JSON can't represent (e.g., dates) stored as strings.
+	If persist_path is given, entries are also written to an SQLite file
+	there and read back by later processes; persistence is skipped if
+	its directory doesn't exist yet.'''
+
+	def __init__(self, max_entries=MAX_ENTRIES, ttl=TTL, persist_path=None):
+		self.max_entries = max_entries
+		self.ttl = ttl
+		self.persist_path = persist_path
+		self.entries = OrderedDict() #Keys are cache keys, values are (time, result)
+		self.lock = threading.Lock()
+		self.dbcon = None
+		self.hits = 0
+		self.misses = 0
+
+	def connect(self):
+		'''Opens the persistent store, if any. Returns a connection or None.'''
+
+		if self.persist_path is None or not Path(self.persist_path).parent.exists():
+			return None
+		if self.dbcon is None:
+			self.dbcon = sqlite3.connect(str(self.persist_path), check_same_thread=False)
+			self.dbcon.execute("""CREATE TABLE IF NOT EXISTS entries (
+								key text PRIMARY KEY,
+								generation integer,
+								created real,
+								result text)""")
+			#Entries from earlier generations can never be used again
+			self.dbcon.execute("DELETE FROM entries WHERE generation < ?", (get_generation(),))
+			self.dbcon.commit()
+		return self.dbcon
+
+	def get(self, key):
+		'''Returns a cached result, or None if there isn't a current one.'''
+
+		now = time.time()
+		with self.lock:
+			if key in self.entries:
+				created, result = self.entries[key]
+				if now - created <= self.ttl:
+					self.entries.move_to_end(key)
+					self.hits = self.hits + 1
+					return result
+				del self.entries[key]
+
+			dbcon = self.connect()
+			if dbcon is not None:
+				row = dbcon.execute("SELECT created, result FROM entries WHERE key = ?",
+									(key,)).fetchone()
+				if row is not None and now - row[0] <= self.ttl:
+					result = json.loads(row[1])
+					self.store(key, row[0], result)
+					self.hits = self.hits + 1
+					return result
+
+			self.misses = self.misses + 1
+			return None
+
+	def store(self, key, created, result):
+		'''Adds an entry in memory, evicting the least recently used
+		entries if there are too many. Call with the lock held.'''
+
+		self.entries[key] = (created, result)
+		self.entries.move_to_end(key)
+		while len(self.entries) > self.max_entries:
+			self.entries.popitem(last=False)
+
+	def put(self, key, result, generation):
+		'''Caches a result. Returns the result as it is stored.'''
+
+		result_json = json.dumps(result, default=str)
+		result = json.loads(result_json)
+		created = time.time()
+		with self.lock:
+			self.store(key, created, result)
+			dbcon = self.connect()
+			if dbcon is not None:
+				dbcon.execute("INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?)",
+								(key, generation, created, result_json))
+				dbcon.commit()
+
+		return result
+
+	def run(self, session, statement, params=None):
+		'''Runs a read query through the cache.
+		Takes a Neo4j session, a Cypher statement and a dict of parameters.
+		Returns the result as a list of dicts.'''
+
+		generation = get_generation()
+		key = make_key(statement, params, generation)
+		result = self.get(key)
+		if result is None:
+			records = session.run(statement, params or {})
+			result = self.put(key, [record.data() for record in records], generation)
+
+		return result
+
+	def clear(self):
+		'''Removes all entries, including persistent ones.'''
+
+		with self.lock:
+			self.entries.clear()
+			dbcon = self.connect()
+			if dbcon is not None:
+				dbcon.execute("DELETE FROM entries")
+				dbcon.commit()
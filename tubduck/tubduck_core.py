@@ -4,7 +4,7 @@
 This is the primary file for TUBDUCK.
 It is intended to call all submethods as modules.
 
-Requires Python 3.4 or above.
+Requires Python 3.7 or above.
 Uses Neo4j graph database. 
   This requires Java 8; see https://neo4j.com/docs/ for more info.
 
@@ -14,58 +14,105 @@ Knowledgebases. It renders experimental and clinical text as graphs,
 for integration into a knowledge graph. TUBDUCK is designed to be
 domain-sensitive, particularly for cardiovascular disease research
 and cardiovascular clinial case reports.
+
+Usage: python3 tubduck_core.py [command] [options]
+Commands are listed with --help; "run" is the default.
+Modules are only imported by the commands that need them,
+so starting up (e.g., for --help) stays fast.
 '''
 __author__= "Harry Caufield"
 __email__ = "jcaufield@mednet.ucla.edu"
 
-import sys, argparse
+import argparse
+import sys
 
 #import nltk
 
-import tubduck_helpers as thelp
-import tubduck_start as tstart
-import tubduck_input as tinput
-import tubduck_process as tproc
-import tubduck_output as toutput
-
 ## Constants and Options
-parser = argparse.ArgumentParser()
-parser.add_argument("--empty_db", help="empty the TUBDUCK Neo4j DB", 
-					action="store_true")
-parser.add_argument("--test_load_db", help="load only a testing set (100 entries each) of each data source into the DB", 
-					action="store_true")
-parser.add_argument("--get_pmid", help="retrieve one or more documents in MEDLINE format from PubMed based on PMID", 
-					action="append", nargs='+')
-parser.add_argument("--get_pmid_file", help="retrieve documents specified in a file containing one PMID per line",
-					action="append")
-args = parser.parse_args()
-
-## Classes
+COMMANDS = ["run", "setup", "stream", "stats", "empty", "fetch", "annotations", "normalize", "export", "predict", "evaluate", "serve"]
 
 ## Functions
+def get_parser():
+	'''Builds the command line parser, with a subparser per command.'''
+
+	parser = argparse.ArgumentParser(prog="tubduck_core.py",
+					description="TUBDUCK: Translating Unstructured Biomedical Data into Unified, Coherent Knowledgebases.")
+	subparsers = parser.add_subparsers(dest="command", metavar="command")
+
+	run_parser = subparsers.add_parser("run", help="set up as needed, then parse input documents, process and write output (the default)")
+	run_parser.add_argument("--empty_db", help="empty the TUBDUCK Neo4j DB", 
+						action="store_true")
+	run_parser.add_argument("--test_load_db", help="load only a testing set (100 entries each) of each data source into the DB", 
+						action="store_true")
+	run_parser.add_argument("--resume", help="continue loading the graph DB from where an interrupted load stopped",
+						action="store_true")
+	run_parser.add_argument("--get_pmid", help="retrieve one or more documents in MEDLINE format from PubMed based on PMID", 
+						action="append", nargs='+')
+	run_parser.add_argument("--get_pmid_file", help="retrieve documents specified in a file containing one PMID per line",
+						action="append")
+	run_parser.add_argument("--export_graph", help="export the concept graph as node and edge tables, as Arrow if pyarrow is installed or NumPy .npz otherwise",
+						action="store_true")
+	run_parser.add_argument("--predict_links", help="score candidate missing relations in the graph with the given method (common_neighbors, adamic_adar or katz) and write the top candidates for each node")
+	run_parser.add_argument("--evaluate", help="run a suite of test queries (e.g., mito) against the graph DB and report correctness and latency",
+						action="append")
+	run_parser.add_argument("--workers", help="run up to this many independent steps at once (default: CPU count + 4)",
+						type=int)
+	run_parser.add_argument("--profile", help="profile each step of the run with cProfile, writing .prof files and summaries to ../working/profiles",
+						action="store_true")
+	run_parser.add_argument("--profile-memory", help="trace memory allocations in each step of the run, writing the lines with the most growth to ../working/profiles",
+						action="store_true")
+
+	setup_parser = subparsers.add_parser("setup", help="retrieve and process knowledge bases and populate the graph DB, as needed")
+	setup_parser.add_argument("--test_load_db", help="load only a testing set (100 entries each) of each data source into the DB", 
+						action="store_true")
+	setup_parser.add_argument("--resume", help="continue loading the graph DB from where an interrupted load stopped",
+						action="store_true")
+	setup_parser.add_argument("--workers", help="run up to this many independent setup tasks at once",
+						type=int)
+
+	stream_parser = subparsers.add_parser("stream", help="stream knowledge bases from their sources straight into the graph DB, without writing files")
+	stream_parser.add_argument("kbs", help="codes of the knowledge bases to stream (default: don m19)",
+						nargs="*")
+	stream_parser.add_argument("--local", help="stream from the files already in ../working/kbs instead of downloading them",
+						action="store_true")
+
+	subparsers.add_parser("stats", help="count nodes and relations in the graph DB and check each knowledge base is fully loaded")
+
+	subparsers.add_parser("empty", help="empty the TUBDUCK graph DB")
+
+	fetch_parser = subparsers.add_parser("fetch", help="retrieve documents in MEDLINE format from PubMed, to be parsed on the next run")
+	fetch_parser.add_argument("pmids", help="PMIDs to retrieve", nargs="*")
+	fetch_parser.add_argument("--pmid_file", help="a file containing one PMID per line")
+
+	annotations_parser = subparsers.add_parser("annotations", help="load brat annotation sets (.ann and .txt files, e.g., from ACROBAT) into the instance graph")
+	annotations_parser.add_argument("paths", help=".ann files, or directories of them",
+						nargs="+")
+	annotations_parser.add_argument("--workers", help="parse files in up to this many processes",
+						type=int)
+	annotations_parser.add_argument("--normalize", help="also link annotations to the concepts they resolve to",
+						action="store_true")
+
+	normalize_parser = subparsers.add_parser("normalize", help="resolve mentions to the concepts of the processed knowledge bases")
+	normalize_parser.add_argument("mentions", help="mentions to resolve, e.g., \"heart attacks\"",
+						nargs="+")
+
+	subparsers.add_parser("export", help="export the concept graph as node and edge tables")
+
+	predict_parser = subparsers.add_parser("predict", help="score candidate missing relations in the graph")
+	predict_parser.add_argument("method", help="common_neighbors, adamic_adar or katz",
+						nargs="?", default="adamic_adar")
+
+	evaluate_parser = subparsers.add_parser("evaluate", help="run suites of test queries against the graph DB")
+	evaluate_parser.add_argument("suites", help="names of suites in ../evaluation, or paths to them",
+						nargs="+")
+
+	subparsers.add_parser("serve", help="start the lookup service")
+
+	return parser
+
+def check_version():
+	'''Exits if this Python is too old.'''
 
-## Main
-def main():
-	
-	pmids_to_get = []
-	
-	#Check to see if there are command line arguments first
-	tasks = [] #All user-specified tasks will go here
-	if args.empty_db:
-		tasks.append("empty_db")
-	if args.test_load_db:
-		tasks.append("test_load_db")
-	if args.get_pmid:
-		for pmid in args.get_pmid[0]:
-			pmids_to_get.append(pmid)
-	if args.get_pmid_file:
-		with open(args.get_pmid_file[0]) as pmid_file:
-			for pmid in pmid_file:
-				pmids_to_get.append(pmid)
-	
-	print("*** TUBDUCK ***")
-	
-	#A quick version check
 	if sys.version_info[0] < 3:
 		sys.exit("Not compatible with Python2 -- sorry!\n"
 					"Exiting...")
@@ -73,12 +120,26 @@ def main():
 		if sys.version_info[1] < 7:
 			sys.exit("Python3.7 or more recent is required for proper operation.\n"
 						"Exiting...")
-	
+
+def run_setup(tasks, scheduler=None, workers=None):
+	'''Checks what setup is needed and does it.
+	If a Scheduler is given, setup tasks are added to it as stages
+	instead, to run alongside others; returns the list of their names.
+	Exits if setup fails or if only emptying the DB was requested.'''
+
+	import tubduck_profile as tprofile
+	import tubduck_start as tstart
+
 	print("Checking to see what setup may be required.")
-	setup_to_do = tstart.setup_checks(tasks)
+	with tprofile.step("setup_checks"):
+		setup_to_do = tstart.setup_checks(tasks)
 	if len(setup_to_do) > 0:
 		print("Performing intial setup for: \n* %s" % ("\n* ".join(setup_to_do)))
-		if tstart.setup(setup_to_do):
+		if scheduler is not None and "empty_db" not in tasks:
+			return tstart.add_setup_stages(setup_to_do, scheduler)
+		with tprofile.step("setup"):
+			setup_done = tstart.setup(setup_to_do, workers=workers)
+		if setup_done:
 			print("All setup complete.")
 			if "empty_db" in tasks:
 				sys.exit("Database empty, exiting.")
@@ -86,14 +147,21 @@ def main():
 			sys.exit("Setup did not complete properly.")
 	else:
 		print("No setup required.")
-		
-	print("Getting input ready.")
-	tinput.setup()
+	return []
+
+def read_pmid_file(filename):
+	'''Returns a list of PMIDs from a file with one per line.'''
+
+	with open(filename) as pmid_file:
+		return [pmid.strip() for pmid in pmid_file if pmid.strip() != ""]
+
+def ingest_docs():
+	'''Finds local input documents and parses them into the input DB.
+	Returns True once done.'''
+
+	import tubduck_input as tinput
 
-	if len(pmids_to_get) > 0 :
-		newpmidfile = tinput.get_remote_docs(pmids_to_get)
 	doc_file_index = tinput.get_local_docs()
-	parsed_docs = {}
 	for filetype in doc_file_index:
 		filecount = len(doc_file_index[filetype])
 		if filecount == 0:
@@ -101,15 +169,196 @@ def main():
 		else:
 			print("Found %s local %s input files." % (filecount, filetype))
 	tinput.parse_docs(doc_file_index)
-	
+	return True
+
+def run_processing(args):
+	'''Runs the tubduck_process methods requested in args.
+	Returns True once done; failures are reported but not fatal.'''
+
+	import tubduck_export as texport
+	import tubduck_process as tproc
+
 	print("Processing...")
-	#Run tubduck_process methods
-	
+	if args.export_graph:
+		if not texport.export_graph():
+			print("Could not export the concept graph.")
+	if args.predict_links:
+		if not tproc.predict_links(args.predict_links):
+			print("Could not predict relations.")
+	if args.evaluate:
+		for suite in args.evaluate:
+			tproc.run_evaluation(suite)
+	return True
+
+def write_output():
+	'''Writes the instance graph.
+	Returns True if it was written.'''
+
+	import tubduck_metrics as tmetrics
+	import tubduck_output as toutput
+
 	print("Preparing output...")
-	#Run tubduck_output methods
+	with tmetrics.stage("write_instance_graph"):
+		return toutput.write_instance_graph()
+
+def run_pipeline(args):
+	'''Runs the whole pipeline: setup as needed, then
+	input, processing and output.
+	Steps run as stages of a Scheduler, so input documents are
+	retrieved and parsed while KBs are set up; processing and output
+	wait for both. When profiling, stages run one at a time, on threads,
+	so each profile covers one stage.'''
+
+	import tubduck_input as tinput
+	import tubduck_metrics as tmetrics
+	import tubduck_profile as tprofile
+	import tubduck_schedule as tschedule
+
+	pmids_to_get = []
+	
+	#Check to see if there are command line arguments first
+	tasks = [] #All user-specified tasks will go here
+	if args.empty_db:
+		tasks.append("empty_db")
+	if args.test_load_db:
+		tasks.append("test_load_db")
+	if args.resume:
+		tasks.append("resume")
+	if args.get_pmid:
+		for pmid in args.get_pmid[0]:
+			pmids_to_get.append(pmid)
+	if args.get_pmid_file:
+		pmids_to_get.extend(read_pmid_file(args.get_pmid_file[0]))
+	
+	tmetrics.start_run()
+	if args.profile or args.profile_memory:
+		tprofile.configure(cpu=args.profile, memory=args.profile_memory)
+		scheduler = tschedule.Scheduler(workers=1, use_processes=False, context=tprofile.step)
+	else:
+		scheduler = tschedule.Scheduler(workers=args.workers)
+	
+	setup_stages = run_setup(tasks, scheduler, workers=args.workers)
+	
+	print("Getting input ready.")
+	scheduler.add("input_setup", tinput.setup)
+	input_stages = ["input_setup"]
+	if len(pmids_to_get) > 0 :
+		input_stages.append(scheduler.add("remote_fetch", tinput.get_remote_docs, (pmids_to_get,),
+											deps=["input_setup"], group="download"))
+	scheduler.add("parse_docs", ingest_docs, deps=input_stages)
+	scheduler.add("processing", run_processing, (args,), deps=["parse_docs"] + setup_stages)
+	scheduler.add("output", write_output, deps=["processing"], group="graph")
+	
+	results = scheduler.run()
+	tmetrics.finish_run()
+	if any(results[name]["status"] != "done" for name in setup_stages):
+		sys.exit("Setup did not complete properly.")
+	if len(setup_stages) > 0:
+		print("All setup complete.")
+	if results["output"]["status"] != "done":
+		sys.exit("Could not write the instance graph.")
 	
 	print("Done.")
 
+def run_command(args):
+	'''Runs any command other than "run".
+	Returns True if it completes without error.'''
+
+	if args.command == "setup":
+		tasks = []
+		if args.test_load_db:
+			tasks.append("test_load_db")
+		if args.resume:
+			tasks.append("resume")
+		run_setup(tasks, workers=args.workers)
+		return True
+
+	if args.command == "stream":
+		import tubduck_stream as tstream
+		return tstream.stream_kbs(args.kbs or None, local=args.local)
+
+	if args.command == "stats":
+		import tubduck_start as tstart
+		verified = tstart.verify_loads()
+		for kb, result in verified.items():
+			print("%s: %s of %s entries loaded (%s)" % (kb, result["loaded"],
+														result["expected"], result["status"]))
+		return all(result["status"] in ["complete", "not processed"]
+					for result in verified.values())
+
+	if args.command == "empty":
+		import tubduck_start as tstart
+		return tstart.empty_graphdb()
+
+	if args.command == "fetch":
+		import tubduck_input as tinput
+		pmids = list(args.pmids)
+		if args.pmid_file:
+			pmids.extend(read_pmid_file(args.pmid_file))
+		if len(pmids) == 0:
+			print("No PMIDs to retrieve.")
+			return False
+		tinput.setup()
+		tinput.get_remote_docs(pmids)
+		return True
+
+	if args.command == "annotations":
+		import tubduck_brat as tbrat
+		normalizer = None
+		if args.normalize:
+			import tubduck_normalize as tnorm
+			normalizer = tnorm.Normalizer()
+		return tbrat.import_annotations(args.paths, workers=args.workers,
+										normalizer=normalizer)
+
+	if args.command == "normalize":
+		import tubduck_normalize as tnorm
+		normalizer = tnorm.Normalizer()
+		results = normalizer.resolve(args.mentions)
+		normalizer.close()
+		for mention, result in zip(args.mentions, results):
+			if result is None:
+				print("%s: no match" % mention)
+			else:
+				print("%s: %s %s (%.2f)" % (mention, result["concept"], result["name"],
+											result["score"]))
+		return True
+
+	if args.command == "export":
+		import tubduck_export as texport
+		return texport.export_graph()
+
+	if args.command == "predict":
+		import tubduck_process as tproc
+		return tproc.predict_links(args.method)
+
+	if args.command == "evaluate":
+		import tubduck_process as tproc
+		reports = [tproc.run_evaluation(suite) for suite in args.suites]
+		return all(report is not None and report["failed"] == 0 for report in reports)
+
+	if args.command == "serve":
+		import tubduck_server as tserver
+		return tserver.serve()
+
+## Main
+def main(argv=None):
+	
+	if argv is None:
+		argv = sys.argv[1:]
+	if len(argv) == 0 or (argv[0] not in COMMANDS and argv[0] not in ["-h", "--help"]):
+		argv = ["run"] + list(argv) #Options without a command are for "run"
+	args = get_parser().parse_args(argv)
+	
+	print("*** TUBDUCK ***")
+	
+	#A quick version check
+	check_version()
+	
+	if args.command == "run":
+		run_pipeline(args)
+	elif not run_command(args):
+		sys.exit("Could not complete %s." % args.command)
+
 if __name__ == "__main__":
 	sys.exit(main())
-
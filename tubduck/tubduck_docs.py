@@ -0,0 +1,180 @@
+#!/usr/bin/python
+#tubduck_docs.py
+'''
+Document access functions for TUBDUCK.
+
+These provide read access to the input document store (the SQLite
+database populated by tubduck_input) for processing and output stages.
+Documents are yielded in batches rather than loaded all at once, and the
+table may be split into ranges so several consumers can each take one.
+Connections are read-only; the input database uses WAL journaling,
+so reading may happen while ingestion is still writing.
+'''
+
+from pathlib import Path
+
+import sqlite3
+
+## Constants
+DB_PATH = Path('../input/db.sqlite')
+
+BATCH_SIZE = 1000 #Default number of documents per batch
+
+RANGE_KEYS = ["rowid", "PMID"]
+'''
+Columns the documents table may be split on.
+PMIDs are stored as text, so PMID ranges are in text order.
+'''
+
+## Functions
+def docs_db_connect(db_path=DB_PATH):
+	'''Opens a read-only connection to the input database.
+	Rows are returned as sqlite3.Row objects.
+	Returns the connection.'''
+
+	db_uri = Path(db_path).resolve().as_uri() + "?mode=ro"
+	dbcon = sqlite3.connect(db_uri, uri=True, timeout=60)
+	dbcon.row_factory = sqlite3.Row
+
+	return dbcon
+
+def get_doc_columns(dbcon):
+	'''Returns a list of the column names in the documents table.'''
+
+	return [row[1] for row in dbcon.execute("PRAGMA table_info(documents)")]
+
+def build_doc_select(dbcon, columns):
+	'''Builds the column list of a SELECT statement for documents.
+	columns is a list of column names, or None for all columns.
+	Raises ValueError for names that aren't columns.'''
+
+	if columns is None:
+		return "rowid AS rowid, *"
+
+	known_columns = get_doc_columns(dbcon)
+	unknown = [column for column in columns if column not in known_columns + ["rowid"]]
+	if len(unknown) > 0:
+		raise ValueError("No document column(s) named %s." % ", ".join(unknown))
+
+	return ", ".join(columns)
+
+def build_doc_query(dbcon, columns, key, start, end):
+	'''Builds a SELECT statement for documents, with only the
+	requested columns, optionally limited to a range of key values.
+	The start of a range is inclusive and the end is exclusive;
+	None leaves that side open.
+	Returns a tuple of the statement and its parameters.'''
+
+	if key not in RANGE_KEYS:
+		raise ValueError("Documents can't be split on %s - use one of %s." % (key, RANGE_KEYS))
+
+	select = build_doc_select(dbcon, columns)
+
+	conditions = []
+	params = []
+	if key == "PMID": #Documents without PMIDs (e.g., raw) aren't in any PMID range
+		conditions.append("PMID IS NOT NULL")
+	if start is not None:
+		conditions.append("%s >= ?" % key)
+		params.append(start)
+	if end is not None:
+		conditions.append("%s < ?" % key)
+		params.append(end)
+
+	sql = "SELECT %s FROM documents" % select
+	if len(conditions) > 0:
+		sql = sql + " WHERE " + " AND ".join(conditions)
+	sql = sql + " ORDER BY %s" % key
+
+	return (sql, params)
+
+def iter_doc_batches(columns=None, batch_size=BATCH_SIZE, key="rowid",
+						start=None, end=None, db_path=DB_PATH):
+	'''Yields lists of documents from the input database,
+	batch_size documents at a time, as dicts.
+	columns is a list of the columns to include (default is all).
+	A range of key values, as produced by get_doc_ranges(),
+	may be given to read only part of the table.'''
+
+	dbcon = docs_db_connect(db_path)
+	try:
+		sql, params = build_doc_query(dbcon, columns, key, start, end)
+		cur = dbcon.execute(sql, params)
+		while 1:
+			rows = cur.fetchmany(batch_size)
+			if not rows:
+				break
+			yield [dict(row) for row in rows]
+	finally:
+		dbcon.close()
+
+def iter_docs(columns=None, batch_size=BATCH_SIZE, key="rowid",
+				start=None, end=None, db_path=DB_PATH):
+	'''Yields documents from the input database one at a time, as dicts.
+	Reads from the database in batches; takes the same options
+	as iter_doc_batches().'''
+
+	for batch in iter_doc_batches(columns, batch_size, key, start, end, db_path):
+		for doc in batch:
+			yield doc
+
+def count_docs(key="rowid", start=None, end=None, db_path=DB_PATH):
+	'''Returns the number of documents in the input database,
+	or in a range of it.'''
+
+	dbcon = docs_db_connect(db_path)
+	try:
+		sql, params = build_doc_query(dbcon, [key], key, start, end)
+		count = dbcon.execute("SELECT COUNT(*) FROM (%s)" % sql, params).fetchone()[0]
+	finally:
+		dbcon.close()
+
+	return count
+
+def get_docs_by_pmid(pmids, columns=None, db_path=DB_PATH):
+	'''Looks up documents by PMID.
+	Takes a list of PMIDs and optionally a list of columns.
+	Returns a dict of documents, as dicts, keyed by PMID;
+	PMIDs not in the database are left out.'''
+
+	docs = {}
+
+	dbcon = docs_db_connect(db_path)
+	try:
+		if columns is not None and "PMID" not in columns:
+			columns = ["PMID"] + columns
+		sql = "SELECT %s FROM documents WHERE PMID IN (%%s)" % build_doc_select(dbcon, columns)
+		for i in range(0, len(pmids), 500): #Stay under SQLite's variable limit
+			chunk = [str(pmid) for pmid in pmids[i:i+500]]
+			for row in dbcon.execute(sql % ", ".join(["?"] * len(chunk)), chunk):
+				docs[row["PMID"]] = dict(row)
+	finally:
+		dbcon.close()
+
+	return docs
+
+def get_doc_ranges(parts, key="rowid", db_path=DB_PATH):
+	'''Splits the documents table into contiguous ranges of
+	roughly equal size, one for each of parts consumers.
+	key may be "rowid" or "PMID".
+	Returns a list of (start, end) tuples, to be passed to
+	iter_doc_batches(); the first start and last end are None.'''
+
+	dbcon = docs_db_connect(db_path)
+	try:
+		sql, params = build_doc_query(dbcon, [key], key, None, None)
+		total = dbcon.execute("SELECT COUNT(*) FROM (%s)" % sql, params).fetchone()[0]
+
+		bounds = []
+		for i in range(1, parts):
+			row = dbcon.execute(sql + " LIMIT 1 OFFSET ?",
+								params + [(total * i) // parts]).fetchone()
+			if row is not None and row[0] not in bounds:
+				bounds.append(row[0])
+	finally:
+		dbcon.close()
+
+	starts = [None] + bounds
+	ends = bounds + [None]
+
+	return list(zip(starts, ends))
@@ -0,0 +1,360 @@
+#!/usr/bin/python
+#tubduck_export.py
+'''
+Graph export functions for TUBDUCK.
+
+Exports the concept graph as columnar node and edge tables for
+analysis outside of Neo4j. Tables are built from the processed
+knowledge base files directly, or streamed from the graph DB. Node IDs are encoded as integers (their row in the node
+table), so edges are just pairs of integers.
+
+If pyarrow is installed, tables are written as Arrow IPC files
+(or Parquet, if requested). Otherwise they are written as one
+uncompressed NumPy .npz file. Either way, load_graph_export() reads
+them back through memory maps, without copying.
+'''
+
+import ast
+from itertools import islice
+from pathlib import Path
+import zipfile
+
+import numpy as np
+
+try:
+	import pyarrow as pa
+	import pyarrow.parquet as pq
+except ImportError: #Optional; exports fall back to .npz
+	pa = None
+
+from tqdm import *
+
+import neobolt.exceptions
+
+import tubduck_graph as tgraph
+import tubduck_start as tstart
+
+## Constants
+EXPORT_PATH = Path('../working/export')
+
+PAGE_SIZE = 50000 #Nodes or relationships added at a time when reading from Neo4j
+
+FORMATS = ["arrow", "parquet", "npz"]
+
+## Functions
+def new_graph():
+	'''Returns an empty set of graph tables, as a dict of lists.
+	Nodes are indexed in node_index by their IDs.'''
+
+	return {"node_id": [], "node_name": [], "node_source": [], "node_label": [],
+			"edge_src": [], "edge_dst": [], "edge_type": [], "node_index": {}}
+
+def add_node(graph, node_id, name="", source="", label=""):
+	'''Adds a node to the graph tables if it isn't there yet,
+	filling in any empty values if it is.
+	Returns the node's integer index.'''
+
+	index = graph["node_index"].get(node_id)
+	if index is None:
+		index = len(graph["node_id"])
+		graph["node_index"][node_id] = index
+		graph["node_id"].append(node_id)
+		graph["node_name"].append(name or "")
+		graph["node_source"].append(source)
+		graph["node_label"].append(label)
+	elif name and graph["node_name"][index] == "":
+		graph["node_name"][index] = name
+		graph["node_source"][index] = source
+		graph["node_label"][index] = label
+
+	return index
+
+def add_edge(graph, src_id, dst_id, edge_type):
+	'''Adds an edge between two node IDs, adding either node
+	if it isn't in the graph yet. Self-loops are skipped.'''
+
+	if src_id == dst_id:
+		return
+	graph["edge_src"].append(add_node(graph, src_id))
+	graph["edge_dst"].append(add_node(graph, dst_id))
+	graph["edge_type"].append(edge_type)
+
+def add_kb_entry(graph, kb, entry):
+	'''Adds one entry from a processed KB file to the graph tables,
+	with its subclassOf edges (and hasPharmacologicalAction edges,
+	for MeSH).'''
+
+	if kb in tstart.OBO_KBS: #OBO entries hold lists
+		node_id = entry["id"][0]
+		name = entry.get("name", [""])[0]
+		parents = [(target.split("!")[0]).strip() for target in entry.get("is_a", [])]
+	else:
+		node_id = entry["id"]
+		name = entry.get("name", "")
+		parents = entry.get("is_a", [])
+		if isinstance(parents, str):
+			parents = [parents]
+
+	if kb.startswith("reactome"):
+		label = "Pathway"
+		parents = [parent for parent in parents if parent != "Reactome:NA"]
+	else:
+		label = "NamedThing"
+
+	add_node(graph, node_id, name, kb, label)
+	for parent in parents:
+		add_edge(graph, node_id, parent, "subclassOf")
+	for action in entry.get("pa", []):
+		add_edge(graph, node_id, action, "hasPharmacologicalAction")
+
+def read_kb_graph(kb_codes=None, inpath=tstart.KB_PROC_PATH):
+	'''Builds graph tables from processed KB files.
+	Takes a list of KB codes (default is all KBs with
+	processed files) and the Path of the processed files.
+	Returns the graph tables.'''
+
+	graph = new_graph()
+
+	if kb_codes is None:
+		kb_codes = [kb for kb in tstart.KB_NAMES if kb != "reactome2"]
+
+	for kb in kb_codes:
+		infilename = tstart.KB_NAMES[kb].split(".")[0] + "-proc"
+		infilepath = inpath / infilename
+		if not infilepath.exists():
+			print("No processed file for %s - skipping." % kb)
+			continue
+		print("Reading %s..." % infilename)
+		with infilepath.open() as infile:
+			pbar = tqdm(unit=" entries")
+			for line in infile:
+				try:
+					add_kb_entry(graph, kb, ast.literal_eval(line.rstrip()))
+				except (KeyError, IndexError, ValueError, SyntaxError): #Discard this entry
+					pass
+				pbar.update(1)
+			pbar.close()
+
+	return graph
+
+def read_neo4j_graph(backend=None, page_size=PAGE_SIZE):
+	'''Builds graph tables from the graph DB, through the given
+	graph backend, or the one set by GRAPH_BACKEND (see tubduck_graph).
+	Only the neo4j backend can be read this way; export from the
+	processed KB files otherwise.
+	Nodes and relationships are each streamed from a single query
+	and added page_size records at a time.
+	Raises ValueError for other backends.
+	Returns the graph tables.'''
+
+	if backend is None:
+		backend = tgraph.get_backend()
+	if backend.name != "neo4j":
+		raise ValueError("Can't read the graph from the %s backend - only from neo4j. "
+							"Use the processed KB files instead." % backend.name)
+
+	graph = new_graph()
+
+	node_statement = ("MATCH (n) WHERE exists(n.id) "
+						"RETURN n.id AS id, n.name AS name, labels(n) AS labels")
+	edge_statement = ("MATCH (a)-[r]->(b) "
+						"RETURN a.id AS src, b.id AS dst, type(r) AS type")
+
+	print("Reading graph from %s..." % tgraph.NEO4J_URI)
+	with backend.get_driver().session() as session:
+		pbar = tqdm(unit=" nodes")
+		records = iter(session.run(node_statement))
+		while 1:
+			page = list(islice(records, page_size))
+			if len(page) == 0:
+				break
+			for record in page:
+				labels = [label for label in record["labels"]
+							if not tgraph.is_source_label(label)]
+				add_node(graph, record["id"], record["name"], "neo4j",
+							labels[0] if len(labels) > 0 else "")
+			pbar.update(len(page))
+		pbar.close()
+
+		pbar = tqdm(unit=" relationships")
+		records = iter(session.run(edge_statement))
+		while 1:
+			page = list(islice(records, page_size))
+			if len(page) == 0:
+				break
+			for record in page:
+				if record["src"] is not None and record["dst"] is not None:
+					add_edge(graph, record["src"], record["dst"], record["type"])
+			pbar.update(len(page))
+		pbar.close()
+
+	return graph
+
+def encode_strings(values):
+	'''Encodes a list of strings as one UTF-8 byte array and an array
+	of offsets, where string i is data[offsets[i]:offsets[i+1]].
+	Returns a tuple of the two arrays.'''
+
+	encoded = [value.encode("utf-8") for value in values]
+	offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+	np.cumsum([len(value) for value in encoded], out=offsets[1:])
+	data = np.frombuffer(b"".join(encoded), dtype=np.uint8)
+
+	return (data, offsets)
+
+def decode_string(data, offsets, i):
+	'''Returns string i from a byte array and offsets, as made by encode_strings().'''
+
+	return bytes(data[offsets[i]:offsets[i+1]]).decode("utf-8")
+
+def encode_categories(values):
+	'''Encodes a list of strings as integer codes.
+	Returns a tuple of the code array and the list of distinct values.'''
+
+	categories = sorted(set(values))
+	lookup = {value: code for code, value in enumerate(categories)}
+	codes = np.array([lookup[value] for value in values], dtype=np.int16)
+
+	return (codes, categories)
+
+def write_npz(graph, outpath):
+	'''Writes graph tables to outpath/graph.npz, uncompressed, with
+	strings stored as byte arrays and offsets, and categorical columns
+	(source, label and edge type) as integer codes.'''
+
+	arrays = {}
+	arrays["node_id_data"], arrays["node_id_offsets"] = encode_strings(graph["node_id"])
+	arrays["node_name_data"], arrays["node_name_offsets"] = encode_strings(graph["node_name"])
+	for column in ["node_source", "node_label", "edge_type"]:
+		codes, categories = encode_categories(graph[column])
+		arrays[column] = codes
+		arrays[column + "_names_data"], arrays[column + "_names_offsets"] = encode_strings(categories)
+	arrays["edge_src"] = np.array(graph["edge_src"], dtype=np.int32)
+	arrays["edge_dst"] = np.array(graph["edge_dst"], dtype=np.int32)
+
+	outfilepath = outpath / "graph.npz"
+	np.savez(str(outfilepath), **arrays)
+
+	return [outfilepath]
+
+def write_arrow(graph, outpath, file_format):
+	'''Writes graph tables to outpath as nodes and edges tables,
+	in Arrow IPC (uncompressed, so it can be memory mapped) or Parquet.'''
+
+	nodes = pa.table({"id": pa.array(graph["node_id"], pa.string()),
+						"name": pa.array(graph["node_name"], pa.string()),
+						"source": pa.array(graph["node_source"], pa.string()).dictionary_encode(),
+						"label": pa.array(graph["node_label"], pa.string()).dictionary_encode()})
+	edges = pa.table({"src": pa.array(graph["edge_src"], pa.int32()),
+						"dst": pa.array(graph["edge_dst"], pa.int32()),
+						"type": pa.array(graph["edge_type"], pa.string()).dictionary_encode()})
+
+	outfilepaths = []
+	for name, table in [("nodes", nodes), ("edges", edges)]:
+		if file_format == "parquet":
+			outfilepath = outpath / (name + ".parquet")
+			pq.write_table(table, str(outfilepath))
+		else:
+			outfilepath = outpath / (name + ".arrow")
+			with pa.OSFile(str(outfilepath), "wb") as sink:
+				with pa.ipc.new_file(sink, table.schema) as writer:
+					writer.write_table(table)
+		outfilepaths.append(outfilepath)
+
+	return outfilepaths
+
+def export_graph(source="kbs", outpath=EXPORT_PATH, file_format=None, kb_codes=None):
+	'''Exports the concept graph as node and edge tables.
+	source is "kbs" to read processed KB files or "neo4j" to read
+	the graph DB. file_format is one of FORMATS; default is "arrow" if
+	pyarrow is installed and "npz" otherwise.
+	Returns True if the export completes without error.'''
+
+	status = False
+
+	if file_format is None:
+		file_format = "arrow" if pa is not None else "npz"
+	if file_format not in FORMATS:
+		print("Can't export as %s - use one of %s." % (file_format, ", ".join(FORMATS)))
+		return status
+	if file_format != "npz" and pa is None:
+		print("Exporting as %s requires pyarrow." % file_format)
+		return status
+
+	if source == "neo4j":
+		try:
+			graph = read_neo4j_graph()
+		except (ValueError, neobolt.exceptions.ServiceUnavailable,
+				neobolt.exceptions.DatabaseError) as e:
+			print("Could not read the graph DB: %s" % e)
+			return status
+	else:
+		graph = read_kb_graph(kb_codes)
+
+	print("Writing %s nodes and %s edges as %s..." %
+			(len(graph["node_id"]), len(graph["edge_src"]), file_format))
+	try:
+		outpath.mkdir(parents=True, exist_ok=True)
+		if file_format == "npz":
+			outfilepaths = write_npz(graph, outpath)
+		else:
+			outfilepaths = write_arrow(graph, outpath, file_format)
+		print("Wrote %s" % ", ".join(str(outfilepath) for outfilepath in outfilepaths))
+		status = True
+	except IOError as e:
+		print("Encountered an error while exporting graph: %s" % e)
+
+	return status
+
+def mmap_npz(filepath):
+	'''Memory maps every array in an uncompressed .npz file.
+	Members of an uncompressed ZIP are stored as-is, so each array
+	can be mapped at its offset within the file.
+	Returns a dict of arrays.'''
+
+	arrays = {}
+
+	with zipfile.ZipFile(str(filepath)) as npz, open(str(filepath), "rb") as npzfile:
+		for info in npz.infolist():
+			if info.compress_type != zipfile.ZIP_STORED:
+				raise ValueError("%s is compressed and can't be memory mapped." % filepath)
+			#The local header is 30 bytes plus variable-length name and extra fields
+			npzfile.seek(info.header_offset + 26)
+			name_length = int.from_bytes(npzfile.read(2), "little")
+			extra_length = int.from_bytes(npzfile.read(2), "little")
+			npzfile.seek(info.header_offset + 30 + name_length + extra_length)
+			version = np.lib.format.read_magic(npzfile)
+			if version == (1, 0):
+				shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(npzfile)
+			else:
+				shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(npzfile)
+			name = info.filename[:-len(".npy")]
+			if 0 in shape:
+				arrays[name] = np.zeros(shape, dtype=dtype)
+			else:
+				arrays[name] = np.memmap(str(filepath), dtype=dtype, mode="r", offset=npzfile.tell(),
+										shape=shape, order="F" if fortran_order else "C")
+
+	return arrays
+
+def load_graph_export(path=EXPORT_PATH):
+	'''Loads an exported graph without copying it into memory.
+	Arrow files are memory mapped; Parquet files are read normally.
+	Returns a dict with "nodes" and "edges" as pyarrow Tables for
+	Arrow and Parquet exports, or a dict of memory-mapped NumPy arrays
+	(see write_npz()) for .npz exports.'''
+
+	path = Path(path)
+
+	if (path / "graph.npz").exists():
+		return mmap_npz(path / "graph.npz")
+
+	tables = {}
+	for name in ["nodes", "edges"]:
+		if (path / (name + ".arrow")).exists():
+			source = pa.memory_map(str(path / (name + ".arrow")), "r")
+			tables[name] = pa.ipc.open_file(source).read_all()
+		else:
+			tables[name] = pq.read_table(str(path / (name + ".parquet")), memory_map=True)
+
+	return tables
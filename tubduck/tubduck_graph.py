@@ -0,0 +1,519 @@
+#!/usr/bin/python
+#tubduck_graph.py
+'''
+Graph DB backends for TUBDUCK.
+
+Everything that loads, counts or clears the graph goes through a
+backend, so the same code can write to Neo4j or to an embedded
+graph store. The backend is chosen with the GRAPH_BACKEND setting
+(see tubduck_settings):
+neo4j - the Neo4j server at NEO4J_HOST:NEO4J_PORT (the default)
+sqlite - an SQLite file at GRAPH_DB_PATH, for runs without a server
+memory - an in-memory SQLite DB, lost when the process exits;
+	useful for tests and benchmarks
+
+Nodes have a label, an ID unique within that label, and properties.
+Nodes loaded from a KB also have a source property, the KB's code;
+Neo4j gives them a second label for it (see source_label()), so
+they can be counted from its count store.
+Edges have a type and connect two nodes; there is at most one edge of
+each type between two nodes. All writes are upserts: writing the same
+node or edge again updates its properties rather than duplicating it.
+'''
+
+from datetime import date
+import json
+from pathlib import Path
+
+import sqlite3
+
+from neo4j import GraphDatabase
+import neobolt.exceptions
+
+import tubduck_cache as tcache
+import tubduck_metrics as tmetrics
+import tubduck_settings as tsettings
+
+## Constants
+NEO4J_HOST=tsettings.NEO4J_HOST
+NEO4J_PORT=tsettings.NEO4J_PORT
+NEO4J_URI = "bolt://" + NEO4J_HOST + ":" + str(NEO4J_PORT)
+NEO4J_USER=tsettings.NEO4J_USER
+NEO4J_PASSWORD=tsettings.NEO4J_PASSWORD
+
+GRAPH_BACKEND = tsettings.GRAPH_BACKEND
+GRAPH_DB_PATH = Path('../working/graph.sqlite')
+
+BACKENDS = ["neo4j", "sqlite", "memory"]
+
+BATCH_SIZE = 5000 #Rows per write transaction
+
+SOURCE_LABEL_PREFIX = "KB_" #Starts the labels Neo4j gives nodes for their source KB
+
+backends = {}
+'''
+Backends already opened, keyed by name, so all parts of a run
+share one Neo4j driver or one embedded DB.
+'''
+
+## Functions
+def get_backend(name=None, cache=None):
+	'''Returns the graph backend with the given name,
+	or the one set by GRAPH_BACKEND.
+	cache is an optional QueryCache (see tubduck_cache) for
+	Neo4j reads; the embedded backends don't need one. It is
+	attached to the Neo4j backend if that has none yet.
+	Raises ValueError for unknown backends, or for a cache
+	other than the one already attached.'''
+
+	if name is None:
+		name = GRAPH_BACKEND
+	if name not in BACKENDS:
+		raise ValueError("Unknown graph backend %s - use one of %s." % (name, ", ".join(BACKENDS)))
+
+	if name not in backends:
+		if name == "neo4j":
+			backends[name] = Neo4jBackend(cache=cache)
+		elif name == "sqlite":
+			backends[name] = SQLiteBackend(GRAPH_DB_PATH)
+		else:
+			backends[name] = SQLiteBackend(":memory:")
+	elif cache is not None and name == "neo4j":
+		if backends[name].cache is None:
+			backends[name].cache = cache
+		elif backends[name].cache is not cache:
+			raise ValueError("The neo4j backend already has a different query cache.")
+
+	return backends[name]
+
+def source_label(source):
+	'''Returns the Neo4j label for nodes from a source KB.'''
+	return SOURCE_LABEL_PREFIX + source
+
+def is_source_label(label):
+	'''Returns True if a Neo4j label is one for a source KB.'''
+	return label.startswith(SOURCE_LABEL_PREFIX)
+
+def edge_rows(rows):
+	'''Fills in empty properties for edge rows.
+	Each row is a dict with a "source" ID, a "target" ID and
+	optionally a dict of "props".'''
+
+	return [{"source": row["source"], "target": row["target"],
+				"props": row.get("props") or {}} for row in rows]
+
+## Classes
+class GraphBackend:
+	'''Operations every graph backend provides.'''
+
+	name = None
+
+	def available(self):
+		'''Returns True if the graph DB can be reached.'''
+		raise NotImplementedError
+
+	def ensure_index(self, label):
+		'''Makes node IDs unique and indexed for a label.'''
+		raise NotImplementedError
+
+	def ensure_property_index(self, label, prop):
+		'''Indexes a node property for a label, for lookups
+		with find_nodes().'''
+		raise NotImplementedError
+
+	def ensure_fulltext_index(self, label, props):
+		'''Indexes the text of some node properties for a label,
+		where the backend supports full-text search.'''
+		raise NotImplementedError
+
+	def await_indexes(self, timeout):
+		'''Waits up to timeout seconds for new indexes to come online.'''
+		raise NotImplementedError
+
+	def upsert_nodes(self, label, rows, source=None):
+		'''Creates or updates nodes with a label.
+		Each row is a dict of properties, including the "id", and
+		for nodes from a KB, its code as the "source". source is
+		that code, if all rows are from the same KB.
+		Returns the number of rows written.'''
+		raise NotImplementedError
+
+	def upsert_edges(self, rel_type, source_label, target_label, rows, create_nodes=True):
+		'''Creates or updates edges of a type between nodes with
+		the given labels. Rows are as described in edge_rows().
+		If create_nodes is True, missing nodes are created with just
+		an ID; otherwise edges to or from missing nodes are skipped.
+		Returns the number of rows written.'''
+		raise NotImplementedError
+
+	def count_nodes(self, label=None):
+		'''Returns the number of nodes, optionally only with a label.'''
+		raise NotImplementedError
+
+	def count_edges(self, rel_type=None):
+		'''Returns the number of edges, optionally only of a type.'''
+		raise NotImplementedError
+
+	def stats(self):
+		'''Counts nodes and edges without scanning them, where the
+		backend keeps counts.
+		Returns a dict of dicts of counts: "labels", of nodes by label,
+		"types", of edges by type, and "sources", of nodes by source KB.'''
+		raise NotImplementedError
+
+	def find_nodes(self, label, prop, value):
+		'''Returns list of the nodes with a label having a property
+		value, as dicts of properties, in ID order.'''
+		raise NotImplementedError
+
+	def neighbors(self, label, node_id, rel_type=None, direction="out"):
+		'''Returns the nodes linked to a node, as dicts of properties
+		sorted by ID. direction is "out" for edge targets,
+		"in" for edge sources, or "both".'''
+		raise NotImplementedError
+
+	def delete(self, label=None, rel_type=None):
+		'''Deletes part of the graph: edges of rel_type if given,
+		otherwise nodes with label and their edges if given,
+		otherwise everything.'''
+		raise NotImplementedError
+
+	def close(self):
+		pass
+
+class Neo4jBackend(GraphBackend):
+	'''A graph backend using the Neo4j server.
+	Writes are batched UNWIND statements using MERGE on node IDs.
+	Every write or delete increases the graph generation, so cached
+	reads from before it are no longer used.'''
+
+	name = "neo4j"
+
+	def __init__(self, cache=None):
+		self.driver = None
+		self.cache = cache
+
+	def get_driver(self):
+		if self.driver is None:
+			self.driver = GraphDatabase.driver(NEO4J_URI, auth=(NEO4J_USER, NEO4J_PASSWORD),
+												encrypted=False)
+		return self.driver
+
+	def available(self):
+		self.get_driver()
+		return True
+
+	def read(self, statement, **params):
+		'''Runs a read query, through the cache if there is one.
+		Returns a list of dicts.'''
+
+		with self.get_driver().session() as session:
+			if self.cache is not None:
+				return self.cache.run(session, statement, params)
+			return session.run(statement, params).data()
+
+	def write(self, statement, rows):
+		'''Runs an UNWIND statement on rows, BATCH_SIZE per transaction.'''
+
+		def run_batch(tx, batch):
+			tx.run(statement, rows=batch)
+
+		with self.get_driver().session() as session:
+			for i in range(0, len(rows), BATCH_SIZE):
+				with tmetrics.transaction():
+					session.write_transaction(run_batch, rows[i:i+BATCH_SIZE])
+		tcache.bump_generation()
+
+		return len(rows)
+
+	def run_schema(self, statement, **params):
+		'''Runs a schema statement. It's fine if what it creates
+		already exists: schema commands report that with an
+		*AlreadyExists code, and procedures with a failed call
+		saying so.'''
+
+		with self.get_driver().session() as session:
+			try:
+				session.run(statement, params).consume()
+			except neobolt.exceptions.ClientError as e:
+				code = str(getattr(e, "code", ""))
+				if "AlreadyExists" in code:
+					return
+				if code.endswith("ProcedureCallFailed") and "already exists" in str(e).lower():
+					return
+				print("\nSetting up constraints and encountered error: %s" % e)
+
+	def index_names(self):
+		'''Returns the set of names of the indexes in the graph DB.
+		Read without the cache, as new indexes don't change the
+		graph generation.'''
+
+		with self.get_driver().session() as session:
+			records = session.run("CALL db.indexes()").data()
+		#Neo4j 3.5 calls it indexName, later versions name
+		return {record.get("indexName", record.get("name")) for record in records}
+
+	def ensure_index(self, label):
+		self.run_schema("CREATE CONSTRAINT ON (a:%s) ASSERT a.id IS UNIQUE" % label)
+
+	def ensure_property_index(self, label, prop):
+		self.run_schema("CREATE INDEX ON :%s(%s)" % (label, prop))
+
+	def ensure_fulltext_index(self, label, props):
+		if label + "_text" in self.index_names(): #Creating it again fails
+			return
+		self.run_schema("CALL db.index.fulltext.createNodeIndex($name, [$label], $props)",
+						name=label + "_text", label=label, props=props)
+
+	def await_indexes(self, timeout):
+		with self.get_driver().session() as session:
+			session.run("CALL db.awaitIndexes($timeout)", timeout=timeout).consume()
+
+	def upsert_nodes(self, label, rows, source=None):
+		add_label = ", a:%s" % source_label(source) if source else ""
+		return self.write("UNWIND $rows AS row "
+							"MERGE (a:%s {id: row.id}) "
+							"ON CREATE SET a.creationDate = date() "
+							"SET a += row%s" % (label, add_label), rows)
+
+	def upsert_edges(self, rel_type, source_label, target_label, rows, create_nodes=True):
+		if create_nodes:
+			find = "MERGE (a:%s {id: row.source}) MERGE (b:%s {id: row.target}) "
+		else:
+			find = "MATCH (a:%s {id: row.source}) MATCH (b:%s {id: row.target}) "
+		return self.write("UNWIND $rows AS row " + find % (source_label, target_label) +
+							"MERGE (a)-[r:%s]->(b) "
+							"ON CREATE SET r.creationDate = date() "
+							"SET r += row.props" % rel_type, edge_rows(rows))
+
+	def count_nodes(self, label=None):
+		pattern = "(a:%s)" % label if label else "(a)"
+		return self.read("MATCH %s RETURN count(a) AS count" % pattern)[0]["count"]
+
+	def count_edges(self, rel_type=None):
+		pattern = "[r:%s]" % rel_type if rel_type else "[r]"
+		return self.read("MATCH ()-%s->() RETURN count(r) AS count" % pattern)[0]["count"]
+
+	def stats(self):
+		#Counts of all nodes with a label, or all edges of a type,
+		#come from the count store
+		counts = {"labels": {}, "types": {}, "sources": {}}
+		for row in self.read("CALL db.labels() YIELD label RETURN label"):
+			label = row["label"]
+			count = self.count_nodes(label)
+			if is_source_label(label):
+				counts["sources"][label[len(SOURCE_LABEL_PREFIX):]] = count
+			else:
+				counts["labels"][label] = count
+		for row in self.read("CALL db.relationshipTypes() YIELD relationshipType "
+								"RETURN relationshipType"):
+			counts["types"][row["relationshipType"]] = self.count_edges(row["relationshipType"])
+		return counts
+
+	def find_nodes(self, label, prop, value):
+		rows = self.read("MATCH (a:%s) WHERE a.%s = $value RETURN a ORDER BY a.id" % (label, prop),
+							value=value)
+		return [row["a"] for row in rows]
+
+	def neighbors(self, label, node_id, rel_type=None, direction="out"):
+		edge = "[r:%s]" % rel_type if rel_type else "[r]"
+		if direction == "out":
+			pattern = "(a:%s {id: $id})-%s->(b)"
+		elif direction == "in":
+			pattern = "(a:%s {id: $id})<-%s-(b)"
+		else:
+			pattern = "(a:%s {id: $id})-%s-(b)"
+		rows = self.read(("MATCH " + pattern + " RETURN DISTINCT b ORDER BY b.id") % (label, edge),
+							id=node_id)
+		return [row["b"] for row in rows]
+
+	def delete(self, label=None, rel_type=None):
+		with self.get_driver().session() as session:
+			if rel_type:
+				session.run("MATCH ()-[r:%s]->() DELETE r" % rel_type)
+			elif label:
+				session.run("MATCH (n:%s) DETACH DELETE n" % label)
+			else:
+				session.run("MATCH ()-[r]-() DELETE r")
+				session.run("MATCH (n) DELETE n ")
+		tcache.bump_generation()
+
+	def close(self):
+		if self.driver is not None:
+			self.driver.close()
+			self.driver = None
+
+class SQLiteBackend(GraphBackend):
+	'''An embedded graph backend using SQLite, in a file or in memory
+	(with the path ":memory:"). Properties are stored as JSON.'''
+
+	name = "sqlite"
+
+	def __init__(self, path):
+		self.path = path
+		self.dbcon = None
+		if path == ":memory:":
+			self.name = "memory"
+
+	def connect(self):
+		if self.dbcon is None:
+			if self.path != ":memory:":
+				Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+			self.dbcon = sqlite3.connect(str(self.path), check_same_thread=False)
+			if self.path != ":memory:":
+				self.dbcon.execute("PRAGMA journal_mode=WAL")
+			self.dbcon.execute("""CREATE TABLE IF NOT EXISTS nodes (
+								label text,
+								id text,
+								created text,
+								props text,
+								PRIMARY KEY (label, id))""")
+			self.dbcon.execute("""CREATE TABLE IF NOT EXISTS edges (
+								type text,
+								source_label text,
+								source text,
+								target_label text,
+								target text,
+								created text,
+								props text,
+								PRIMARY KEY (source_label, source, type, target_label, target))""")
+			self.dbcon.execute("""CREATE INDEX IF NOT EXISTS edges_target
+								ON edges (target_label, target)""")
+			self.dbcon.commit()
+		return self.dbcon
+
+	def available(self):
+		self.connect()
+		return True
+
+	def ensure_index(self, label):
+		pass #Node IDs are part of the primary key
+
+	def ensure_property_index(self, label, prop):
+		#One index per property serves all labels
+		dbcon = self.connect()
+		with dbcon:
+			dbcon.execute("CREATE INDEX IF NOT EXISTS \"nodes_%s\" "
+							"ON nodes (label, json_extract(props, '$.%s'))" % (prop, prop))
+
+	def ensure_fulltext_index(self, label, props):
+		pass #Not supported; text is only searched in Neo4j
+
+	def await_indexes(self, timeout):
+		pass #SQLite indexes are built as they are created
+
+	def upsert_nodes(self, label, rows, source=None):
+		dbcon = self.connect() #Sources are only kept in the rows
+		today = date.today().isoformat()
+		with tmetrics.transaction(), dbcon:
+			dbcon.executemany("""INSERT INTO nodes VALUES (?, ?, ?, ?)
+								ON CONFLICT (label, id) DO UPDATE
+								SET props = json_patch(props, excluded.props)""",
+								((label, row["id"], today, json.dumps(row, default=str))
+									for row in rows))
+		return len(rows)
+
+	def upsert_edges(self, rel_type, source_label, target_label, rows, create_nodes=True):
+		dbcon = self.connect()
+		today = date.today().isoformat()
+		rows = edge_rows(rows)
+		with tmetrics.transaction(), dbcon:
+			if create_nodes:
+				dbcon.executemany("INSERT OR IGNORE INTO nodes VALUES (?, ?, ?, ?)",
+									((label, node_id, today, json.dumps({"id": node_id}))
+										for row in rows
+										for label, node_id in [(source_label, row["source"]),
+																(target_label, row["target"])]))
+			else:
+				rows = [row for row in rows if
+						dbcon.execute("SELECT 1 FROM nodes WHERE label = ? AND id = ?",
+										(source_label, row["source"])).fetchone() and
+						dbcon.execute("SELECT 1 FROM nodes WHERE label = ? AND id = ?",
+										(target_label, row["target"])).fetchone()]
+			dbcon.executemany("""INSERT INTO edges VALUES (?, ?, ?, ?, ?, ?, ?)
+								ON CONFLICT (source_label, source, type, target_label, target)
+								DO UPDATE SET props = json_patch(props, excluded.props)""",
+								((rel_type, source_label, row["source"], target_label,
+									row["target"], today, json.dumps(row["props"], default=str))
+									for row in rows))
+		return len(rows)
+
+	def count_nodes(self, label=None):
+		if label:
+			query = ("SELECT count(*) FROM nodes WHERE label = ?", (label,))
+		else:
+			query = ("SELECT count(*) FROM nodes", ())
+		return self.connect().execute(*query).fetchone()[0]
+
+	def count_edges(self, rel_type=None):
+		if rel_type:
+			query = ("SELECT count(*) FROM edges WHERE type = ?", (rel_type,))
+		else:
+			query = ("SELECT count(*) FROM edges", ())
+		return self.connect().execute(*query).fetchone()[0]
+
+	def stats(self):
+		#SQLite keeps no counts, so these are scans, of the primary
+		#key for labels
+		dbcon = self.connect()
+		return {"labels": dict(dbcon.execute("SELECT label, count(*) FROM nodes GROUP BY label")),
+				"types": dict(dbcon.execute("SELECT type, count(*) FROM edges GROUP BY type")),
+				"sources": dict(dbcon.execute("SELECT json_extract(props, '$.source') AS source, "
+												"count(*) FROM nodes WHERE source IS NOT NULL "
+												"GROUP BY source"))}
+
+	def find_nodes(self, label, prop, value):
+		#Matches the expression indexed by ensure_property_index()
+		rows = self.connect().execute("SELECT id, created, props FROM nodes "
+										"WHERE label = ? AND json_extract(props, '$.%s') = ? "
+										"ORDER BY id" % prop, (label, value))
+		found = []
+		for found_id, created, props in rows:
+			node = json.loads(props)
+			node["creationDate"] = created
+			found.append(node)
+		return found
+
+	def neighbors(self, label, node_id, rel_type=None, direction="out"):
+		dbcon = self.connect()
+		type_filter = " AND e.type = ?" if rel_type else ""
+		type_param = (rel_type,) if rel_type else ()
+
+		queries = []
+		if direction in ["out", "both"]:
+			queries.append(("SELECT n.id, n.created, n.props FROM edges e JOIN nodes n "
+							"ON n.label = e.target_label AND n.id = e.target "
+							"WHERE e.source_label = ? AND e.source = ?" + type_filter,
+							(label, node_id) + type_param))
+		if direction in ["in", "both"]:
+			queries.append(("SELECT n.id, n.created, n.props FROM edges e JOIN nodes n "
+							"ON n.label = e.source_label AND n.id = e.source "
+							"WHERE e.target_label = ? AND e.target = ?" + type_filter,
+							(label, node_id) + type_param))
+
+		found = {}
+		for query, params in queries:
+			for found_id, created, props in dbcon.execute(query, params):
+				node = json.loads(props)
+				node["creationDate"] = created
+				found[found_id] = node
+
+		return [found[found_id] for found_id in sorted(found)]
+
+	def delete(self, label=None, rel_type=None):
+		dbcon = self.connect()
+		with dbcon:
+			if rel_type:
+				dbcon.execute("DELETE FROM edges WHERE type = ?", (rel_type,))
+			elif label:
+				dbcon.execute("DELETE FROM edges WHERE source_label = ? OR target_label = ?",
+								(label, label))
+				dbcon.execute("DELETE FROM nodes WHERE label = ?", (label,))
+			else:
+				dbcon.execute("DELETE FROM edges")
+				dbcon.execute("DELETE FROM nodes")
+
+	def close(self):
+		if self.dbcon is not None:
+			self.dbcon.close()
+			self.dbcon = None
@@ -9,7 +9,12 @@ or in MEDLINE format, in their respective directories within the "input"
 directory. They are then stored in an SQLite database.
 '''
 
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
+import gzip
+import hashlib
+import mmap
+import os
 from pathlib import Path
 from tqdm import *
 import urllib
@@ -18,30 +23,422 @@ from urllib.request import urlopen
 
 import sqlite3
 
-from Bio import Medline
+import tubduck_docs as tdocs
+import tubduck_metrics as tmetrics
 
 ## Constants
 INPUT_PATH = Path('../input')
 MEDLINE_PATH = Path('../input/medline')
 RAW_PATH = Path('../input/raw')
+PUBMED_PATH = Path('../input/pubmed')
 DB_PATH = Path('../input/db.sqlite')
 
+RAW_BATCH_SIZE = 500 #Raw documents inserted per transaction
+PUBMED_BATCH_SIZE = 2000 #PubMed XML articles inserted per transaction
+
+PUBMED_FIELDS = ["PMID", "OWN", "STAT", "DCOM", "LR", "IP", "VI", "DP", 
+					"TI", "PG", "LID", "AB", "FAU", "AU", "AD", "CN", 
+					"LA", "PT", "PL", "TA", "JT", "JID", "RN", "SB", 
+					"MH", "OT", "AID", "PMC"]
+'''
+MEDLINE fields filled in from PubMed XML,
+in the order they are inserted.
+'''
+
 ## Functions
 def get_local_docs():
 	'''Retrieve locally stored documents.
 	These may be in MEDLINE format or raw format.
-	In MEDLINE format, a file may contain >1 document.'''
+	In MEDLINE format, a file may contain >1 document.
+	PubMed XML files (e.g., the annual baseline) may be gzipped.'''
 	
 	doc_file_index = {}
 	
 	medline_file_list = [x for x in MEDLINE_PATH.iterdir()]
-	raw_file_list  = [x for x in RAW_PATH.iterdir()]
+	raw_file_list  = [Path(entry.path) for entry in scan_raw_docs(RAW_PATH)]
+	pubmed_file_list = sorted(x for x in PUBMED_PATH.iterdir()
+								if x.name.endswith((".xml", ".xml.gz")))
 	
 	doc_file_index["medline"] = medline_file_list
 	doc_file_index["raw"] = raw_file_list
+	doc_file_index["pubmed"] = pubmed_file_list
 	
 	return doc_file_index
-	
+
+def scan_raw_docs(path):
+	'''Yields a DirEntry for each raw document file under the given
+	Path, descending into subdirectories.
+	Uses os.scandir so large directories are streamed rather than
+	listed all at once. Hidden files are skipped.'''
+
+	with os.scandir(path) as entries:
+		for entry in entries:
+			if entry.name.startswith("."):
+				continue
+			if entry.is_dir(follow_symlinks=False):
+				yield from scan_raw_docs(entry.path)
+			elif entry.is_file():
+				yield entry
+
+def hash_raw_doc(doc_file_path):
+	'''Reads a raw document through a memory map.
+	Returns a tuple of its SHA-1 hex digest and its contents as bytes.
+	Empty files can't be mapped, so they are handled directly.'''
+
+	with open(doc_file_path, "rb") as raw_doc:
+		if os.fstat(raw_doc.fileno()).st_size == 0:
+			return (hashlib.sha1(b"").hexdigest(), b"")
+		with mmap.mmap(raw_doc.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+			digest = hashlib.sha1(mapped).hexdigest()
+			contents = mapped[:]
+
+	return (digest, contents)
+
+def load_raw_docs(dbcon, doc_file_paths):
+	'''Loads raw (text only) documents into the input database.
+	Takes a database connection and an iterable of Paths.
+	Each document's ID is derived from the hash of its contents,
+	so the same text always receives the same ID. Files with the same
+	size and modification time as on a previous run are skipped
+	without being read, and files with contents matching an already
+	stored document are not stored again. When a file's contents
+	change, the document stored for its old contents is removed,
+	unless another file still has them.
+	Returns a dict of counts.'''
+
+	cur = dbcon.cursor()
+
+	counts = {"new": 0, "unchanged": 0, "duplicate": 0, "replaced": 0}
+	doc_rows = []
+	file_rows = []
+	stale_rows = []
+
+	doc_sql = """INSERT OR IGNORE INTO documents(id, FN, TXT, HASH)
+				VALUES(?, ?, ?, ?)"""
+	file_sql = """INSERT OR REPLACE INTO raw_files(path, size, mtime, hash)
+				VALUES(?, ?, ?, ?)"""
+	stale_sql = """DELETE FROM documents WHERE HASH = ? AND NOT EXISTS
+				(SELECT 1 FROM raw_files WHERE hash = ? AND path != ?)"""
+
+	def write_batch():
+		with tmetrics.transaction():
+			cur.executemany(stale_sql, stale_rows) #Before their files' new rows
+			before = dbcon.total_changes
+			cur.executemany(doc_sql, doc_rows)
+			added = dbcon.total_changes - before
+			cur.executemany(file_sql, file_rows)
+			dbcon.commit()
+		counts["new"] = counts["new"] + added
+		counts["duplicate"] = counts["duplicate"] + len(doc_rows) - added
+		doc_rows.clear()
+		file_rows.clear()
+		stale_rows.clear()
+
+	pbar = tqdm(unit="documents")
+	for doc_file_path in doc_file_paths:
+		filepath = str(doc_file_path)
+		stat = os.stat(filepath)
+
+		cur.execute("SELECT size, mtime, hash FROM raw_files WHERE path = ?", (filepath,))
+		previous = cur.fetchone()
+		if previous is not None and previous[:2] == (stat.st_size, stat.st_mtime_ns):
+			counts["unchanged"] = counts["unchanged"] + 1
+			pbar.update(1)
+			continue
+
+		digest, contents = hash_raw_doc(filepath)
+		if previous is not None and previous[2] != digest:
+			stale_rows.append((previous[2], previous[2], filepath))
+			counts["replaced"] = counts["replaced"] + 1
+		doc_id = int(digest[:15], 16) #60 bits of the hash fits an SQLite integer
+		text = contents.decode("utf-8", errors="replace")
+
+		doc_rows.append((doc_id, Path(filepath).stem, text, digest))
+		file_rows.append((filepath, stat.st_size, stat.st_mtime_ns, digest))
+		if len(doc_rows) == RAW_BATCH_SIZE:
+			write_batch()
+		pbar.update(1)
+
+	if len(doc_rows) > 0:
+		write_batch()
+	pbar.close()
+
+	print("Raw documents: %s new, %s unchanged, %s duplicate, %s changed." %
+			(counts["new"], counts["unchanged"], counts["duplicate"], counts["replaced"]))
+
+	return counts
+
+def pubmed_date(element):
+	'''Formats a PubMed XML date element as in MEDLINE,
+	e.g., 20190314 for DCOM or "2019 Mar 14" for DP.
+	Returns an empty string if the element is missing.'''
+
+	if element is None:
+		return ""
+
+	medline_date = element.findtext("MedlineDate")
+	if medline_date:
+		return medline_date
+
+	parts = [element.findtext(part) for part in ["Year", "Month", "Day"]]
+	parts = [part for part in parts if part]
+	if element.tag in ["DateCompleted", "DateRevised"]:
+		return "".join(parts)
+	return " ".join(parts)
+
+def parse_pubmed_article(article):
+	'''Maps one PubmedArticle XML element onto MEDLINE field codes,
+	so XML records share the documents table with MEDLINE text records.
+	Lists are flattened with "|" as in parse_docs.
+	Returns a dict.'''
+
+	record = {}
+	citation = article.find("MedlineCitation")
+	journal_article = citation.find("Article")
+	journal = journal_article.find("Journal")
+	journal_info = citation.find("MedlineJournalInfo")
+
+	def text_of(element):
+		if element is None:
+			return ""
+		return "".join(element.itertext()).strip()
+
+	record["PMID"] = citation.findtext("PMID")
+	record["OWN"] = citation.get("Owner")
+	record["STAT"] = citation.get("Status")
+	record["DCOM"] = pubmed_date(citation.find("DateCompleted"))
+	record["LR"] = pubmed_date(citation.find("DateRevised"))
+
+	record["IP"] = journal.findtext("JournalIssue/Issue")
+	record["VI"] = journal.findtext("JournalIssue/Volume")
+	record["DP"] = pubmed_date(journal.find("JournalIssue/PubDate"))
+	record["JT"] = journal.findtext("Title")
+
+	record["TI"] = text_of(journal_article.find("ArticleTitle"))
+	record["PG"] = journal_article.findtext("Pagination/MedlinePgn")
+	record["LID"] = "|".join("%s [%s]" % (text_of(loc), loc.get("EIdType"))
+								for loc in journal_article.iterfind("ELocationID"))
+
+	abstract = []
+	for abstract_text in journal_article.iterfind("Abstract/AbstractText"):
+		label = abstract_text.get("Label")
+		if label:
+			abstract.append("%s: %s" % (label, text_of(abstract_text)))
+		else:
+			abstract.append(text_of(abstract_text))
+	record["AB"] = " ".join(abstract)
+
+	full_names = []
+	short_names = []
+	affiliations = []
+	collective_names = []
+	for author in journal_article.iterfind("AuthorList/Author"):
+		collective = author.findtext("CollectiveName")
+		if collective:
+			collective_names.append(collective)
+			continue
+		last_name = author.findtext("LastName", "")
+		full_names.append("%s, %s" % (last_name, author.findtext("ForeName", "")))
+		short_names.append("%s %s" % (last_name, author.findtext("Initials", "")))
+		for affiliation in author.iterfind("AffiliationInfo/Affiliation"):
+			affiliations.append(text_of(affiliation))
+	record["FAU"] = "|".join(full_names)
+	record["AU"] = "|".join(short_names)
+	record["AD"] = "|".join(affiliations)
+	record["CN"] = "|".join(collective_names)
+
+	record["LA"] = "|".join(lang.text for lang in journal_article.iterfind("Language"))
+	record["PT"] = "|".join(text_of(pubtype) for pubtype in
+							journal_article.iterfind("PublicationTypeList/PublicationType"))
+
+	if journal_info is not None:
+		record["PL"] = journal_info.findtext("Country")
+		record["TA"] = journal_info.findtext("MedlineTA")
+		record["JID"] = journal_info.findtext("NlmUniqueID")
+
+	chemicals = []
+	for chemical in citation.iterfind("ChemicalList/Chemical"):
+		chemicals.append("%s (%s)" % (chemical.findtext("RegistryNumber"),
+										chemical.findtext("NameOfSubstance")))
+	record["RN"] = "|".join(chemicals)
+	record["SB"] = "|".join(subset.text for subset in citation.iterfind("CitationSubset"))
+
+	#MeSH headings follow the MEDLINE convention of
+	#Descriptor/qualifier, with * marking major topics
+	headings = []
+	for heading in citation.iterfind("MeshHeadingList/MeshHeading"):
+		descriptor = heading.find("DescriptorName")
+		parts = [descriptor.text]
+		if descriptor.get("MajorTopicYN") == "Y":
+			parts[0] = "*" + parts[0]
+		for qualifier in heading.iterfind("QualifierName"):
+			if qualifier.get("MajorTopicYN") == "Y":
+				parts.append("*" + qualifier.text)
+			else:
+				parts.append(qualifier.text)
+		headings.append("/".join(parts))
+	record["MH"] = "|".join(headings)
+
+	record["OT"] = "|".join(text_of(keyword) for keyword in
+							citation.iterfind("KeywordList/Keyword"))
+
+	article_ids = []
+	for article_id in article.iterfind("PubmedData/ArticleIdList/ArticleId"):
+		id_type = article_id.get("IdType")
+		article_ids.append("%s [%s]" % (article_id.text, id_type))
+		if id_type == "pmc":
+			record["PMC"] = article_id.text
+	record["AID"] = "|".join(article_ids)
+
+	#Empty strings are stored as NULL, as with missing MEDLINE fields
+	for field in record:
+		if record[field] == "":
+			record[field] = None
+
+	return record
+
+def stage_pubmed_file(filepath, staging_path):
+	'''Parses one PubMed XML file, such as a baseline or update file,
+	into a staging database of its own at staging_path, to be applied
+	to the input database later (see apply_staged_file()).
+	Gzipped files are decompressed as a stream and parsed with
+	iterparse, clearing each article once it has been read, so memory
+	use doesn't grow with file size. Each article and each PMID in a
+	DeleteCitation entry is staged as an operation, numbered in the
+	order it appears in the file.
+	Runs in its own process, so several files may be parsed at once.
+	Raises ValueError if the XML can't be parsed.
+	Returns the Path of the staging database.'''
+
+	from lxml import etree #Only needed for PubMed XML, so imported here
+
+	columns = ", ".join(PUBMED_FIELDS)
+	placeholders = ", ".join(["?"] * len(PUBMED_FIELDS))
+	insert_sql = "INSERT INTO ops(op, %s) VALUES('insert', %s)" % (columns, placeholders)
+	delete_sql = "INSERT INTO ops(op, PMID) VALUES('delete', ?)"
+
+	staging_path = Path(staging_path)
+	if staging_path.exists():
+		staging_path.unlink()
+	dbcon = sqlite3.connect(str(staging_path))
+	cur = dbcon.cursor()
+	cur.execute("CREATE TABLE ops (seq integer PRIMARY KEY, op text, %s)"
+				% ", ".join("%s text" % field for field in PUBMED_FIELDS))
+
+	rows = []
+
+	if str(filepath).endswith(".gz"):
+		stream = gzip.open(filepath, "rb")
+	else:
+		stream = open(filepath, "rb")
+
+	try:
+		with stream:
+			for event, element in etree.iterparse(stream, events=("end",),
+											tag=("PubmedArticle", "DeleteCitation")):
+				if element.tag == "PubmedArticle":
+					record = parse_pubmed_article(element)
+					rows.append(tuple(record.get(field) for field in PUBMED_FIELDS))
+				else: #Stage anything pending first, to keep the file's order
+					cur.executemany(insert_sql, rows)
+					rows = []
+					cur.executemany(delete_sql, [(pmid.text,) for pmid in element.iterfind("PMID")])
+
+				#Drop the finished element and anything before it
+				element.clear()
+				while element.getprevious() is not None:
+					del element.getparent()[0]
+
+				if len(rows) == PUBMED_BATCH_SIZE:
+					cur.executemany(insert_sql, rows)
+					rows = []
+
+		cur.executemany(insert_sql, rows)
+		cur.execute("CREATE INDEX ops_pmid ON ops(PMID, seq)")
+		dbcon.commit()
+	except etree.XMLSyntaxError as e: #Can't be passed back from a process
+		raise ValueError(str(e))
+	finally:
+		dbcon.close()
+
+	return staging_path
+
+def apply_staged_file(dbcon, staging_path):
+	'''Applies a staging database from stage_pubmed_file() to the
+	input database, in one transaction. Only the last operation
+	staged for each PMID counts: a newer version of an article
+	replaces an older one, and a DeleteCitation entry removes it.
+	Returns a dict of counts.'''
+
+	columns = ", ".join(PUBMED_FIELDS)
+	latest = "SELECT max(seq) FROM staged.ops GROUP BY PMID"
+
+	counts = {"articles": 0, "deleted": 0}
+
+	dbcon.execute("ATTACH DATABASE ? AS staged", (str(staging_path),))
+	try:
+		with tmetrics.transaction(), dbcon:
+			cur = dbcon.execute("""DELETE FROM documents WHERE PMID IN
+								(SELECT PMID FROM staged.ops
+								WHERE op = 'delete' AND seq IN (%s))""" % latest)
+			counts["deleted"] = cur.rowcount
+			cur = dbcon.execute("""INSERT OR REPLACE INTO documents(%s)
+								SELECT %s FROM staged.ops
+								WHERE op = 'insert' AND seq IN (%s)
+								ORDER BY seq""" % (columns, columns, latest))
+			counts["articles"] = cur.rowcount
+	finally:
+		dbcon.execute("DETACH DATABASE staged")
+
+	return counts
+
+def load_pubmed_files(filepaths, db_path=DB_PATH, workers=None):
+	'''Loads a list of PubMed XML files into the input database.
+	Files are parsed in parallel processes, one file per process;
+	workers sets the number of processes (default is one per CPU).
+	Parsed files are then applied from this process alone, in
+	filename order (the baseline files, then each update in turn),
+	so the outcome doesn't depend on which file is parsed first.
+	Returns a dict of total counts.'''
+
+	totals = {"articles": 0, "deleted": 0}
+
+	filepaths = sorted(filepaths, key=lambda filepath: Path(filepath).name)
+	staging_dir = Path(db_path).parent / "pubmed-staging"
+	staging_dir.mkdir(parents=True, exist_ok=True)
+
+	print("Loading %s PubMed XML file(s)." % len(filepaths))
+	dbcon = input_db_connect(db_path)
+	pbar = tqdm(unit=" files", total=len(filepaths))
+	with ProcessPoolExecutor(max_workers=workers) as executor:
+		futures = [executor.submit(stage_pubmed_file, filepath,
+									staging_dir / (Path(filepath).name + ".sqlite"))
+					for filepath in filepaths]
+		for filepath, future in zip(filepaths, futures): #Waits for each in turn
+			staging_path = staging_dir / (Path(filepath).name + ".sqlite")
+			try:
+				future.result()
+				counts = apply_staged_file(dbcon, staging_path)
+				totals["articles"] = totals["articles"] + counts["articles"]
+				totals["deleted"] = totals["deleted"] + counts["deleted"]
+			except (ValueError, OSError, sqlite3.Error) as e:
+				print("Encountered an error while loading %s: %s" % (filepath, e))
+			finally:
+				if staging_path.exists():
+					staging_path.unlink()
+			pbar.update(1)
+	pbar.close()
+	dbcon.close()
+	try:
+		staging_dir.rmdir()
+	except OSError: #Not empty, e.g., if another load is using it
+		pass
+
+	print("Loaded %s PubMed articles and removed %s." %
+			(totals["articles"], totals["deleted"]))
+
+	return totals
+
 def get_remote_docs(pmids):
 	'''Retrieve documents from PubMed, given one or more PMIDs.
 	Input is a list. Returns a dict.'''
@@ -113,74 +510,86 @@ def get_remote_docs(pmids):
 
 def parse_docs(doc_file_index):
 	'''Parses input documents. This varies based on their filetype,
-	which may be 'medline' or 'raw'. In the first case, each entry is
+	which may be 'medline', 'pubmed' (XML) or 'raw'. In the first case, each entry is
 	named based on its PMID and populated with MEDLINE format fields.
-	For raw documents, they will be identified based on their filenames.
+	Raw documents are identified by a hash of their contents, with their
+	filenames stored alongside.
 	Takes a dictionary as input, as produced by the get_local_docs()
 	method. Loads contents into input database.'''
 	
+	from Bio import Medline #Slow to import, and only needed here
+	
 	dbcon = input_db_connect()
 	cur = dbcon.cursor()
 	
-	doc_id = 0
-	
 	for filetype in doc_file_index:
-		if filetype == "medline": #Need to parse further
-			for doc_file_path in doc_file_index[filetype]:
-				with open(doc_file_path) as handle:
-					pbar = tqdm(unit="documents")
-					records = Medline.parse(handle)
-					for record in records:
-						
-						record["id"] = doc_id
-						if "IS" in record.keys(): #Incompatible with SQL
-							del record["IS"]
-						
-						newrecord = {} #Need to flatten some lists
-						for datatype in record:
-							if type(record[datatype]) is list:
-								newrecord[datatype] = "|".join(record[datatype])
-							else:
-								newrecord[datatype] = record[datatype]
-						record = newrecord
-						
-						columns = ', '.join(record.keys())
-						placeholders = ':'+', :'.join(record.keys())
-						sql = """INSERT INTO documents(%s)
-									VALUES(%s)""" % (columns, placeholders)
-									
-						try:
-							cur.execute(sql, record)
-							dbcon.commit()
-							pbar.update(1)
-						except sqlite3.OperationalError as e:
-							print(e)
-							pass		#Note this will NOT load the entry
-						except sqlite3.IntegrityError as e:
-							print("%s - document with PMID %s already stored" % (e, record["PMID"]))
-						
-						doc_id = doc_id +1
-				pbar.close()
-				
-		# if filetype == "raw": #Not much to parse yet
-			# for doc_file_path in doc_file_index[filetype]:
-				# filename = doc_file_path.stem
-				# parsed_docs[filename] = {}
-				# parsed_docs[filename]['text'] = []
-				# with open(doc_file_path) as raw_doc:
-					# for line in raw_doc:
-						# parsed_docs[filename]['text'].append(line)
-				# doc_id = doc_id +1
+		if len(doc_file_index[filetype]) == 0:
+			continue
+		with tmetrics.stage("ingest_docs", filetype=filetype):
+			if filetype == "medline": #Need to parse further
+				for doc_file_path in doc_file_index[filetype]:
+					with open(doc_file_path) as handle:
+						pbar = tqdm(unit="documents")
+						records = Medline.parse(handle)
+						for record in records:
+							
+							#SQLite assigns the id, as other filetypes share the table
+							if "IS" in record.keys(): #Incompatible with SQL
+								del record["IS"]
+							
+							newrecord = {} #Need to flatten some lists
+							for datatype in record:
+								if type(record[datatype]) is list:
+									newrecord[datatype] = "|".join(record[datatype])
+								else:
+									newrecord[datatype] = record[datatype]
+							record = newrecord
+							
+							columns = ', '.join(record.keys())
+							placeholders = ':'+', :'.join(record.keys())
+							sql = """INSERT INTO documents(%s)
+										VALUES(%s)""" % (columns, placeholders)
+										
+							try:
+								with tmetrics.transaction():
+									cur.execute(sql, record)
+									dbcon.commit()
+								pbar.update(1)
+								tmetrics.add(records_out=1)
+							except sqlite3.OperationalError as e:
+								print(e)
+								pass		#Note this will NOT load the entry
+							except sqlite3.IntegrityError as e:
+								print("%s - document with PMID %s already stored" % (e, record["PMID"]))
+							
+							tmetrics.add(records_in=1)
+					pbar.close()
+					
+			if filetype == "raw": #Not much to parse yet
+				counts = load_raw_docs(dbcon, doc_file_index[filetype])
+				tmetrics.add(records_in=counts["new"] + counts["unchanged"] + counts["duplicate"],
+								records_out=counts["new"])
+			
+			if filetype == "pubmed":
+				counts = load_pubmed_files(doc_file_index[filetype])
+				tmetrics.add(records_in=counts["articles"] + counts["deleted"],
+								records_out=counts["articles"])
+	
+	dbcon.close()
 	
-	cur.execute("SELECT COUNT(*) FROM documents")
-	print("Loaded %s documents." % list(cur)[0][0])
-	cur.execute("SELECT * FROM documents")
-	sample = cur.fetchmany(2)
-	print([description[0] for description in cur.description])
+	print("Loaded %s documents." % tdocs.count_docs(db_path=DB_PATH))
+	sample = next(tdocs.iter_doc_batches(["id", "PMID", "FN", "TI"], batch_size=2, 
+											db_path=DB_PATH), [])
 	print(sample)
 	
 def input_db_connect(db_path=DB_PATH):
-	dbcon = sqlite3.connect(DB_PATH)
+	'''Opens a writable connection to the input database.
+	Uses WAL journaling so readers (see tubduck_docs) aren't blocked
+	while documents are being loaded.
+	Returns the connection.'''
+	
+	dbcon = sqlite3.connect(str(db_path), timeout=60)
+	dbcon.execute("PRAGMA journal_mode=WAL")
 	return dbcon
 	
 def setup():
@@ -188,9 +597,10 @@ def setup():
 	INPUT_PATH.mkdir(exist_ok=True)
 	MEDLINE_PATH.mkdir(exist_ok=True)
 	RAW_PATH.mkdir(exist_ok=True)
+	PUBMED_PATH.mkdir(exist_ok=True)
 	
 	'''Setup document database. Defines most fields upon initial parsing.'''
-	dbcon = sqlite3.connect(DB_PATH)
+	dbcon = input_db_connect(DB_PATH)
 	cur = dbcon.cursor()
 	setup_sql = """CREATE TABLE IF NOT EXISTS documents (
 				id integer PRIMARY KEY,
@@ -254,5 +664,24 @@ def setup():
 				TA text,
 				TI text,
 				TT text,
-				VI text)"""
+				VI text,
+				FN text,
+				TXT text,
+				HASH text)"""
 	cur.execute(setup_sql)
+	
+	#Raw document columns were added later, so older databases need them
+	doc_columns = [row[1] for row in cur.execute("PRAGMA table_info(documents)")]
+	for column in ["FN", "TXT", "HASH"]:
+		if column not in doc_columns:
+			cur.execute("ALTER TABLE documents ADD COLUMN %s text" % column)
+	cur.execute("CREATE UNIQUE INDEX IF NOT EXISTS documents_hash ON documents(HASH)")
+	
+	#Raw files seen on previous runs, so unchanged files aren't re-read
+	cur.execute("""CREATE TABLE IF NOT EXISTS raw_files (
+				path text PRIMARY KEY,
+				size integer,
+				mtime integer,
+				hash text)""")
+	dbcon.commit()
+
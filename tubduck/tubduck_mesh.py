@@ -0,0 +1,174 @@
+#!/usr/bin/python
+#tubduck_mesh.py
+'''
+MeSH parsing for TUBDUCK.
+
+Reads MeSH descriptors from the ASCII release (d20XX.bin) record by
+record, as a stream. Each record starts with a *NEWRECORD line and
+has one FIELD = value line per value; fields may repeat.
+
+Descriptors are placed in the MeSH tree by their tree numbers (MN),
+e.g., C04.557.337 is below C04.557. A descriptor's parents are the
+descriptors holding the parent of each of its tree numbers, so these
+are resolved through an index of tree numbers built in a first pass
+over the file (see build_index()). Pharmacological actions (PA) name
+other descriptors and are resolved through the same index.
+
+MEDLINE records name descriptors in their MH field, in the form
+Descriptor/Qualifier, with * marking major topics (see
+heading_descriptors()).
+'''
+
+import ast
+
+## Constants
+RECORD_START = "*NEWRECORD"
+PREFIX = "MESH:"
+
+FIELDS = ["RECTYPE", "MH", "AQ", "ENTRY", "MN", "PA", "MS", "UI"]
+'''
+Fields kept from each record.
+'''
+
+INDEX_FIELDS = ["MH", "MN", "UI"]
+'''
+Fields needed to build the index of tree numbers and names.
+'''
+
+## Functions
+def iter_records(filepath, fields=FIELDS):
+	'''Parses a MeSH ASCII file.
+	Yields a dict for each record, with lists of values for each of
+	the given fields it has, e.g., {"MH": ["Calcimycin"],
+	"MN": ["D03.633.100.221.173"], "UI": ["D000001"], ...}.'''
+
+	with filepath.open(encoding="utf-8") as infile:
+		for record in parse_records(infile, fields):
+			yield record
+
+def parse_records(lines, fields=FIELDS):
+	'''Parses MeSH ASCII text from an iterable of lines, e.g.,
+	as it is downloaded. Yields records as iter_records() does.'''
+
+	wanted = set(fields)
+	record = {}
+
+	for line in lines:
+		line = line.rstrip("\n")
+		if line == RECORD_START:
+			if len(record) > 0:
+				yield record
+			record = {}
+			continue
+		field, sep, value = line.partition(" = ")
+		if not sep or field not in wanted:
+			continue
+		values = record.get(field)
+		if values is None:
+			record[field] = [value]
+		else:
+			values.append(value)
+
+	if len(record) > 0:
+		yield record
+
+def is_descriptor(record):
+	'''Returns True if a record is a descriptor with an ID.'''
+
+	return record.get("RECTYPE", ["D"])[0] == "D" and "UI" in record
+
+def parent_tree_number(tree_number):
+	'''Returns the tree number above another, or None for the
+	top of a tree (e.g., C04).'''
+
+	if "." not in tree_number:
+		return None
+	return tree_number.rsplit(".", 1)[0]
+
+def build_index(filepath):
+	'''Reads the tree numbers and names of all descriptors in a
+	MeSH ASCII file.
+	Returns a tuple of two dicts: descriptor IDs by tree number,
+	and by name.'''
+
+	tree_ids = {}
+	name_ids = {}
+
+	for record in iter_records(filepath, INDEX_FIELDS + ["RECTYPE"]):
+		if is_descriptor(record):
+			index_record(record, tree_ids, name_ids)
+
+	return (tree_ids, name_ids)
+
+def index_record(record, tree_ids, name_ids):
+	'''Adds a descriptor to dicts of descriptor IDs by tree number
+	and by name.'''
+
+	mesh_id = PREFIX + record["UI"][0]
+	for tree_number in record.get("MN", []):
+		tree_ids[tree_number] = mesh_id
+	if "MH" in record:
+		name_ids[record["MH"][0]] = mesh_id
+
+def descriptor_entry(record, tree_ids, name_ids):
+	'''Converts one descriptor record to a processed KB entry,
+	with its parents (is_a) and pharmacological actions (pa) as
+	lists of descriptor IDs. Parents or actions missing from the
+	index are left out.
+	Returns a dict.'''
+
+	mesh_id = PREFIX + record["UI"][0]
+	tree_numbers = record.get("MN", [])
+
+	parents = []
+	for tree_number in tree_numbers:
+		parent_id = tree_ids.get(parent_tree_number(tree_number))
+		if parent_id is not None and parent_id != mesh_id and parent_id not in parents:
+			parents.append(parent_id)
+
+	actions = []
+	for action in record.get("PA", []):
+		action_id = name_ids.get(action)
+		if action_id is not None and action_id not in actions:
+			actions.append(action_id)
+
+	entry = {'id':mesh_id, 'name':record["MH"][0], 'tree_numbers':tree_numbers,
+				'is_a':parents, 'pa':actions,
+				'synonyms':[value.split("|")[0] for value in record.get("ENTRY", [])],
+				'qualifiers':record["AQ"][0].split() if "AQ" in record else []}
+	if "MS" in record:
+		entry['description'] = record["MS"][0]
+
+	return entry
+
+def heading_descriptors(headings):
+	'''Returns list of the descriptor names in a MEDLINE MH value,
+	e.g., "*Neoplasms/drug therapy|Humans" gives
+	["Neoplasms", "Humans"].'''
+
+	if not headings:
+		return []
+	names = []
+	for heading in headings.split("|"):
+		name = heading.split("/")[0].lstrip("*").strip()
+		if name != "":
+			names.append(name)
+	return names
+
+def read_heading_ids(filepath):
+	'''Reads descriptor IDs by name from a processed MeSH file.
+	Returns a dict, which is empty if the file doesn't exist.'''
+
+	name_ids = {}
+	if not filepath.exists():
+		return name_ids
+
+	with filepath.open() as infile:
+		for line in infile:
+			try:
+				entry = ast.literal_eval(line.rstrip())
+				name_ids[entry["name"]] = entry["id"]
+			except (KeyError, ValueError, SyntaxError): #Discard this entry
+				pass
+
+	return name_ids
@@ -0,0 +1,286 @@
+#!/usr/bin/python
+#tubduck_metrics.py
+'''
+Run metrics for TUBDUCK.
+
+Each stage of a run (downloading, processing and loading a KB,
+cross-linking, ingesting documents) is wrapped in stage(), which
+records its wall and CPU time, peak resident memory, bytes read and
+written, records in and out, and the count and latency of database
+transactions. Records are counted by the stages themselves with add(),
+and transactions are reported by the graph backends and input loaders
+with transaction().
+
+At the end of a run, finish_run() writes a JSON report to
+METRICS_PATH and, if METRICS_TEXTFILE is set (see tubduck_settings),
+a Prometheus textfile for the node exporter's textfile collector,
+so throughput can be tracked across rebuilds.
+
+Bytes are counted from /proc/self/io, so they include all reads and
+writes by this process (files, sockets and databases), but not those
+of worker processes. Peak memory is per stage where the kernel allows
+resetting the high-water mark, and otherwise the peak so far in the run.
+Stages may run concurrently on separate threads (see tubduck_schedule);
+their byte counts and peak memory then overlap.
+'''
+
+from contextlib import contextmanager
+from datetime import datetime
+import json
+import os
+from pathlib import Path
+import resource
+import socket
+import threading
+import time
+
+import tubduck_settings as tsettings
+
+## Constants
+METRICS_PATH = Path('../working/metrics')
+METRICS_TEXTFILE = tsettings.METRICS_TEXTFILE
+
+METRIC_PREFIX = "tubduck_"
+
+PROM_METRICS = [("wall_seconds", "Wall clock time of the stage"),
+				("cpu_seconds", "CPU time of the stage"),
+				("peak_rss_bytes", "Peak resident memory during the stage"),
+				("records_in", "Records read by the stage"),
+				("records_out", "Records written by the stage"),
+				("bytes_read", "Bytes read by the stage"),
+				("bytes_written", "Bytes written by the stage"),
+				("transactions", "Database transactions committed by the stage"),
+				("transaction_seconds", "Total time spent in database transactions")]
+'''
+Per-stage values written to the Prometheus textfile, with help text.
+'''
+
+run = None #The current run: a dict of run details and finished stages
+local = threading.local() #Stages in progress on each thread
+open_stages = [0] #Outer stages in progress, on all threads
+open_lock = threading.Lock()
+
+## Functions
+def start_run(name="tubduck"):
+	'''Starts recording a new run, discarding any stages
+	recorded so far. Returns the run dict.'''
+
+	global run
+	run = {"name": name,
+			"host": socket.gethostname(),
+			"started": datetime.now().isoformat(timespec="seconds"),
+			"start_time": time.time(),
+			"stages": []}
+	local.stages = []
+	open_stages[0] = 0
+
+	return run
+
+def get_run():
+	'''Returns the current run, starting one if needed.'''
+
+	if run is None:
+		start_run()
+	return run
+
+def active_stages():
+	'''Returns the list of stages in progress on this thread,
+	innermost last.'''
+
+	if not hasattr(local, "stages"):
+		local.stages = []
+	return local.stages
+
+def read_io():
+	'''Returns a tuple of bytes read and written by this
+	process so far, or (None, None) if not available.'''
+
+	try:
+		values = {}
+		with open("/proc/self/io") as io_file:
+			for line in io_file:
+				key, value = line.split(":", 1)
+				values[key] = int(value)
+		return (values["rchar"], values["wchar"])
+	except (IOError, KeyError, ValueError):
+		return (None, None)
+
+def reset_peak_rss():
+	'''Resets the kernel's record of peak resident memory for this
+	process, so the next reading covers only what follows.
+	Returns True if it could be reset.'''
+
+	try:
+		with open("/proc/self/clear_refs", "w") as clear_refs:
+			clear_refs.write("5")
+		return True
+	except (IOError, OSError):
+		return False
+
+def read_peak_rss():
+	'''Returns the peak resident memory of this process, in bytes.'''
+
+	try:
+		with open("/proc/self/status") as status_file:
+			for line in status_file:
+				if line.startswith("VmHWM:"):
+					return int(line.split()[1]) * 1024
+	except (IOError, ValueError):
+		pass
+	return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024 #kB on Linux
+
+def percentile(values, q):
+	'''Returns the qth percentile of a sorted list of values,
+	interpolating between the closest two as numpy does.'''
+
+	position = (len(values) - 1) * q / 100
+	lower = int(position)
+	upper = min(lower + 1, len(values) - 1)
+	return values[lower] + (values[upper] - values[lower]) * (position - lower)
+
+@contextmanager
+def stage(name, **labels):
+	'''Records metrics for a stage of the run, as a context manager.
+	labels are extra values identifying the stage, e.g., kb="don".
+	Yields the dict of stage metrics; counts can be added to it
+	directly or through add(). If the stage raises an exception,
+	its status is recorded as "error".'''
+
+	metrics = {"stage": name, "labels": labels, "status": "ok",
+				"started": datetime.now().isoformat(timespec="seconds"),
+				"records_in": 0, "records_out": 0,
+				"transactions": 0, "transaction_latencies": []}
+
+	active = active_stages()
+	if len(active) == 0: #Nested stages share the outer stage's reset
+		with open_lock:
+			#Resetting while another thread's stage is open would lose its peak
+			metrics["peak_reset"] = open_stages[0] == 0 and reset_peak_rss()
+			open_stages[0] = open_stages[0] + 1
+	else:
+		metrics["peak_reset"] = active[0]["peak_reset"]
+	metrics["peak_rss_bytes"] = 0
+	start_read, start_written = read_io()
+	start_wall = time.perf_counter()
+	start_cpu = time.process_time()
+	active.append(metrics)
+
+	try:
+		yield metrics
+	except BaseException:
+		metrics["status"] = "error"
+		raise
+	finally:
+		active.remove(metrics)
+		if len(active) == 0:
+			with open_lock:
+				open_stages[0] = open_stages[0] - 1
+		metrics["wall_seconds"] = round(time.perf_counter() - start_wall, 4)
+		metrics["cpu_seconds"] = round(time.process_time() - start_cpu, 4)
+		metrics["peak_rss_bytes"] = max(metrics["peak_rss_bytes"], read_peak_rss())
+		if len(active) > 0:
+			parent = active[-1]
+			parent["peak_rss_bytes"] = max(parent["peak_rss_bytes"], metrics["peak_rss_bytes"])
+		end_read, end_written = read_io()
+		if start_read is not None and end_read is not None:
+			metrics["bytes_read"] = end_read - start_read
+			metrics["bytes_written"] = end_written - start_written
+		else:
+			metrics["bytes_read"] = None
+			metrics["bytes_written"] = None
+
+		latencies = metrics.pop("transaction_latencies")
+		metrics["transaction_seconds"] = round(float(sum(latencies)), 4)
+		if len(latencies) > 0:
+			values = sorted(latency * 1000 for latency in latencies)
+			metrics["transaction_latency_ms"] = {"p50": round(percentile(values, 50), 3),
+												"p95": round(percentile(values, 95), 3),
+												"max": round(values[-1], 3)}
+		if metrics["wall_seconds"] > 0:
+			metrics["records_per_s"] = round(max(metrics["records_in"], metrics["records_out"]) /
+												metrics["wall_seconds"], 1)
+		get_run()["stages"].append(metrics)
+
+def add(records_in=0, records_out=0):
+	'''Adds record counts to the innermost stage in progress
+	on this thread. Does nothing outside of a stage.'''
+
+	active = active_stages()
+	if len(active) > 0:
+		active[-1]["records_in"] = active[-1]["records_in"] + records_in
+		active[-1]["records_out"] = active[-1]["records_out"] + records_out
+
+@contextmanager
+def transaction():
+	'''Times a database transaction, as a context manager, and adds it
+	to the innermost stage in progress on this thread.
+	Failed transactions aren't counted.'''
+
+	start = time.perf_counter()
+	yield
+	active = active_stages()
+	if len(active) > 0:
+		active[-1]["transactions"] = active[-1]["transactions"] + 1
+		active[-1]["transaction_latencies"].append(time.perf_counter() - start)
+
+def prom_labels(metrics):
+	'''Returns the Prometheus label string for a stage.'''
+
+	labels = dict(metrics["labels"], stage=metrics["stage"])
+	return ",".join('%s="%s"' % (key, str(value).replace("\\", "\\\\").replace('"', '\\"'))
+					for key, value in sorted(labels.items()))
+
+def write_textfile(textfile_path, report):
+	'''Writes a report as a Prometheus textfile.
+	The file is replaced atomically, so the collector
+	never reads a partial file.'''
+
+	lines = []
+	for key, help_text in PROM_METRICS:
+		metric = METRIC_PREFIX + "stage_" + key
+		lines.append("# HELP %s %s" % (metric, help_text))
+		lines.append("# TYPE %s gauge" % metric)
+		for metrics in report["stages"]:
+			if metrics.get(key) is not None:
+				lines.append("%s{%s} %s" % (metric, prom_labels(metrics), metrics[key]))
+	for key, help_text in [("run_timestamp_seconds", "Time the run started"),
+							("run_seconds", "Wall clock time of the run"),
+							("run_failed_stages", "Stages that ended with an error")]:
+		lines.append("# HELP %s %s" % (METRIC_PREFIX + key, help_text))
+		lines.append("# TYPE %s gauge" % (METRIC_PREFIX + key))
+	lines.append("%srun_timestamp_seconds %s" % (METRIC_PREFIX, round(report["start_time"])))
+	lines.append("%srun_seconds %s" % (METRIC_PREFIX, report["wall_seconds"]))
+	lines.append("%srun_failed_stages %s" % (METRIC_PREFIX,
+				sum(1 for metrics in report["stages"] if metrics["status"] != "ok")))
+
+	textfile_path = Path(textfile_path)
+	textfile_path.parent.mkdir(parents=True, exist_ok=True)
+	temppath = textfile_path.with_name(textfile_path.name + ".tmp")
+	temppath.write_text("\n".join(lines) + "\n")
+	os.replace(str(temppath), str(textfile_path))
+
+def finish_run(outpath=METRICS_PATH, textfile_path=METRICS_TEXTFILE):
+	'''Ends the current run and writes its report as JSON to
+	outpath/run-<date and time>.json, and as a Prometheus textfile
+	if textfile_path is set.
+	Returns the Path of the JSON report, or None if it
+	couldn't be written.'''
+
+	report = get_run()
+	report["finished"] = datetime.now().isoformat(timespec="seconds")
+	report["wall_seconds"] = round(time.time() - report["start_time"], 4)
+
+	try:
+		outpath.mkdir(parents=True, exist_ok=True)
+		outfilepath = outpath / ("run-%s.json" % datetime.now().strftime("%Y_%m_%d_%H_%M_%S"))
+		with outfilepath.open("w") as outfile:
+			json.dump(report, outfile, indent=2)
+		print("Wrote run report to %s" % outfilepath)
+		if textfile_path:
+			write_textfile(textfile_path, report)
+			print("Wrote run metrics to %s" % textfile_path)
+	except IOError as e:
+		print("Encountered an error while writing the run report: %s" % e)
+		outfilepath = None
+
+	return outfilepath
@@ -0,0 +1,99 @@
+#!/usr/bin/python
+#tubduck_nodes.py
+'''
+Compact node tables for TUBDUCK's KB processing.
+
+A NodeTable keeps one row per node in parallel arrays rather than
+in a dict per node. URIs generated by TUBDUCK are a prefix and a
+count, so they are stored as an index into a short list of interned
+prefixes and an integer. Parents are row numbers, and chapter
+numbers, repeated for every node in a chapter, are interned.
+Rows can be read back one at a time as Node objects.
+
+See benchmarks/bench_nodes.py for how its memory use compares with
+a dict per node.
+'''
+
+from array import array
+import sys
+
+## Constants
+NO_PARENT = -1
+
+## Classes
+class Node:
+	'''One row of a NodeTable.'''
+
+	__slots__ = ("uri", "code", "title", "chapter", "parent")
+
+	def __init__(self, uri, code, title, chapter, parent):
+		self.uri = uri
+		self.code = code
+		self.title = title
+		self.chapter = chapter
+		self.parent = parent #A row number, or NO_PARENT
+
+class NodeTable:
+	'''A table of nodes, each with a URI (a prefix and a number),
+	a code, a title, a chapter and a parent row.'''
+
+	__slots__ = ("prefixes", "prefix_rows", "uri_prefixes", "uri_numbers",
+					"codes", "titles", "chapters", "parents")
+
+	def __init__(self):
+		self.prefixes = [] #Interned URI prefixes
+		self.prefix_rows = {} #Index of each prefix in prefixes
+		self.uri_prefixes = array("H")
+		self.uri_numbers = array("q")
+		self.codes = []
+		self.titles = []
+		self.chapters = []
+		self.parents = array("q")
+
+	def __len__(self):
+		return len(self.parents)
+
+	def prefix_row(self, prefix):
+		'''Returns the index of a URI prefix, adding it if needed.'''
+
+		row = self.prefix_rows.get(prefix)
+		if row is None:
+			row = len(self.prefixes)
+			self.prefixes.append(sys.intern(prefix))
+			self.prefix_rows[self.prefixes[row]] = row
+		return row
+
+	def add(self, prefix, number, code, title, chapter="", parent=NO_PARENT):
+		'''Adds a node. Returns its row number.'''
+
+		self.uri_prefixes.append(self.prefix_row(prefix))
+		self.uri_numbers.append(number)
+		self.codes.append(code)
+		self.titles.append(title)
+		self.chapters.append(sys.intern(chapter))
+		self.parents.append(parent)
+
+		return len(self.parents) - 1
+
+	def update(self, row, prefix, number, title, parent):
+		'''Replaces a node's URI, title and parent.'''
+
+		self.uri_prefixes[row] = self.prefix_row(prefix)
+		self.uri_numbers[row] = number
+		self.titles[row] = title
+		self.parents[row] = parent
+
+	def uri(self, row):
+		'''Returns the URI of a node.'''
+
+		return self.prefixes[self.uri_prefixes[row]] + str(self.uri_numbers[row])
+
+	def __getitem__(self, row):
+		if row < 0:
+			row = row + len(self)
+		return Node(self.uri(row), self.codes[row], self.titles[row],
+					self.chapters[row], self.parents[row])
+
+	def __iter__(self):
+		for row in range(len(self)):
+			yield self[row]
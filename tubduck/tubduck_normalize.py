@@ -0,0 +1,345 @@
+#!/usr/bin/python
+#tubduck_normalize.py
+'''
+Mention normalization for TUBDUCK.
+
+Resolves mentions of concepts in text, e.g., from case reports, to
+the concepts of the processed KBs, even when they don't match a name
+exactly: "cardiomyopathies" or "cardiomiopathy" still find
+cardiomyopathy. Abbreviations like HOCM are found where a KB lists
+them as synonyms.
+
+Every name and synonym of every concept is indexed by its character
+n-grams (NGRAM_SIZE characters, with the ends of the text padded),
+weighted by TF-IDF, as rows of a sparse matrix (see ConceptIndex).
+Mentions are vectorized the same way, and their cosine similarity
+with all names is scored at once, BLOCK_SIZE mentions per sparse
+matrix product, and the best names for each are found with a partial
+sort. Only names sharing an n-gram with a mention are candidates.
+Names matching a mention exactly, once both are normalized
+(see normalize_surface()), are found without scoring.
+
+Resolutions are memoized in an SQLite file, keyed by normalized
+surface form, so a mention seen before in any document or run costs
+one lookup. The memo is cleared whenever the processed KB files
+it was built from change.
+'''
+
+import ast
+from collections import Counter
+import json
+from pathlib import Path
+import re
+import unicodedata
+
+import sqlite3
+
+import numpy as np
+import scipy.sparse as sp
+
+import tubduck_start as tstart
+
+## Constants
+MEMO_PATH = Path('../working/normalize_memo.sqlite')
+
+NORMALIZE_KBS = ["don", "m19", "i10", "i11", "reactome1"] #KBs whose concepts mentions resolve to
+
+NGRAM_SIZE = 3
+BLOCK_SIZE = 64 #Mentions scored per sparse matrix product
+MIN_SCORE = 0.5 #Lowest similarity counted as a match
+NAMES_PER_CANDIDATE = 8 #Best-scoring names kept for each candidate wanted, as concepts may share names
+MEMO_BATCH_SIZE = 500 #Surface forms looked up per memo query
+
+NON_WORD = re.compile(r"[\W_]+")
+
+QUOTED = re.compile(r'^"((?:[^"\\]|\\.)*)"')
+'''
+Matches the quoted text of an OBO synonym, e.g., "HOCM" EXACT [].
+'''
+
+## Functions
+def normalize_surface(text):
+	'''Returns the normalized surface form of a mention or name:
+	lowercase, without accents, and with punctuation and runs
+	of whitespace replaced by single spaces.'''
+
+	text = unicodedata.normalize("NFKD", text)
+	text = "".join(char for char in text if not unicodedata.combining(char))
+	return NON_WORD.sub(" ", text.lower()).strip()
+
+def char_ngrams(surface, n=NGRAM_SIZE):
+	'''Returns list of the character n-grams of a surface form,
+	padded with a space at each end.'''
+
+	padded = " %s " % surface
+	return [padded[i:i+n] for i in range(max(1, len(padded) - n + 1))]
+
+def entry_names(entry):
+	'''Returns list of the names and synonyms of a processed KB entry.
+	OBO entries have lists of values, and their synonyms are quoted.'''
+
+	names = []
+	for key in ["name", "synonym", "synonyms"]:
+		values = entry.get(key, [])
+		if isinstance(values, str):
+			values = [values]
+		for value in values:
+			match = QUOTED.match(value)
+			names.append(match.group(1) if match else value)
+	return names
+
+def kb_proc_paths(kbs=NORMALIZE_KBS, proc_path=None):
+	'''Returns list of the processed files of KBs that exist.'''
+
+	if proc_path is None:
+		proc_path = tstart.KB_PROC_PATH
+	filepaths = [proc_path / (tstart.KB_NAMES[kb].split(".")[0] + "-proc") for kb in kbs]
+	return [filepath for filepath in filepaths if filepath.exists()]
+
+def index_fingerprint(filepaths):
+	'''Returns a string identifying the versions of the processed
+	files an index is built from (see file_fingerprint() in
+	tubduck_start).'''
+
+	return json.dumps([[filepath.name] + tstart.file_fingerprint(filepath)
+						for filepath in filepaths])
+
+def iter_kb_names(filepaths):
+	'''Reads processed KB files.
+	Yields a tuple of concept ID and name for each name and synonym
+	of each entry.'''
+
+	for filepath in filepaths:
+		with filepath.open() as infile:
+			for line in infile:
+				try:
+					entry = ast.literal_eval(line.rstrip())
+					concept_id = entry["id"]
+					if isinstance(concept_id, list):
+						concept_id = concept_id[0]
+				except (KeyError, IndexError, ValueError, SyntaxError): #Discard this entry
+					continue
+				for name in entry_names(entry):
+					yield (concept_id, name)
+
+def build_index(kbs=NORMALIZE_KBS, proc_path=None):
+	'''Builds a ConceptIndex of the names of the concepts in the
+	processed files of the given KBs.'''
+
+	concept_ids = []
+	names = []
+	for concept_id, name in iter_kb_names(kb_proc_paths(kbs, proc_path)):
+		concept_ids.append(concept_id)
+		names.append(name)
+	return ConceptIndex(concept_ids, names)
+
+## Classes
+class ConceptIndex:
+	'''A character n-gram index of concept names.
+	Takes lists of concept IDs and names, one per name; a concept
+	may have several names.'''
+
+	def __init__(self, concept_ids, names):
+		self.concept_ids = concept_ids
+		self.names = names
+		self.exact = {} #Row of the first name with each surface form
+		self.vocab = {} #Column of each n-gram
+
+		rows = []
+		cols = []
+		for row, name in enumerate(names):
+			surface = normalize_surface(name)
+			self.exact.setdefault(surface, row)
+			for ngram in char_ngrams(surface):
+				rows.append(row)
+				cols.append(self.vocab.setdefault(ngram, len(self.vocab)))
+
+		shape = (len(names), max(1, len(self.vocab)))
+		counts = sp.csr_matrix((np.ones(len(rows), dtype=np.float32), (rows, cols)),
+								shape=shape)
+		doc_freq = np.bincount(counts.indices, minlength=shape[1])
+		self.idf = (np.log((1 + shape[0]) / (1 + doc_freq)) + 1).astype(np.float32)
+		self.unknown_idf = np.float32(np.log(1 + shape[0]) + 1) #For n-grams in no name
+
+		counts.data = counts.data * self.idf[counts.indices]
+		self.matrix_t = self.normalize_rows(counts, np.zeros(shape[0])).T.tocsr()
+
+	def normalize_rows(self, matrix, extra):
+		'''Scales the rows of a matrix to unit length, counting extra
+		squared length for each row. Returns the matrix.'''
+
+		lengths = np.sqrt(np.asarray(matrix.multiply(matrix).sum(axis=1)).ravel() + extra)
+		lengths[lengths == 0] = 1
+		return sp.csr_matrix(sp.diags(1 / lengths) @ matrix)
+
+	def vectorize(self, surfaces):
+		'''Returns the TF-IDF vectors of surface forms as rows of
+		a sparse matrix. N-grams in no name count towards the length
+		of a vector, at the highest weight, but match nothing.'''
+
+		rows = []
+		cols = []
+		values = []
+		extra = np.zeros(len(surfaces))
+		for row, surface in enumerate(surfaces):
+			for ngram, count in Counter(char_ngrams(surface)).items():
+				col = self.vocab.get(ngram)
+				if col is None:
+					extra[row] = extra[row] + (count * self.unknown_idf) ** 2
+				else:
+					rows.append(row)
+					cols.append(col)
+					values.append(count * self.idf[col])
+		vectors = sp.csr_matrix((np.array(values, dtype=np.float32), (rows, cols)),
+								shape=(len(surfaces), self.matrix_t.shape[0]))
+		return self.normalize_rows(vectors, extra)
+
+	def rank(self, surfaces, k=1, block_size=BLOCK_SIZE):
+		'''Finds the k most similar concepts for each surface form,
+		block_size at a time.
+		Returns a list with a list of (concept ID, name, score)
+		tuples for each, best first. Concepts with equal scores are
+		in the order they were indexed.'''
+
+		ranked = []
+		vectors = self.vectorize(surfaces)
+		keep = k * NAMES_PER_CANDIDATE
+
+		for start in range(0, len(surfaces), block_size):
+			scores = sp.csr_matrix(vectors[start:start+block_size] @ self.matrix_t)
+			for row in range(scores.shape[0]):
+				row_start, row_end = scores.indptr[row], scores.indptr[row+1]
+				name_rows = scores.indices[row_start:row_end]
+				values = scores.data[row_start:row_end]
+				if len(values) > keep:
+					best = np.argpartition(-values, keep)[:keep]
+					name_rows = name_rows[best]
+					values = values[best]
+				order = np.lexsort((name_rows, -values)) #Ties go to the first KB
+				candidates = []
+				seen = set()
+				for i in order: #Several names of one concept may score well
+					concept_id = self.concept_ids[name_rows[i]]
+					if concept_id in seen:
+						continue
+					seen.add(concept_id)
+					candidates.append((concept_id, self.names[name_rows[i]], float(values[i])))
+					if len(candidates) == k:
+						break
+				ranked.append(candidates)
+
+		return ranked
+
+	def resolve(self, surfaces):
+		'''Finds the best concept for each surface form: one with an
+		exact name if there is one, otherwise the most similar.
+		Returns a list with a (concept ID, name, score) tuple,
+		or None, for each.'''
+
+		resolved = [None] * len(surfaces)
+		to_rank = []
+		for i, surface in enumerate(surfaces):
+			row = self.exact.get(surface)
+			if row is not None:
+				resolved[i] = (self.concept_ids[row], self.names[row], 1.0)
+			else:
+				to_rank.append(i)
+
+		ranked = self.rank([surfaces[i] for i in to_rank])
+		for i, candidates in zip(to_rank, ranked):
+			if len(candidates) > 0:
+				resolved[i] = candidates[0]
+
+		return resolved
+
+class Normalizer:
+	'''Resolves mentions to concepts through the memo at memo_path,
+	building a ConceptIndex of the given KBs only when a mention
+	isn't memoized yet.'''
+
+	def __init__(self, memo_path=MEMO_PATH, kbs=NORMALIZE_KBS, proc_path=None,
+					min_score=MIN_SCORE):
+		self.memo_path = memo_path
+		self.filepaths = kb_proc_paths(kbs, proc_path)
+		self.kbs = kbs
+		self.proc_path = proc_path
+		self.min_score = min_score
+		self.index = None
+		self.dbcon = None
+		self.hits = 0
+		self.misses = 0
+
+	def connect(self):
+		'''Opens the memo, clearing it if the processed KB files have
+		changed since it was written. Returns a connection.'''
+
+		if self.dbcon is None:
+			Path(self.memo_path).parent.mkdir(parents=True, exist_ok=True)
+			self.dbcon = sqlite3.connect(str(self.memo_path))
+			self.dbcon.execute("""CREATE TABLE IF NOT EXISTS memo (
+								surface text PRIMARY KEY,
+								concept text,
+								name text,
+								score real)""")
+			self.dbcon.execute("CREATE TABLE IF NOT EXISTS meta (key text PRIMARY KEY, value text)")
+			fingerprint = index_fingerprint(self.filepaths)
+			row = self.dbcon.execute("SELECT value FROM meta WHERE key = 'index'").fetchone()
+			if row is None or row[0] != fingerprint:
+				self.dbcon.execute("DELETE FROM memo")
+				self.dbcon.execute("INSERT OR REPLACE INTO meta VALUES ('index', ?)", (fingerprint,))
+			self.dbcon.commit()
+		return self.dbcon
+
+	def lookup(self, surfaces):
+		'''Returns a dict of memoized resolutions for surface forms,
+		as (concept ID, name, score) tuples or None.'''
+
+		dbcon = self.connect()
+		found = {}
+		for start in range(0, len(surfaces), MEMO_BATCH_SIZE):
+			batch = surfaces[start:start+MEMO_BATCH_SIZE]
+			for surface, concept_id, name, score in dbcon.execute(
+					"SELECT surface, concept, name, score FROM memo WHERE surface IN (%s)"
+					% ", ".join("?" * len(batch)), batch):
+				found[surface] = None if concept_id is None else (concept_id, name, score)
+		return found
+
+	def resolve(self, texts):
+		'''Resolves mentions to concepts.
+		Returns a list with a dict of the "concept" ID, its "name" and
+		the similarity "score" for each mention, or None if nothing
+		scores at least min_score.'''
+
+		surfaces = [normalize_surface(text) for text in texts]
+		unique = list(set(surface for surface in surfaces if surface != ""))
+		found = self.lookup(unique)
+		self.hits = self.hits + len(found)
+
+		missing = [surface for surface in unique if surface not in found]
+		if len(missing) > 0:
+			self.misses = self.misses + len(missing)
+			if self.index is None:
+				self.index = build_index(self.kbs, self.proc_path)
+			resolved = self.index.resolve(missing)
+			dbcon = self.connect()
+			with dbcon:
+				dbcon.executemany("INSERT OR REPLACE INTO memo VALUES (?, ?, ?, ?)",
+									((surface,) + (result or (None, None, None))
+										for surface, result in zip(missing, resolved)))
+			found.update(zip(missing, resolved))
+
+		results = []
+		for surface in surfaces:
+			result = found.get(surface)
+			if result is None or result[2] < self.min_score:
+				results.append(None)
+			else:
+				results.append({"concept": result[0], "name": result[1], "score": result[2]})
+		return results
+
+	def close(self):
+		'''Closes the memo.'''
+
+		if self.dbcon is not None:
+			self.dbcon.close()
+			self.dbcon = None
@@ -0,0 +1,369 @@
+#!/usr/bin/python
+#tubduck_obo.py
+'''
+OBO format parsing for TUBDUCK.
+
+Reads ontologies in OBO 1.2/1.4 format (the Disease Ontology, and
+others like MONDO, HPO or UBERON) stanza by stanza, keeping every tag.
+Files are read in chunks of CHUNK_SIZE characters rather than line by
+line, and text can also be parsed as it arrives, in chunks of any size
+(see parse_stanzas()). Tag values are split from their trailing modifiers
+({name="value", ...}) and comments (! ...) only when a line has any,
+so most lines take just a split.
+
+Stanzas are yielded as (stanza type, tags, modifiers), where tags is
+a dict of lists of values for each tag, and modifiers a dict of lists
+of dicts, for the tags that had any, in the same order as their values.
+Header tags are yielded as a stanza of type "Header".
+
+iter_tables() collects terms, their relations and all of their other
+tag values into column-oriented tables (see COLUMNS), in batches,
+and write_columns() writes them out.
+'''
+
+from pathlib import Path
+
+## Constants
+CHUNK_SIZE = 1 << 20 #Characters read at a time
+BATCH_SIZE = 100000 #Stanzas per batch of columns written
+
+TERM_COLUMNS = ["id", "name", "namespace", "def", "comment", "stanza"]
+'''
+Single-valued tags kept as columns of the terms table.
+Multi-valued tags (synonyms, xrefs and the like) go in the tags table.
+'''
+
+EDGE_TAGS = {"is_a", "relationship", "intersection_of", "union_of",
+				"disjoint_from", "equivalent_to"}
+'''
+Tags relating a term to other terms, kept in the edges table.
+'''
+
+TYPED_EDGE_TAGS = {"relationship", "intersection_of"}
+'''
+Edge tags whose values may start with a relation type.
+'''
+
+COLUMNS = {"terms": TERM_COLUMNS,
+			"edges": ["source", "type", "target", "modifiers"],
+			"tags": ["id", "tag", "value", "modifiers"]}
+'''
+Columns of each table written by write_columns().
+'''
+
+ESCAPES = {"n": "\n", "W": " ", "t": "\t"}
+'''
+OBO escape sequences that don't stand for themselves.
+'''
+
+## Functions
+def unescape(value):
+	'''Replaces OBO escape sequences (\\n, \\W, \\t, or a backslash
+	before any other character) in a value.'''
+
+	if "\\" not in value:
+		return value
+	chars = []
+	escaped = False
+	for char in value:
+		if escaped:
+			chars.append(ESCAPES.get(char, char))
+			escaped = False
+		elif char == "\\":
+			escaped = True
+		else:
+			chars.append(char)
+	return "".join(chars)
+
+def parse_modifiers(text):
+	'''Parses the inside of a trailing modifier block, e.g.,
+	source="DOID:1", cardinality=2.
+	Returns a dict of modifier names and values.'''
+
+	modifiers = {}
+	for part in split_unquoted(text, ","):
+		name, _, value = part.partition("=")
+		value = value.strip()
+		if len(value) > 1 and value[0] == '"' and value[-1] == '"':
+			value = value[1:-1]
+		modifiers[name.strip()] = unescape(value)
+	return modifiers
+
+def split_unquoted(text, separator):
+	'''Splits text on a separator, except where the separator
+	is escaped or within double quotes.'''
+
+	parts = []
+	start = 0
+	quoted = False
+	escaped = False
+	for i, char in enumerate(text):
+		if escaped:
+			escaped = False
+		elif char == "\\":
+			escaped = True
+		elif char == '"':
+			quoted = not quoted
+		elif char == separator and not quoted:
+			parts.append(text[start:i])
+			start = i + 1
+	parts.append(text[start:])
+	return parts
+
+def parse_value(value):
+	'''Splits a tag value from its trailing modifiers and comment,
+	ignoring "!" and "{" when escaped or quoted.
+	Returns a tuple of the value and a dict of modifiers (or None).
+	Quoted values, e.g., of def and synonym, are kept as written;
+	others are unescaped.'''
+
+	if '"' not in value and "\\" not in value: #Nothing to ignore
+		text = value.partition("!")[0].rstrip()
+		brace = text.rfind("{")
+	else:
+		quoted = False
+		escaped = False
+		brace = -1 #Start of the last unquoted modifier block
+		end = len(value)
+		for i, char in enumerate(value):
+			if escaped:
+				escaped = False
+			elif char == "\\":
+				escaped = True
+			elif char == '"':
+				quoted = not quoted
+			elif quoted:
+				continue
+			elif char == "{":
+				brace = i
+			elif char == "!":
+				end = i
+				break
+		text = value[:end].rstrip()
+
+	modifiers = None
+	if brace >= 0 and text.endswith("}"):
+		modifiers = parse_modifiers(text[brace + 1:-1])
+		text = text[:brace].rstrip()
+	if '"' not in text:
+		text = unescape(text)
+
+	return (text, modifiers)
+
+def read_chunks(filepath, chunk_size=CHUNK_SIZE):
+	'''Yields the text of a file, chunk_size characters at a time.'''
+
+	with Path(filepath).open(encoding="utf-8") as infile:
+		while True:
+			chunk = infile.read(chunk_size)
+			if not chunk:
+				break
+			yield chunk
+
+def iter_stanzas(filepath, chunk_size=CHUNK_SIZE):
+	'''Parses an OBO file.
+	Yields a tuple of (stanza type, tags, modifiers) for the header
+	and then each stanza, e.g., ("Term", {"id": ["DOID:4"],
+	"name": ["disease"], ...}, {}).'''
+
+	return parse_stanzas(read_chunks(filepath, chunk_size))
+
+def parse_stanzas(chunks):
+	'''Parses OBO text from an iterable of chunks of any size,
+	e.g., as it is downloaded. Yields stanzas as iter_stanzas() does.'''
+
+	stanza_type = "Header"
+	tags = {}
+	modifiers = {}
+
+	rest = ""
+	chunks = iter(chunks)
+	while True:
+		chunk = next(chunks, None)
+		if chunk is not None:
+			lines = (rest + chunk).split("\n")
+			rest = lines.pop() #May be cut short
+		else:
+			lines = [rest]
+
+		for line in lines:
+			if not line:
+				continue
+			first = line[0]
+			if first == "!": #Comment
+				continue
+			if first == "[":
+				line = line.rstrip()
+				if line[-1] == "]":
+					if len(tags) > 0 or stanza_type != "Header":
+						yield (stanza_type, tags, modifiers)
+					stanza_type = line[1:-1]
+					tags = {}
+					modifiers = {}
+					continue
+			tag, sep, value = line.partition(":")
+			if not sep:
+				continue
+			value = value.strip()
+			if "!" in value or "{" in value or "\\" in value:
+				if '"' in value or "{" in value or "\\" in value:
+					value, value_modifiers = parse_value(value)
+				else: #Just a comment
+					value = value[:value.index("!")].rstrip()
+					value_modifiers = None
+				if value_modifiers is not None:
+					if tag not in modifiers:
+						modifiers[tag] = [None] * len(tags.get(tag, []))
+					modifiers[tag].append(value_modifiers)
+				elif modifiers and tag in modifiers:
+					modifiers[tag].append(None)
+			elif modifiers and tag in modifiers:
+				modifiers[tag].append(None)
+			values = tags.get(tag)
+			if values is None:
+				tags[tag] = [value]
+			else:
+				values.append(value)
+
+		if chunk is None:
+			break
+
+	if len(tags) > 0 or stanza_type != "Header":
+		yield (stanza_type, tags, modifiers)
+
+def is_obsolete(tags):
+	'''Returns True if a stanza's tags mark it obsolete.'''
+
+	return tags.get("is_obsolete", ["false"])[0] == "true"
+
+def edge_target(tag, value):
+	'''Returns a tuple of the relation type and target of an edge
+	tag value, or None if it has no target.'''
+
+	parts = value.split()
+	if len(parts) == 0:
+		return None
+	if len(parts) > 1 and tag in TYPED_EDGE_TAGS:
+		return (parts[0], parts[1])
+	return (tag, parts[0])
+
+def new_tables():
+	'''Returns empty tables, as a dict of dicts of column lists.'''
+
+	return {name: {column: [] for column in table_columns}
+			for name, table_columns in COLUMNS.items()}
+
+def iter_tables(stanzas, skip_obsolete=True, batch_size=BATCH_SIZE):
+	'''Collects stanzas into column-oriented tables, as in COLUMNS.
+	Obsolete stanzas are skipped if skip_obsolete is True.
+	Yields tables for each batch_size stanzas, as a dict of dicts
+	of column lists. Modifiers are written as strings,
+	e.g., source="DOID:1".'''
+
+	tables = new_tables()
+	count = 0
+	empty = [""]
+
+	for stanza_type, tags, modifiers in stanzas:
+		if stanza_type == "Header" or "id" not in tags:
+			continue
+		if skip_obsolete and is_obsolete(tags):
+			continue
+		terms = tables["terms"]
+		edges = tables["edges"]
+		other = tables["tags"]
+		term_id = tags["id"][0]
+		for column in TERM_COLUMNS[:-1]:
+			terms[column].append(tags.get(column, empty)[0])
+		terms["stanza"].append(stanza_type)
+		
+		for tag, values in tags.items():
+			tag_modifiers = modifiers.get(tag) if modifiers else None
+			if tag in EDGE_TAGS:
+				for i, value in enumerate(values):
+					edge = edge_target(tag, value)
+					if edge is None:
+						continue
+					edges["source"].append(term_id)
+					edges["type"].append(edge[0])
+					edges["target"].append(edge[1])
+					edges["modifiers"].append("" if tag_modifiers is None
+												else format_modifiers(tag_modifiers[i]))
+			elif tag in TERM_COLUMNS and len(values) == 1 and tag_modifiers is None:
+				continue
+			else:
+				for i, value in enumerate(values):
+					other["id"].append(term_id)
+					other["tag"].append(tag)
+					other["value"].append(value)
+					other["modifiers"].append("" if tag_modifiers is None
+												else format_modifiers(tag_modifiers[i]))
+		count = count + 1
+		if count == batch_size:
+			yield tables
+			tables = new_tables()
+			count = 0
+
+	if count > 0:
+		yield tables
+
+def format_modifiers(modifiers):
+	'''Returns modifiers as a string, e.g., source="DOID:1",
+	or "" if there are none.'''
+
+	if not modifiers:
+		return ""
+	return ", ".join('%s="%s"' % (name, value.replace('"', '\\"'))
+						for name, value in modifiers.items())
+
+def write_columns(batches, outpath, file_format=None):
+	'''Writes tables from iter_tables() to outpath, batch by batch,
+	as one Arrow IPC file per table if pyarrow is installed (or
+	file_format is "arrow"). Otherwise, writes one uncompressed NumPy
+	.npz file of UTF-8 byte arrays and offsets (see tubduck_export);
+	this needs all batches in memory at once.
+	Returns list of the Paths written.'''
+
+	import tubduck_export as texport
+
+	if file_format is None:
+		file_format = "arrow" if texport.pa is not None else "npz"
+	outpath.mkdir(parents=True, exist_ok=True)
+
+	if file_format == "arrow":
+		pa = texport.pa
+		schemas = {name: pa.schema([(column, pa.string()) for column in columns])
+					for name, columns in COLUMNS.items()}
+		outfilepaths = [outpath / (name + ".arrow") for name in COLUMNS]
+		sinks = {}
+		writers = {}
+		try:
+			for name, outfilepath in zip(COLUMNS, outfilepaths):
+				sinks[name] = pa.OSFile(str(outfilepath), "wb")
+				writers[name] = pa.ipc.new_file(sinks[name], schemas[name])
+			for tables in batches:
+				for name, table in tables.items():
+					writers[name].write_batch(pa.record_batch([pa.array(table[column], pa.string())
+																for column in COLUMNS[name]],
+																schema=schemas[name]))
+		finally:
+			for name in writers:
+				writers[name].close()
+			for name in sinks:
+				sinks[name].close()
+		return outfilepaths
+
+	merged = new_tables()
+	for tables in batches:
+		for name, table in tables.items():
+			for column, values in table.items():
+				merged[name][column].extend(values)
+	arrays = {}
+	for name, table in merged.items():
+		for column, values in table.items():
+			key = "%s_%s" % (name, column)
+			arrays[key + "_data"], arrays[key + "_offsets"] = texport.encode_strings(values)
+	outfilepath = outpath / "columns.npz"
+	texport.np.savez(str(outfilepath), **arrays)
+
+	return [outfilepath]
@@ -2,4 +2,223 @@
 #tubduck_output.py
 '''
 Output functions for TUBDUCK.
+
+These write the instance graph: documents from the input database,
+the patients they describe, and the concepts they mention.
+Documents are Publication nodes and patients are Case nodes,
+following the schema (see schemas/schema.yaml and the Patient entry
+in the instance schema). Mentions are edges to the NamedThing and
+Pathway nodes of the concept graph. The MeSH headings of each
+document (its MH column) are linked to the corresponding MeSH
+descriptor nodes in the same way.
+All writes are batched upserts on node IDs through the graph backend
+(see tubduck_graph), so writing the same documents again doesn't
+duplicate anything.
 '''
+
+from tqdm import *
+
+import sqlite3
+
+import neobolt.exceptions
+
+import tubduck_docs as tdocs
+import tubduck_graph as tgraph
+import tubduck_mesh as tmesh
+import tubduck_schema as tschema
+import tubduck_start as tstart
+
+## Constants
+BATCH_SIZE = 5000 #Rows per write transaction
+
+DOC_COLUMNS = ["PMID", "TI", "DP", "TA", "PT"]
+'''
+Document columns used for Publication nodes.
+'''
+
+CASE_REPORT_TYPE = "Case Reports" #Publication type for documents with a patient
+
+MESH_PROC_PATH = tstart.KB_PROC_PATH / (tstart.KB_NAMES["m19"].split(".")[0] + "-proc")
+
+## Functions
+def doc_node_id(pmid):
+	'''Returns the Publication node ID for a PMID.'''
+	return "PMID:" + str(pmid)
+
+def case_node_id(pmid, count):
+	'''Returns the Case node ID for a patient in a document,
+	in the form [PMID]-[count], with patients counted from 1.'''
+	return "%s-%s" % (pmid, count)
+
+def concept_label(concept_id):
+	'''Returns the label of the concept graph node with the given ID,
+	based on its prefix.'''
+
+	if concept_id.startswith("Reactome:"):
+		return "Pathway"
+	return "NamedThing"
+
+def write_batches(rows, write, pbar=None):
+	'''Writes a list of rows with the given backend write function,
+	BATCH_SIZE rows at a time.'''
+
+	for i in range(0, len(rows), BATCH_SIZE):
+		batch = rows[i:i+BATCH_SIZE]
+		write(batch)
+		if pbar is not None:
+			pbar.update(len(batch))
+
+def write_cases(backend, case_rows):
+	'''Writes Case nodes and their sourceDoc edges to
+	Publication nodes. Cases of documents not in the graph
+	get no edge.'''
+
+	write_batches([{"id": row["id"], "sourceDoc": row["pmid"]} for row in case_rows],
+					lambda batch: backend.upsert_nodes("Case", batch))
+	write_batches([{"source": row["id"], "target": row["doc"]} for row in case_rows],
+					lambda batch: backend.upsert_edges("sourceDoc", "Case", "Publication",
+														batch, create_nodes=False))
+
+def doc_rows_and_cases(docs):
+	'''Converts documents, as dicts of DOC_COLUMNS, to rows for
+	Publication nodes and for the Case nodes of case reports.
+	Returns a tuple of two lists.'''
+
+	doc_rows = []
+	case_rows = []
+
+	for doc in docs:
+		pmid = doc["PMID"]
+		if pmid is None: #Can't key it
+			continue
+		pub_types = doc["PT"].split("|") if doc["PT"] else []
+		doc_rows.append({"id": doc_node_id(pmid), "pmid": pmid, "name": doc["TI"],
+						"date": doc["DP"], "journal": doc["TA"],
+						"publicationType": pub_types})
+		if CASE_REPORT_TYPE in pub_types:
+			case_rows.append({"id": case_node_id(pmid, 1), "pmid": pmid,
+							"doc": doc_node_id(pmid)})
+
+	return (doc_rows, case_rows)
+
+def mention_rows(mentions):
+	'''Groups mentions by the labels of their source and target nodes.
+	Each mention is a dict with a "pmid", a "concept" ID, and optionally
+	a "patient" count (from 1) and the mention "text".
+	A mention with a patient is linked from that patient's Case node,
+	otherwise from the document's Publication node.
+	Returns a tuple of a dict of row lists, keyed by
+	(source label, concept label), and a list of Case rows needed for
+	patients that the mentions refer to.'''
+
+	grouped = {}
+	case_rows = {}
+
+	for mention in mentions:
+		pmid = mention["pmid"]
+		patient = mention.get("patient")
+		if patient:
+			source_label = "Case"
+			source = case_node_id(pmid, patient)
+			case_rows[source] = {"id": source, "pmid": pmid, "doc": doc_node_id(pmid)}
+		else:
+			source_label = "Publication"
+			source = doc_node_id(pmid)
+		labels = (source_label, concept_label(mention["concept"]))
+		row = {"source": source, "concept": mention["concept"],
+				"text": mention.get("text")}
+		grouped.setdefault(labels, []).append(row)
+
+	return (grouped, list(case_rows.values()))
+
+def heading_mentions(docs, heading_ids):
+	'''Returns list of mention dicts (see mention_rows()) linking
+	documents, as dicts with PMID and MH columns, to the MeSH
+	descriptors in their headings. heading_ids is a dict of
+	descriptor IDs by name; headings not in it are skipped.'''
+
+	mentions = []
+
+	for doc in docs:
+		if doc["PMID"] is None or not doc["MH"]:
+			continue
+		for heading in doc["MH"].split("|"):
+			for name in tmesh.heading_descriptors(heading):
+				if name in heading_ids:
+					mentions.append({"pmid": doc["PMID"], "concept": heading_ids[name],
+									"text": heading})
+
+	return mentions
+
+def write_mentions(backend, mentions):
+	'''Writes mention edges, and any Case nodes they need.
+	Mentions of concepts not in the concept graph are skipped.
+	Takes a graph backend and a list of mention dicts as described
+	in mention_rows().'''
+
+	grouped, case_rows = mention_rows(mentions)
+	write_cases(backend, case_rows)
+	for (source_label, target_label), rows in grouped.items():
+		edges = [{"source": row["source"], "target": row["concept"],
+					"props": {"text": row["text"]}} for row in rows]
+		write_batches(edges, lambda batch: backend.upsert_edges("mentions", source_label,
+																target_label, batch,
+																create_nodes=False))
+
+def write_instance_graph(mentions=None, db_path=tdocs.DB_PATH, backend=None,
+							mesh_path=MESH_PROC_PATH):
+	'''Writes documents from the input database to the graph DB
+	as Publication nodes, keyed by PMID, with Case nodes for the
+	patients in case reports.
+	mentions is an optional list of mention dicts
+	(see mention_rows()), to be linked to concept nodes.
+	If the documents have MeSH headings and MeSH has been processed
+	(to mesh_path), headings are linked to their descriptors, too.
+	Documents without PMIDs aren't written.
+	Writes through the given graph backend, or the one set by
+	GRAPH_BACKEND (see tubduck_graph).
+	Returns True if writing completes without error.'''
+
+	status = False
+
+	if backend is None:
+		backend = tgraph.get_backend()
+
+	print("Writing documents to instance graph...")
+	try:
+		tschema.provision(backend, ["Publication", "Case"])
+		
+		columns = DOC_COLUMNS
+		heading_ids = {}
+		dbcon = tdocs.docs_db_connect(db_path)
+		has_headings = "MH" in tdocs.get_doc_columns(dbcon)
+		dbcon.close()
+		if has_headings:
+			heading_ids = tmesh.read_heading_ids(mesh_path)
+		if len(heading_ids) > 0:
+			columns = DOC_COLUMNS + ["MH"]
+		heading_count = 0
+		
+		pbar = tqdm(unit=" documents", total=tdocs.count_docs("PMID", db_path=db_path))
+		for docs in tdocs.iter_doc_batches(columns, BATCH_SIZE, key="PMID",
+											db_path=db_path):
+			doc_rows, case_rows = doc_rows_and_cases(docs)
+			write_batches(doc_rows, lambda batch: backend.upsert_nodes("Publication", batch), pbar)
+			write_cases(backend, case_rows)
+			if len(heading_ids) > 0:
+				doc_mentions = heading_mentions(docs, heading_ids)
+				write_mentions(backend, doc_mentions)
+				heading_count = heading_count + len(doc_mentions)
+		pbar.close()
+		if len(heading_ids) > 0:
+			print("Linked %s MeSH headings to descriptors." % heading_count)
+
+		if mentions:
+			print("Writing %s mentions to instance graph..." % len(mentions))
+			write_mentions(backend, mentions)
+		status = True
+	except (neobolt.exceptions.DatabaseError, neobolt.exceptions.ClientError,
+			neobolt.exceptions.ServiceUnavailable, sqlite3.Error) as e:
+		print("Encountered an error while writing the instance graph: %s" % e)
+
+	return status
@@ -8,3 +8,355 @@ Processing functions for TUBDUCK.
 D. Inference module - Identification of missing relations, Prediction of new relations based on inference targets
 E. Evaluation - Assemble test relationships, Build test queries, Evaluate results of test queries
 '''
+
+from datetime import datetime
+import json
+from pathlib import Path
+import time
+
+import numpy as np
+import scipy.sparse as sp
+
+from tqdm import *
+
+import neobolt.exceptions
+
+import tubduck_cache as tcache
+import tubduck_export as texport
+import tubduck_graph as tgraph
+
+## Constants
+INFERENCE_PATH = Path('../working/inference')
+EVAL_SUITE_PATH = Path('../evaluation')
+EVAL_RESULTS_PATH = Path('../working/evaluation')
+
+LINK_METHODS = ["common_neighbors", "adamic_adar", "katz"]
+
+BLOCK_SIZE = 2048 #Rows of the score matrix computed at once
+TOP_K = 10 #Candidates kept per node
+KATZ_BETA = 0.05 #Damping for each additional step in Katz scores
+KATZ_MAX_LENGTH = 3 #Longest path counted in Katz scores
+
+EVAL_WARMUP = 1 #Default untimed runs of each test query
+EVAL_REPEATS = 5 #Default timed runs of each test query
+LATENCY_TOLERANCE = 1.5 #Slowdown (as a ratio of p95 latency) counted as a regression
+
+## Functions
+def get_graph_arrays(source=None):
+	'''Gets the nodes and edges of a graph for inference.
+	source is "neo4j" to read the concept and instance graph from the
+	graph DB, "kbs" to read the processed KB files, or the Path of a
+	graph export (see tubduck_export). By default, it's "neo4j" if
+	that is the GRAPH_BACKEND, as only Neo4j can be read this way,
+	and "kbs" otherwise.
+	Returns a tuple of a list of node IDs and arrays of edge
+	source and destination indices.'''
+
+	if source is None:
+		source = "neo4j" if tgraph.GRAPH_BACKEND == "neo4j" else "kbs"
+
+	if source in ["neo4j", "kbs"]:
+		if source == "neo4j":
+			graph = texport.read_neo4j_graph()
+		else:
+			graph = texport.read_kb_graph()
+		return (graph["node_id"], np.array(graph["edge_src"], dtype=np.int32),
+				np.array(graph["edge_dst"], dtype=np.int32))
+
+	tables = texport.load_graph_export(source)
+	if "nodes" in tables:
+		node_ids = tables["nodes"].column("id").to_pylist()
+		src = tables["edges"].column("src").to_numpy()
+		dst = tables["edges"].column("dst").to_numpy()
+	else:
+		data, offsets = tables["node_id_data"], tables["node_id_offsets"]
+		node_ids = [texport.decode_string(data, offsets, i) for i in range(len(offsets) - 1)]
+		src = tables["edge_src"]
+		dst = tables["edge_dst"]
+
+	return (node_ids, src, dst)
+
+def build_adjacency(node_count, src, dst):
+	'''Builds a symmetric, binary sparse adjacency matrix (CSR)
+	from edge source and destination indices.
+	Edge direction is ignored for link prediction.'''
+
+	rows = np.concatenate([src, dst])
+	cols = np.concatenate([dst, src])
+	values = np.ones(len(rows), dtype=np.float32)
+	adjacency = sp.csr_matrix((values, (rows, cols)), shape=(node_count, node_count))
+	adjacency.data[:] = 1 #Collapse duplicate edges
+	adjacency.setdiag(0)
+	adjacency.eliminate_zeros()
+
+	return adjacency
+
+def score_block(adjacency, start, end, method, weighted=None):
+	'''Scores all node pairs for rows start to end of the adjacency
+	matrix, using sparse matrix products.
+	weighted is the adjacency matrix with rows scaled by
+	1/log(degree), needed for Adamic-Adar.
+	Returns a sparse matrix of scores, one row per node in the block.'''
+
+	block = adjacency[start:end]
+
+	if method == "common_neighbors":
+		scores = block @ adjacency
+	elif method == "adamic_adar":
+		scores = block @ weighted
+	else: #Katz, truncated to paths of up to KATZ_MAX_LENGTH steps
+		paths = block
+		scores = block * KATZ_BETA
+		for length in range(2, KATZ_MAX_LENGTH + 1):
+			paths = paths @ adjacency
+			scores = scores + paths * (KATZ_BETA ** length)
+
+	return sp.csr_matrix(scores)
+
+def top_candidates(scores, adjacency, start, k):
+	'''Finds the k highest-scoring candidate edges for each row
+	of a block of scores, skipping nodes' existing neighbours
+	and the nodes themselves.
+	Yields (source index, target index, score) tuples.'''
+
+	for row in range(scores.shape[0]):
+		node = start + row
+		row_start, row_end = scores.indptr[row], scores.indptr[row+1]
+		targets = scores.indices[row_start:row_end]
+		values = scores.data[row_start:row_end]
+
+		neighbors = adjacency.indices[adjacency.indptr[node]:adjacency.indptr[node+1]]
+		keep = (targets != node) & ~np.isin(targets, neighbors, assume_unique=True)
+		targets = targets[keep]
+		values = values[keep]
+
+		if len(values) > k:
+			best = np.argpartition(-values, k)[:k]
+			targets = targets[best]
+			values = values[best]
+		order = np.argsort(-values, kind="stable")
+		for i in order:
+			yield (node, targets[i], values[i])
+
+def predict_links(method="adamic_adar", k=TOP_K, block_size=BLOCK_SIZE,
+					source=None, outpath=INFERENCE_PATH):
+	'''Predicts missing relations in the graph.
+	Scores every pair of nodes that aren't already linked with
+	common neighbours, Adamic-Adar, or (truncated) Katz scores,
+	then writes the top k candidates for each node to
+	outpath/<method>-candidates.tsv, as source ID, target ID and score.
+	The graph is read from source (see get_graph_arrays()).
+	Scores are computed block_size rows at a time, so memory use
+	depends on the block size rather than the graph size.
+	Returns True if prediction completes without error.'''
+
+	status = False
+
+	if method not in LINK_METHODS:
+		print("Unknown link prediction method %s - use one of %s." % (method, ", ".join(LINK_METHODS)))
+		return status
+
+	try:
+		node_ids, src, dst = get_graph_arrays(source)
+	except (ValueError, neobolt.exceptions.ServiceUnavailable,
+			neobolt.exceptions.DatabaseError) as e:
+		print("Could not read the graph for link prediction: %s" % e)
+		return status
+	node_count = len(node_ids)
+	adjacency = build_adjacency(node_count, src, dst)
+
+	weighted = None
+	if method == "adamic_adar":
+		degrees = np.asarray(adjacency.sum(axis=1)).ravel()
+		weights = np.zeros(node_count, dtype=np.float32)
+		hubs = degrees > 1 #log(1) is 0, and such nodes can't be shared neighbours anyway
+		weights[hubs] = 1 / np.log(degrees[hubs])
+		weighted = sp.csr_matrix(adjacency.multiply(weights.reshape(-1, 1)))
+
+	print("Scoring candidate relations for %s nodes with %s..." % (node_count, method))
+	try:
+		outpath.mkdir(parents=True, exist_ok=True)
+		outfilepath = outpath / (method + "-candidates.tsv")
+		with outfilepath.open("w") as outfile:
+			pbar = tqdm(unit=" nodes", total=node_count)
+			for start in range(0, node_count, block_size):
+				end = min(start + block_size, node_count)
+				scores = score_block(adjacency, start, end, method, weighted)
+				for node, target, score in top_candidates(scores, adjacency, start, k):
+					outfile.write("%s\t%s\t%.6g\n" % (node_ids[node], node_ids[target], score))
+				pbar.update(end - start)
+			pbar.close()
+		print("Wrote candidate relations to %s" % outfilepath)
+		status = True
+	except IOError as e:
+		print("Encountered an error while writing candidate relations: %s" % e)
+
+	return status
+
+def load_eval_suite(suite):
+	'''Loads a test query suite: a JSON file with a name, optional
+	warmup and repeats counts, and a list of queries. Each query has a
+	name, a Cypher statement ("cypher"), optional "params", and an
+	"expect" object with one or more of:
+	"rows" - exactly these rows, in any order
+	"contains" - at least these rows
+	"count" / "min_count" - the "count" column of the first row
+	equals / is at least this value.
+	suite is a name of a suite in EVAL_SUITE_PATH or a path to one.
+	Returns a dict.'''
+
+	suitepath = Path(suite)
+	if not suitepath.exists():
+		suitepath = EVAL_SUITE_PATH / (str(suite) + ".json")
+	with suitepath.open() as suitefile:
+		return json.load(suitefile)
+
+def check_eval_result(rows, expect):
+	'''Compares the rows returned by a test query with what was expected.
+	Returns a list of strings describing failures; empty if it passed.'''
+
+	failures = []
+
+	def row_key(row):
+		return json.dumps(row, sort_keys=True, default=str)
+
+	returned = [row_key(row) for row in rows]
+	if "rows" in expect:
+		if sorted(returned) != sorted(row_key(row) for row in expect["rows"]):
+			failures.append("expected rows %s, got %s" % (expect["rows"], rows))
+	if "contains" in expect:
+		for row in expect["contains"]:
+			if row_key(row) not in returned:
+				failures.append("missing row %s" % row)
+	if "count" in expect or "min_count" in expect:
+		count = rows[0].get("count") if len(rows) > 0 else None
+		if count is None:
+			failures.append("no count returned")
+		elif "count" in expect and count != expect["count"]:
+			failures.append("expected count %s, got %s" % (expect["count"], count))
+		elif "min_count" in expect and count < expect["min_count"]:
+			failures.append("expected count of at least %s, got %s" % (expect["min_count"], count))
+
+	return failures
+
+def summarize_latencies(latencies):
+	'''Returns a dict of latency statistics, in milliseconds.'''
+
+	values = np.array(latencies) * 1000
+	return {"p50": float(np.percentile(values, 50)),
+			"p95": float(np.percentile(values, 95)),
+			"p99": float(np.percentile(values, 99)),
+			"mean": float(values.mean()),
+			"min": float(values.min()),
+			"max": float(values.max())}
+
+def run_eval_query(session, query, warmup, repeats):
+	'''Runs one test query warmup times untimed, then repeats times timed.
+	Checks the results of the last run.
+	Returns a dict of results.'''
+
+	result = {"name": query["name"], "passed": False}
+	params = query.get("params", {})
+
+	try:
+		for _ in range(warmup):
+			session.run(query["cypher"], params).data()
+		latencies = []
+		for _ in range(repeats):
+			start = time.perf_counter()
+			rows = session.run(query["cypher"], params).data()
+			latencies.append(time.perf_counter() - start)
+	except neobolt.exceptions.CypherError as e:
+		result["failures"] = ["query error: %s" % e]
+		return result
+
+	result["failures"] = check_eval_result(rows, query.get("expect", {}))
+	result["passed"] = len(result["failures"]) == 0
+	result["row_count"] = len(rows)
+	result["latency_ms"] = summarize_latencies(latencies)
+
+	return result
+
+def run_evaluation(suite, outpath=EVAL_RESULTS_PATH, backend=None):
+	'''Runs a suite of test queries against the graph DB
+	(see load_eval_suite()), checking each result and timing each query.
+	Test queries are Cypher, so they run through the given graph
+	backend, or the one set by GRAPH_BACKEND, only if it is neo4j.
+	Writes a report, including the graph generation it was run
+	against, to outpath/<suite>-<date and time>.json.
+	Returns the report as a dict, or None if the suite couldn't run.'''
+
+	if backend is None:
+		backend = tgraph.get_backend()
+	if backend.name != "neo4j":
+		print("Test query suites can only run on the neo4j graph backend, not %s." % backend.name)
+		return None
+
+	try:
+		suite_data = load_eval_suite(suite)
+	except (IOError, ValueError) as e:
+		print("Could not load test query suite %s: %s" % (suite, e))
+		return None
+
+	warmup = suite_data.get("warmup", EVAL_WARMUP)
+	repeats = max(suite_data.get("repeats", EVAL_REPEATS), 1)
+
+	report = {"suite": suite_data["name"],
+				"date": datetime.now().isoformat(timespec="seconds"),
+				"graph_generation": tcache.get_generation(),
+				"warmup": warmup, "repeats": repeats, "queries": []}
+
+	print("Running %s test queries from suite %s..." % (len(suite_data["queries"]), report["suite"]))
+	try:
+		with backend.get_driver().session() as session:
+			for query in suite_data["queries"]:
+				result = run_eval_query(session, query, warmup, repeats)
+				report["queries"].append(result)
+				if result["passed"]:
+					print("PASS %s (p50 %.1f ms, p95 %.1f ms, p99 %.1f ms)" % (result["name"],
+							result["latency_ms"]["p50"], result["latency_ms"]["p95"],
+							result["latency_ms"]["p99"]))
+				else:
+					print("FAIL %s: %s" % (result["name"], "; ".join(result["failures"])))
+	except neobolt.exceptions.ServiceUnavailable as e:
+		print("Could not run test query suite %s: %s" % (report["suite"], e))
+		return None
+
+	report["passed"] = sum(1 for result in report["queries"] if result["passed"])
+	report["failed"] = len(report["queries"]) - report["passed"]
+	print("%s passed, %s failed." % (report["passed"], report["failed"]))
+
+	outpath.mkdir(parents=True, exist_ok=True)
+	outfilepath = outpath / ("%s-%s.json" % (report["suite"],
+								datetime.now().strftime("%Y_%m_%d_%H_%M_%S")))
+	with outfilepath.open("w") as outfile:
+		json.dump(report, outfile, indent=2)
+	print("Wrote evaluation report to %s" % outfilepath)
+
+	return report
+
+def compare_evaluations(old_report, new_report, tolerance=LATENCY_TOLERANCE):
+	'''Compares two evaluation reports, e.g., from two graph builds.
+	Reports are dicts as returned by run_evaluation() or loaded
+	from its JSON output.
+	Returns a list of strings describing regressions: queries that
+	passed before but fail now, and queries whose p95 latency grew
+	by more than the tolerance ratio.'''
+
+	regressions = []
+
+	old_results = {result["name"]: result for result in old_report["queries"]}
+	for result in new_report["queries"]:
+		old_result = old_results.get(result["name"])
+		if old_result is None:
+			continue
+		if old_result["passed"] and not result["passed"]:
+			regressions.append("%s now fails: %s" % (result["name"], "; ".join(result["failures"])))
+		if "latency_ms" in old_result and "latency_ms" in result:
+			old_p95 = old_result["latency_ms"]["p95"]
+			new_p95 = result["latency_ms"]["p95"]
+			if old_p95 > 0 and new_p95 / old_p95 > tolerance:
+				regressions.append("%s p95 latency went from %.1f ms to %.1f ms" %
+									(result["name"], old_p95, new_p95))
+
+	return regressions
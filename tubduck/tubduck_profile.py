@@ -0,0 +1,123 @@
+#!/usr/bin/python
+#tubduck_profile.py
+'''
+Profiling for TUBDUCK.
+
+When enabled (see tubduck_core's --profile and --profile-memory options),
+each top-level step of a run is wrapped in step(), which writes to
+PROFILE_PATH/<date and time>/:
+<NN>-<step>.prof - cProfile output, for pstats, snakeviz and the like
+<NN>-<step>.txt - the TOP_N functions by cumulative and by own time
+<NN>-<step>-memory.txt - the TOP_N lines whose allocations grew the
+	most during the step (a tracemalloc snapshot diff) and its peak
+Steps are numbered in the order they ran.
+'''
+
+import cProfile
+from contextlib import contextmanager
+from datetime import datetime
+import io
+from pathlib import Path
+import pstats
+import tracemalloc
+
+## Constants
+PROFILE_PATH = Path('../working/profiles')
+
+TOP_N = 40 #Entries in each summary
+TRACE_FRAMES = 1 #Stack frames kept per allocation; more is slower
+
+settings = {"cpu": False, "memory": False, "top": TOP_N, "outpath": None, "count": 0}
+'''
+Profiling options for this run, set with configure().
+'''
+
+## Functions
+def configure(cpu=False, memory=False, top=TOP_N, outpath=PROFILE_PATH):
+	'''Turns CPU (cProfile) and/or memory (tracemalloc) profiling
+	on or off for the following steps. Each run writes to its own
+	directory under outpath.
+	Returns the Path profiles will be written to, or None if
+	profiling is off.'''
+
+	settings["cpu"] = cpu
+	settings["memory"] = memory
+	settings["top"] = top
+	settings["count"] = 0
+	settings["outpath"] = None
+
+	if cpu or memory:
+		settings["outpath"] = outpath / datetime.now().strftime("%Y_%m_%d_%H_%M_%S")
+		settings["outpath"].mkdir(parents=True, exist_ok=True)
+		if memory and not tracemalloc.is_tracing():
+			tracemalloc.start(TRACE_FRAMES)
+		print("Writing profiles to %s" % settings["outpath"])
+
+	return settings["outpath"]
+
+def write_cpu_summary(profiler, filepath, top):
+	'''Writes the top functions of a profile by cumulative
+	and by own time.'''
+
+	output = io.StringIO()
+	stats = pstats.Stats(profiler, stream=output)
+	stats.strip_dirs()
+	for sort_key, description in [("cumulative", "cumulative time"), ("tottime", "own time")]:
+		output.write("Top %s functions by %s\n" % (top, description))
+		stats.sort_stats(sort_key).print_stats(top)
+	filepath.write_text(output.getvalue())
+
+def write_memory_summary(before, after, peak, filepath, top):
+	'''Writes the lines whose allocations grew the most
+	between two tracemalloc snapshots.'''
+
+	ignore = [tracemalloc.Filter(False, tracemalloc.__file__),
+				tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+				tracemalloc.Filter(False, "<unknown>")]
+	differences = after.filter_traces(ignore).compare_to(before.filter_traces(ignore), "lineno")
+	lines = ["Peak traced memory during step: %.1f MiB" % (peak / 1048576),
+				"Change in traced memory: %+.1f MiB" % (sum(diff.size_diff for diff in differences) / 1048576),
+				"",
+				"Top %s lines by growth in allocated memory" % top]
+	for diff in differences[:top]:
+		lines.append(str(diff))
+	filepath.write_text("\n".join(lines) + "\n")
+
+@contextmanager
+def step(name):
+	'''Profiles a step of the run, as a context manager, if profiling
+	is on (see configure()). Profiles are written even if the step
+	exits early, e.g., through sys.exit().'''
+
+	if not (settings["cpu"] or settings["memory"]):
+		yield
+		return
+
+	settings["count"] = settings["count"] + 1
+	prefix = settings["outpath"] / ("%02d-%s" % (settings["count"], name))
+	top = settings["top"]
+
+	profiler = None
+	if settings["memory"]:
+		if hasattr(tracemalloc, "reset_peak"):
+			tracemalloc.reset_peak()
+		else: #Before Python 3.9, restarting is the only way to reset the peak
+			frames = tracemalloc.get_traceback_limit()
+			tracemalloc.stop()
+			tracemalloc.start(frames)
+		before = tracemalloc.take_snapshot()
+	if settings["cpu"]:
+		profiler = cProfile.Profile()
+		profiler.enable()
+
+	try:
+		yield
+	finally:
+		if profiler is not None:
+			profiler.disable()
+			profiler.dump_stats(str(prefix) + ".prof")
+			write_cpu_summary(profiler, Path(str(prefix) + ".txt"), top)
+		if settings["memory"]:
+			peak = tracemalloc.get_traced_memory()[1]
+			after = tracemalloc.take_snapshot()
+			write_memory_summary(before, after, peak, Path(str(prefix) + "-memory.txt"), top)
@@ -0,0 +1,192 @@
+#!/usr/bin/python
+#tubduck_schedule.py
+'''
+Pipeline scheduling for TUBDUCK.
+
+A Scheduler runs stages of a pipeline (functions, with arguments)
+as soon as the stages they depend on have finished, so independent
+stages overlap, e.g., document ingestion runs while KBs are
+processed and loaded. Stages run on a thread pool, or on a process
+pool for CPU-bound stages that can be pickled. Worker processes are
+spawned rather than forked, as forking while stages run on threads
+(e.g., holding Neo4j or SQLite locks) can leave the children
+deadlocked. Each stage may belong
+to a group with a concurrency limit, e.g., so only one stage writes
+to the graph DB at a time.
+
+A stage fails if it raises an exception or returns False. Stages
+depending on a failed stage, directly or not, are skipped; all
+others still run.
+'''
+
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+import multiprocessing
+import os
+import time
+import traceback
+
+import tubduck_metrics as tmetrics
+
+## Constants
+GROUP_LIMITS = {"download": 4, #Concurrent downloads
+				"process": os.cpu_count() or 1, #Concurrent KB processing
+				"graph": 1} #Concurrent graph DB writers
+'''
+Default concurrency limits for stage groups.
+Stages without a group are only limited by the number of workers.
+'''
+
+## Functions
+def run_in_process(func, args):
+	'''Runs a stage function in a worker process, recording its
+	metrics in a run of its own (see tubduck_metrics).
+	Returns a tuple of the function's result and its metric stages,
+	so they can be added to the main process's run.'''
+
+	tmetrics.start_run()
+	result = func(*args)
+
+	return (result, tmetrics.get_run()["stages"])
+
+## Classes
+class Scheduler:
+	'''Runs a set of stages with declared dependencies.
+	workers is the number of threads (and processes) to use;
+	1 runs stages one at a time, in dependency order.
+	If use_processes is False, stages meant for the process pool
+	run on threads instead.
+	context is an optional function returning a context manager
+	to enter around each stage run on a thread, given the stage
+	name, e.g., tubduck_profile.step.'''
+
+	def __init__(self, workers=None, use_processes=True, limits=None, context=None):
+		self.workers = workers or min(32, (os.cpu_count() or 1) + 4)
+		self.use_processes = use_processes
+		self.limits = dict(GROUP_LIMITS)
+		if limits:
+			self.limits.update(limits)
+		self.context = context
+		self.stages = {} #Keyed by name, in the order added
+
+	def add(self, name, func, args=(), deps=(), group=None, pool="thread"):
+		'''Adds a stage. func is called with args once every stage
+		named in deps has finished. pool is "thread" or "process";
+		functions run on the process pool must be defined at the top
+		level of a module, and their arguments must be picklable.
+		Returns the name, for use in later stages' deps.
+		Raises ValueError for duplicate names.'''
+
+		if name in self.stages:
+			raise ValueError("Stage %s was already added." % name)
+		self.stages[name] = {"func": func, "args": tuple(args), "deps": list(deps),
+								"group": group, "pool": pool}
+
+		return name
+
+	def has_stage(self, name):
+		return name in self.stages
+
+	def check(self):
+		'''Checks that every dependency is a stage and that there
+		are no cycles. Returns stage names in an order that
+		satisfies all dependencies. Raises ValueError otherwise.'''
+
+		for name, stage in self.stages.items():
+			for dep in stage["deps"]:
+				if dep not in self.stages:
+					raise ValueError("Stage %s depends on unknown stage %s." % (name, dep))
+
+		order = []
+		remaining = {name: set(stage["deps"]) for name, stage in self.stages.items()}
+		while len(remaining) > 0:
+			ready = [name for name, deps in remaining.items() if len(deps) == 0]
+			if len(ready) == 0:
+				raise ValueError("Stages %s depend on each other." % ", ".join(sorted(remaining)))
+			for name in ready:
+				order.append(name)
+				del remaining[name]
+			for deps in remaining.values():
+				deps.difference_update(ready)
+
+		return order
+
+	def run_stage(self, name):
+		'''Runs a stage on a thread, within the context if any.'''
+
+		stage = self.stages[name]
+		if self.context is None:
+			return stage["func"](*stage["args"])
+		with self.context(name):
+			return stage["func"](*stage["args"])
+
+	def run(self):
+		'''Runs all stages. Returns a dict of results keyed by stage
+		name, each a dict with a "status" ("done", "failed" or
+		"skipped"), the stage's return "value", and its "seconds".'''
+
+		order = self.check()
+		results = {}
+		waiting = list(order)
+		running = {} #Futures, with the name of the stage each runs
+		group_counts = {}
+
+		threads = ThreadPoolExecutor(max_workers=self.workers)
+		processes = None
+		if self.use_processes and any(stage["pool"] == "process" for stage in self.stages.values()):
+			processes = ProcessPoolExecutor(max_workers=self.workers,
+											mp_context=multiprocessing.get_context("spawn"))
+
+		try:
+			while len(waiting) > 0 or len(running) > 0:
+				for name in list(waiting):
+					stage = self.stages[name]
+					dep_statuses = [results[dep]["status"] for dep in stage["deps"] if dep in results]
+					if any(status != "done" for status in dep_statuses):
+						failed = [dep for dep in stage["deps"]
+									if dep in results and results[dep]["status"] != "done"]
+						print("Skipping %s as %s did not complete." % (name, ", ".join(failed)))
+						results[name] = {"status": "skipped", "value": None, "seconds": 0}
+						waiting.remove(name)
+						continue
+					if len(dep_statuses) < len(stage["deps"]):
+						continue #Still waiting on dependencies
+					group = stage["group"]
+					if group in self.limits and group_counts.get(group, 0) >= self.limits[group]:
+						continue
+					if len(running) >= self.workers:
+						break
+
+					if stage["pool"] == "process" and processes is not None:
+						future = processes.submit(run_in_process, stage["func"], stage["args"])
+					else:
+						future = threads.submit(self.run_stage, name)
+					running[future] = (name, time.perf_counter())
+					group_counts[group] = group_counts.get(group, 0) + 1
+					waiting.remove(name)
+
+				if len(running) == 0:
+					continue #Anything left was skipped
+				done, _ = wait(list(running), return_when=FIRST_COMPLETED)
+				for future in done:
+					name, start = running.pop(future)
+					stage = self.stages[name]
+					group_counts[stage["group"]] = group_counts[stage["group"]] - 1
+					result = {"seconds": round(time.perf_counter() - start, 4), "value": None}
+					try:
+						value = future.result()
+						if stage["pool"] == "process" and processes is not None:
+							value, stage_metrics = value
+							tmetrics.get_run()["stages"].extend(stage_metrics)
+						result["value"] = value
+						result["status"] = "failed" if value is False else "done"
+					except Exception as e:
+						print("Stage %s failed: %s" % (name, e))
+						traceback.print_exc()
+						result["status"] = "failed"
+					results[name] = result
+		finally:
+			threads.shutdown()
+			if processes is not None:
+				processes.shutdown()
+
+		return results
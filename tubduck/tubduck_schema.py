@@ -0,0 +1,152 @@
+#!/usr/bin/python
+#tubduck_schema.py
+'''
+Schema-driven graph DB provisioning for TUBDUCK.
+
+Reads the classes and slots of the data model in schemas/schema.yaml
+and, before any bulk writes, sets up the graph DB for each node label
+TUBDUCK writes: a uniqueness constraint on the identifier slot,
+property indexes on slots used for exact lookups (names, synonyms and
+descriptions, which hold ICD codes), and a full-text index on slots
+holding text. The graph backend waits for all of them to come online
+before returning (see tubduck_graph).
+
+A class's node properties are the slots it or its ancestors (is_a)
+list, or which have it or an ancestor as their domain, and which are
+node properties (is_a node property) rather than relations.
+Slot names become property names in camel case, e.g., "full name"
+is fullName, and class names become labels, e.g., "named thing" is
+NamedThing.
+'''
+
+from pathlib import Path
+
+import yaml
+
+## Constants
+SCHEMA_PATH = Path(__file__).resolve().parent.parent / "schemas" / "schema.yaml" #Ships with the code
+
+GRAPH_LABELS = ["NamedThing", "Pathway", "Publication", "Case"]
+'''
+Labels of the nodes TUBDUCK writes, each the label of a schema class.
+'''
+
+INDEXED_RANGES = ["label type", "symbol type", "narrative text"]
+'''
+Ranges of slots given a property index, for lookups by value.
+'''
+
+TEXT_RANGES = ["label type", "narrative text"]
+'''
+Ranges of slots included in full-text indexes.
+'''
+
+NODE_PROPERTY = "node property" #Ancestor of all slots holding node properties
+
+INDEX_TIMEOUT = 300 #Seconds to wait for indexes to come online
+
+SCHEMA_LOADER = getattr(yaml, "CSafeLoader", yaml.SafeLoader) #LibYAML's is much faster, if present
+
+## Functions
+def read_schema(path=SCHEMA_PATH):
+	'''Reads the schema. Returns a dict.'''
+
+	with Path(path).open(encoding="utf-8") as schema_file:
+		return yaml.load(schema_file, Loader=SCHEMA_LOADER)
+
+def class_label(class_name):
+	'''Returns the node label for a schema class name.'''
+
+	return "".join(word.capitalize() for word in class_name.split())
+
+def slot_property(slot_name):
+	'''Returns the node property name for a schema slot name.'''
+
+	words = slot_name.split()
+	return words[0] + "".join(word.capitalize() for word in words[1:])
+
+def ancestors(items, name):
+	'''Returns list of the names of a class or slot and all of
+	its ancestors (is_a), starting with its own.'''
+
+	names = []
+	while name is not None and name not in names:
+		names.append(name)
+		name = (items.get(name) or {}).get("is_a")
+	return names
+
+def class_properties(schema, class_name):
+	'''Returns a dict of the node property slots of a class,
+	keyed by slot name.'''
+
+	classes = schema.get("classes", {})
+	slots = schema.get("slots", {})
+	class_names = ancestors(classes, class_name)
+
+	slot_names = []
+	for name in class_names:
+		definition = classes.get(name) or {}
+		slot_names.extend(definition.get("slots") or [])
+		slot_names.extend((definition.get("slot_usage") or {}).keys())
+	for name, definition in slots.items():
+		if definition and definition.get("domain") in class_names:
+			slot_names.append(name)
+
+	properties = {}
+	for name in slot_names:
+		if name in properties or name == NODE_PROPERTY:
+			continue
+		if NODE_PROPERTY in ancestors(slots, name):
+			properties[name] = slots.get(name) or {}
+
+	return properties
+
+def index_plan(schema, labels=GRAPH_LABELS):
+	'''Works out the constraints and indexes for each node label.
+	Returns a dict, keyed by label, of dicts with lists of property
+	names: "unique" for identifiers, "indexed" for property indexes
+	and "text" for the full-text index.
+	Raises ValueError for labels without a schema class.'''
+
+	class_names = {class_label(name): name for name in schema.get("classes", {})}
+	plan = {}
+
+	for label in labels:
+		if label not in class_names:
+			raise ValueError("No schema class for label %s." % label)
+		label_plan = {"unique": [], "indexed": [], "text": []}
+		for name, slot in class_properties(schema, class_names[label]).items():
+			prop = slot_property(name)
+			if slot.get("identifier"):
+				label_plan["unique"].append(prop)
+			elif slot.get("range") in INDEXED_RANGES:
+				label_plan["indexed"].append(prop)
+			if slot.get("range") in TEXT_RANGES:
+				label_plan["text"].append(prop)
+		plan[label] = label_plan
+
+	return plan
+
+def provision(backend, labels=GRAPH_LABELS, schema_path=SCHEMA_PATH, timeout=INDEX_TIMEOUT):
+	'''Creates the constraints and indexes for the given node labels
+	(see index_plan()) through a graph backend, then waits up to
+	timeout seconds for them to come online. Constraints and indexes
+	that already exist are left as they are.
+	Every label gets a unique ID, whether or not its schema class has
+	an identifier slot, as the backends write nodes by their IDs;
+	other identifiers are indexed.
+	Returns the plan.'''
+
+	plan = index_plan(read_schema(schema_path), labels)
+
+	print("Setting up graph DB constraints and indexes for %s..." % ", ".join(labels))
+	for label, label_plan in plan.items():
+		backend.ensure_index(label) #Nodes are keyed on their IDs
+		for prop in label_plan["unique"] + label_plan["indexed"]:
+			if prop != "id":
+				backend.ensure_property_index(label, prop)
+		if len(label_plan["text"]) > 0:
+			backend.ensure_fulltext_index(label, label_plan["text"])
+	backend.await_indexes(timeout)
+
+	return plan
@@ -0,0 +1,279 @@
+#!/usr/bin/python
+#tubduck_server.py
+'''
+Lookup service for TUBDUCK.
+
+A read-only HTTP service, served with Flask on BIND_HOST:BIND_PORT
+(see tubduck_settings), for looking up concepts in the graph DB and
+documents in the input database. All requests share the pooled driver
+of the neo4j graph backend (see tubduck_graph); the service can't run
+on the other backends. Responses are kept in a bounded LRU cache, and the batch
+endpoints take many IDs at once so clients don't need a request per ID.
+The cache is emptied whenever the graph generation changes
+(see tubduck_cache).
+
+Endpoints:
+GET  /concepts/<id>             One concept
+POST /concepts                  Many concepts: {"ids": [...]}
+GET  /concepts/<id>/parents     Concepts this one is a subclass of
+GET  /concepts/<id>/children    Concepts that are subclasses of this one
+GET  /search?name=...&limit=... Concepts with names containing a string
+GET  /documents/<pmid>          One document
+POST /documents                 Many documents: {"pmids": [...]}
+
+Run with: python3 tubduck_server.py
+'''
+
+from collections import OrderedDict
+import threading
+
+from flask import Flask, abort, jsonify, request
+
+import tubduck_cache as tcache
+import tubduck_docs as tdocs
+import tubduck_graph as tgraph
+import tubduck_output as toutput
+import tubduck_settings as tsettings
+
+## Constants
+CACHE_SIZE = 10000 #Maximum number of cached responses
+MAX_BATCH = 1000 #Maximum IDs per batch request
+SEARCH_LIMIT = 25 #Default maximum search results
+
+DOC_COLUMNS = ["PMID", "TI", "AB", "AU", "DP", "TA", "PT", "MH"]
+'''
+Document columns returned by the service.
+'''
+
+CONCEPT_STATEMENT = ("UNWIND $ids AS id "
+					"MATCH (a:%s {id: id}) "
+					"RETURN a")
+
+PARENT_STATEMENT = ("MATCH (a:%s {id: $id})-[:subclassOf]->(b) "
+					"RETURN b ORDER BY b.id")
+
+CHILD_STATEMENT = ("MATCH (a:%s {id: $id})<-[:subclassOf]-(b) "
+					"RETURN b ORDER BY b.id")
+
+SEARCH_STATEMENT = ("MATCH (a:NamedThing) WHERE toLower(a.name) CONTAINS $name "
+					"RETURN a ORDER BY size(a.name) LIMIT $limit "
+					"UNION "
+					"MATCH (a:Pathway) WHERE toLower(a.name) CONTAINS $name "
+					"RETURN a ORDER BY size(a.name) LIMIT $limit")
+
+app = Flask(__name__)
+
+driver_lock = threading.Lock()
+
+response_cache = OrderedDict()
+cache_lock = threading.Lock()
+cache_generation = None #Graph generation the cached responses are from
+
+## Functions
+def get_driver():
+	'''Returns the Neo4j driver shared by all requests: the graph
+	backend's, created on first use. The driver keeps a pool of
+	connections, so requests don't each open their own.'''
+
+	with driver_lock: #So concurrent first requests don't each create one
+		return tgraph.get_backend("neo4j").get_driver()
+
+@app.before_request
+def check_generation():
+	'''Drops all cached responses if the graph has changed
+	since they were cached. Called once per request.'''
+
+	global cache_generation
+	generation = tcache.get_generation()
+	with cache_lock:
+		if generation != cache_generation:
+			response_cache.clear()
+			cache_generation = generation
+
+def cache_get(key):
+	'''Returns a cached response, or None if it isn't cached.'''
+
+	with cache_lock:
+		if key not in response_cache:
+			return None
+		response_cache.move_to_end(key)
+		return response_cache[key]
+
+def cache_put(key, value):
+	'''Caches a response, dropping the least recently used
+	responses once there are more than CACHE_SIZE.'''
+
+	with cache_lock:
+		response_cache[key] = value
+		response_cache.move_to_end(key)
+		while len(response_cache) > CACHE_SIZE:
+			response_cache.popitem(last=False)
+
+def node_to_dict(node):
+	'''Converts a Neo4j node to a dict that can be sent as JSON.
+	Dates and other Neo4j types become strings.'''
+
+	values = {}
+	for key, value in dict(node).items():
+		if isinstance(value, (str, int, float, bool, list)) or value is None:
+			values[key] = value
+		else:
+			values[key] = str(value)
+
+	return values
+
+def lookup_concepts(concept_ids):
+	'''Looks up concept nodes by ID, querying only for IDs
+	that aren't already cached.
+	Returns a dict of concepts keyed by ID; IDs not found are left out.'''
+
+	concepts = {}
+	missing = {}
+
+	for concept_id in concept_ids:
+		cached = cache_get(("concept", concept_id))
+		if cached is not None:
+			concepts[concept_id] = cached
+		else:
+			label = toutput.concept_label(concept_id)
+			missing.setdefault(label, []).append(concept_id)
+
+	if len(missing) > 0:
+		with get_driver().session() as session:
+			for label, ids in missing.items():
+				for record in session.run(CONCEPT_STATEMENT % label, ids=ids):
+					concept = node_to_dict(record["a"])
+					concepts[concept["id"]] = concept
+					cache_put(("concept", concept["id"]), concept)
+
+	return concepts
+
+def lookup_related(concept_id, direction):
+	'''Looks up the parents or children of a concept.
+	direction is "parents" or "children".
+	Returns a list of concepts.'''
+
+	key = (direction, concept_id)
+	related = cache_get(key)
+	if related is None:
+		if direction == "parents":
+			statement = PARENT_STATEMENT
+		else:
+			statement = CHILD_STATEMENT
+		with get_driver().session() as session:
+			result = session.run(statement % toutput.concept_label(concept_id), id=concept_id)
+			related = [node_to_dict(record["b"]) for record in result]
+		cache_put(key, related)
+
+	return related
+
+def search_concepts(name, limit):
+	'''Finds concepts with names containing the given string,
+	ignoring case. Shorter names come first.
+	Returns a list of concepts.'''
+
+	key = ("search", name.lower(), limit)
+	found = cache_get(key)
+	if found is None:
+		with get_driver().session() as session:
+			result = session.run(SEARCH_STATEMENT, name=name.lower(), limit=limit)
+			found = [node_to_dict(record["a"]) for record in result]
+		found = sorted(found, key=lambda concept: len(concept.get("name") or ""))[:limit]
+		cache_put(key, found)
+
+	return found
+
+def lookup_docs(pmids):
+	'''Looks up documents in the input database by PMID,
+	reading only those that aren't already cached.
+	Returns a dict of documents keyed by PMID.'''
+
+	docs = {}
+	missing = []
+
+	for pmid in pmids:
+		cached = cache_get(("document", pmid))
+		if cached is not None:
+			docs[pmid] = cached
+		else:
+			missing.append(pmid)
+
+	if len(missing) > 0:
+		for pmid, doc in tdocs.get_docs_by_pmid(missing, DOC_COLUMNS).items():
+			docs[pmid] = doc
+			cache_put(("document", pmid), doc)
+
+	return docs
+
+def get_batch_ids(field):
+	'''Gets a list of IDs from the JSON body of a batch request.
+	Aborts with a 400 error if it's missing or too long.'''
+
+	body = request.get_json(silent=True) or {}
+	ids = body.get(field)
+	if not isinstance(ids, list):
+		abort(400, description="Expected a JSON object with a list of %s." % field)
+	if len(ids) > MAX_BATCH:
+		abort(400, description="At most %s %s may be requested at once." % (MAX_BATCH, field))
+
+	return [str(one_id) for one_id in ids]
+
+@app.route("/concepts/<path:concept_id>/parents")
+def concept_parents(concept_id):
+	return jsonify(lookup_related(concept_id, "parents"))
+
+@app.route("/concepts/<path:concept_id>/children")
+def concept_children(concept_id):
+	return jsonify(lookup_related(concept_id, "children"))
+
+@app.route("/concepts/<path:concept_id>")
+def concept(concept_id):
+	concepts = lookup_concepts([concept_id])
+	if concept_id not in concepts:
+		abort(404)
+	return jsonify(concepts[concept_id])
+
+@app.route("/concepts", methods=["POST"])
+def concepts():
+	return jsonify(lookup_concepts(get_batch_ids("ids")))
+
+@app.route("/search")
+def search():
+	name = request.args.get("name", "").strip()
+	if name == "":
+		abort(400, description="Expected a name to search for.")
+	limit = min(request.args.get("limit", SEARCH_LIMIT, type=int), MAX_BATCH)
+	if limit < 1:
+		abort(400, description="Expected a limit of at least 1.")
+	return jsonify(search_concepts(name, limit))
+
+@app.route("/documents/<pmid>")
+def document(pmid):
+	docs = lookup_docs([pmid])
+	if pmid not in docs:
+		abort(404)
+	return jsonify(docs[pmid])
+
+@app.route("/documents", methods=["POST"])
+def documents():
+	return jsonify(lookup_docs(get_batch_ids("pmids")))
+
+def serve():
+	'''Starts the lookup service on BIND_HOST:BIND_PORT, if the graph
+	backend set by GRAPH_BACKEND is neo4j.
+	Returns False if it can't be started.'''
+
+	backend = tgraph.get_backend()
+	if backend.name != "neo4j":
+		print("The lookup service can only run on the neo4j graph backend, not %s."
+				% backend.name)
+		return False
+
+	print("Serving TUBDUCK lookups at http://%s:%s/" % (tsettings.BIND_HOST, tsettings.BIND_PORT))
+	app.run(host=tsettings.BIND_HOST, port=tsettings.BIND_PORT,
+			debug=tsettings.DEBUG, threaded=True)
+
+	return True
+
+if __name__ == "__main__":
+	serve()
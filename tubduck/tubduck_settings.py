@@ -21,3 +21,6 @@ NEO4J_HOST = env('NEO4J_HOST', default='localhost')
 NEO4J_PORT = env.int('NEO4J_PORT', default=7687)
 NEO4J_USER = env('NEO4J_USER', default='neo4j')
 NEO4J_PASSWORD = env('NEO4J_PASSWORD', default='admin')
+GRAPH_BACKEND = env('GRAPH_BACKEND', default='neo4j')
+METRICS_TEXTFILE = env('METRICS_TEXTFILE', default='')
+SORT_RUN_SIZE = env.int('SORT_RUN_SIZE', default=1000000)
@@ -0,0 +1,103 @@
+#!/usr/bin/python
+#tubduck_sort.py
+'''
+External sorting for TUBDUCK.
+
+KB processing resolves each entry's parents by joining entries to
+relations. Rather than holding every entry in a dict, records are sorted with external_sort(), which keeps at most
+SORT_RUN_SIZE records in memory and writes each sorted run to a
+temporary file under SORT_PATH, then merges the runs. Sorted streams
+are joined with merge_join(), so memory use stays bounded however
+large the KB is.
+
+Records are lists of JSON-serializable values.
+'''
+
+import heapq
+from itertools import groupby
+import json
+from pathlib import Path
+import shutil
+import tempfile
+
+import tubduck_settings as tsettings
+
+## Constants
+SORT_PATH = Path('../working/sort')
+SORT_RUN_SIZE = tsettings.SORT_RUN_SIZE #Records held in memory while sorting
+
+## Functions
+def write_run(records, tmpdir, number):
+	'''Sorts records in memory and writes them, one JSON list
+	per line. Returns the Path of the run file.'''
+
+	records.sort()
+	runpath = Path(tmpdir) / ("run-%06d" % number)
+	with runpath.open("w") as runfile:
+		for record in records:
+			runfile.write(json.dumps(record) + "\n")
+
+	return runpath
+
+def read_run(runpath):
+	'''Yields the records in a run file.'''
+
+	with runpath.open() as runfile:
+		for line in runfile:
+			yield json.loads(line)
+
+def external_sort(records, run_size=None, sort_path=SORT_PATH):
+	'''Sorts an iterable of records, in the order of their values.
+	If there are more than run_size records (default SORT_RUN_SIZE),
+	they are sorted in runs of run_size, written to a temporary
+	directory under sort_path, and merged. The directory is removed
+	once all records have been read.
+	Yields records in sorted order.'''
+
+	if run_size is None:
+		run_size = SORT_RUN_SIZE
+
+	batch = []
+	tmpdir = None
+	runpaths = []
+	try:
+		for record in records:
+			batch.append(record)
+			if len(batch) >= run_size:
+				if tmpdir is None:
+					sort_path.mkdir(parents=True, exist_ok=True)
+					tmpdir = tempfile.mkdtemp(dir=str(sort_path))
+				runpaths.append(write_run(batch, tmpdir, len(runpaths)))
+				batch = []
+
+		batch.sort()
+		if len(runpaths) == 0: #Everything fit in memory
+			for record in batch:
+				yield record
+			return
+
+		runs = [read_run(runpath) for runpath in runpaths] + [iter(batch)]
+		for record in heapq.merge(*runs):
+			yield record
+	finally:
+		if tmpdir is not None:
+			shutil.rmtree(tmpdir, ignore_errors=True)
+
+def merge_join(left, right, left_key=0, right_key=0):
+	'''Joins two iterables of records, each sorted by its key field
+	(the index of the field to join on).
+	Yields a tuple of (key, left records, right records) for each key
+	in left, as in a left outer join; the list of right records is
+	empty where right has no records with that key.'''
+
+	right_groups = groupby(right, key=lambda record: record[right_key])
+	right_current = next(right_groups, None)
+
+	for key, left_records in groupby(left, key=lambda record: record[left_key]):
+		while right_current is not None and right_current[0] < key:
+			right_current = next(right_groups, None)
+		if right_current is not None and right_current[0] == key:
+			yield (key, list(left_records), list(right_current[1]))
+			right_current = next(right_groups, None)
+		else:
+			yield (key, list(left_records), [])
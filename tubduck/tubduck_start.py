@@ -16,8 +16,11 @@ import time
 #import resource #for raising open file limits as per Neo4j
 
 import ast
+from itertools import groupby, islice
+import json
+import re
 
-from bs4 import BeautifulSoup
+from lxml import etree
 
 from urllib.request import urlopen
 import urllib.error
@@ -28,20 +31,37 @@ from tqdm import *
 from neo4j import GraphDatabase
 import neobolt.exceptions
 
+import tubduck_cache as tcache
+import tubduck_graph as tgraph
 import tubduck_helpers as thelp
+import tubduck_mesh as tmesh
+import tubduck_metrics as tmetrics
+import tubduck_nodes as tnodes
+import tubduck_obo as tobo
+import tubduck_schedule as tschedule
+import tubduck_schema as tschema
 import tubduck_settings as tsettings
+import tubduck_sort as tsort
 
 ## Constants
-TOTAL_KBS = 4 #The total count of knowledge bases we'll use
+TOTAL_KBS = 5 #The total count of knowledge bases we'll use
 				#To be specified in more detail later
 WORKING_PATH = Path('../working')
 KB_PATH = Path('../working/kbs')
 KB_PROC_PATH = Path('../working/kbs/processed')
+CHECKPOINT_PATH = Path('../working/load-checkpoints.json')
+ENTRY_COUNTS_PATH = Path('../working/entry-counts')
 
-SERVER_LOC = 'http://127.0.0.1:5000/'
+ENTRY_ID = re.compile(rb"""'id': \[?(['"])(.*?)\1""")
+'''
+Matches the ID of an entry in a line of a processed KB file, whether
+a string or, for OBO terms, the first in a list.
+'''
+
+SERVER_LOC = "http://%s:%s/" % (tsettings.BIND_HOST, tsettings.BIND_PORT)
 
 KB_NAMES = {"don": "doid.obo",		
-				#"m19": "d2019.bin",  
+				"m19": "d2019.bin",
 				"i10": "icd10cm_tabular_2019.xml",
 				"i11": "simpletabulation.zip",
 				"reactome1": "ReactomePathways.txt", #Reactome uses two files
@@ -54,12 +74,36 @@ and the original, in some cases compressed, files
 as values.
 '''
 
+KB_LOCATIONS = {"don": ("http://ontologies.berkeleybop.org/","doid.obo"),
+				"m19": ("ftp://nlmpubs.nlm.nih.gov/online/mesh/MESH_FILES/asciimesh/","d2019.bin"),
+				"i10": ("ftp://ftp.cdc.gov/pub/Health_Statistics/NCHS/Publications/ICD10CM/2019/", "icd10cm_tabular_2019.xml"),
+				"i11": ("https://icd.who.int/browse11/Downloads/", "Download?fileName=simpletabulation.zip"),
+				"reactome1": ("https://reactome.org/download/current/","ReactomePathways.txt"),
+				"reactome2": ("https://reactome.org/download/current/","ReactomePathwaysRelation.txt")
+				}
+'''
+Remote locations of each knowledge base,
+as tuples of the base URL and the filename.
+'''
+
+OBO_KBS = ["don"]
+'''
+Knowledge bases in OBO format. Their processed entries hold
+lists of values for each tag.
+'''
+
 NEO4J_HOST=tsettings.NEO4J_HOST
 NEO4J_PORT=tsettings.NEO4J_PORT
 NEO4J_URI = "bolt://" + NEO4J_HOST + ":" + str(NEO4J_PORT)
 NEO4J_USER=tsettings.NEO4J_USER
 NEO4J_PASSWORD=tsettings.NEO4J_PASSWORD
 
+query_cache = tcache.QueryCache(persist_path=tcache.CACHE_DB_PATH)
+'''
+Cache for repeated graph DB reads. Stored on disk, so results carry
+over between runs until the graph is written to again.
+'''
+
 ## Functions
 def setup_checks(tasks):
 	'''Check to see which setup steps need to be completed.
@@ -108,50 +152,72 @@ def setup_checks(tasks):
 		gdb_vals = graphdb_stats()
 		if "empty_db" in tasks:
 			setup_list.append("empty graph DB")
-		if gdb_vals["rel_count"] < 2 and "empty_db" not in tasks:
+		incomplete = incomplete_loads()
+		if "resume" in tasks and len(incomplete) > 0 and "empty_db" not in tasks:
+			setup_list.append("resume populating graph DB")
+		elif gdb_vals["rel_count"] < 2 and "empty_db" not in tasks:
 			if "test_load_db" in tasks:
 				setup_list.append("populate graph DB as test")
 			else:
 				setup_list.append("populate graph DB")
+		elif len(incomplete) > 0 and "empty_db" not in tasks:
+			print("Graph DB population did not finish for: %s. "
+					"Use --resume to continue it." % ", ".join(incomplete))
+		elif "empty_db" not in tasks:
+			verified = verify_loads(gdb_vals)
+			partial = [kb for kb in verified if verified[kb]["status"] in ["partial", "missing"]]
+			if len(partial) > 0:
+				print("Graph DB is missing entries from: %s." %
+						", ".join("%s (%s of %s loaded)" % (kb, verified[kb]["loaded"],
+															verified[kb]["expected"])
+									for kb in partial))
 		
 	return setup_list
 	
-def setup(setup_to_do):
+def setup(setup_to_do, workers=None):
 	'''Main setup function. Calls other functions for some other tasks.
 		Takes list as input.
+		Independent tasks, e.g., retrieving and processing each KB,
+		run at once on up to workers threads (see tubduck_schedule).
 		Returns True if setup encounters no errors.'''
-		
-	setup_all = True #Default is to set up everything
-	status = True
-	kb_codes = KB_NAMES.keys() #Knowledge bases each get code
+	
+	scheduler = tschedule.Scheduler(workers=workers)
+	add_setup_stages(setup_to_do, scheduler)
+	results = scheduler.run()
+	
+	return all(result["status"] == "done" for result in results.values())
+
+def add_setup_stages(setup_to_do, scheduler):
+	'''Adds setup tasks to a Scheduler as stages, with the
+		dependencies between them: each KB is processed once its
+		files are retrieved, and the graph DB is populated once
+		all KBs are processed (and the DB emptied, if requested).
+		Takes list as input, as produced by setup_checks().
+		Returns list of the names of all stages added, so later
+		stages needing a complete setup can depend on them.'''
+	
+	kb_codes = list(KB_NAMES.keys()) #Knowledge bases each get code
 	kb_proc_codes = kb_codes
+	get_codes = []
+	stages = []
 	
 	if "working directory" in setup_to_do:
 		WORKING_PATH.mkdir(parents=True)
-		setup_all = True
 		
 	if "retrieve all knowledge bases" in setup_to_do:
-		KB_PATH.mkdir(parents=True)
-		if not get_kbs(kb_codes,KB_PATH):
-			print("Encountered errors while retrieving knowledge base files.")
-			status = False
+		KB_PATH.mkdir(parents=True, exist_ok=True)
+		get_codes = kb_codes
 		
 	if "retrieve some knowledge bases" in setup_to_do:
 		kb_files = [x.stem for x in KB_PATH.iterdir()]
-		need_kb_files = []
-		for kb in kb_codes:
-			if KB_NAMES[kb] not in kb_files:
-				need_kb_files.append(kb)
-		kb_codes = need_kb_files
-		if not get_kbs(kb_codes,KB_PATH):
-			print("Encountered errors while retrieving knowledge base files.")
-			status = False
+		get_codes = [kb for kb in kb_codes if KB_NAMES[kb] not in kb_files]
+	
+	for kb in get_codes:
+		stages.append(scheduler.add("download_%s" % kb, get_kbs, ([kb], KB_PATH),
+									group="download"))
 	
 	if "process all knowledge bases" in setup_to_do:
-		KB_PROC_PATH.mkdir(parents=True)
-		if not process_kbs(kb_proc_codes,KB_PATH,KB_PROC_PATH):
-			print("Encountered errors while processing knowledge base files.")
-			status = False
+		KB_PROC_PATH.mkdir(parents=True, exist_ok=True)
 	
 	if "process some knowledge bases" in setup_to_do:
 		kb_proc_files = [x.stem for x in KB_PROC_PATH.iterdir()]
@@ -162,28 +228,37 @@ def setup(setup_to_do):
 			if newfilename not in kb_proc_files:
 				need_kb_proc_files.append(kb)
 		kb_proc_codes = need_kb_proc_files
-		if not process_kbs(kb_proc_codes,KB_PATH,KB_PROC_PATH):
-			print("Encountered errors while processing knowledge base files.")
-			status = False
 	
+	process_stages = []
+	if "process all knowledge bases" in setup_to_do or "process some knowledge bases" in setup_to_do:
+		for kb in kb_proc_codes:
+			if kb == "reactome2": #Processed along with reactome1
+				continue
+			source_codes = [kb, "reactome2"] if kb == "reactome1" else [kb]
+			deps = ["download_%s" % code for code in source_codes if code in get_codes]
+			process_stages.append(scheduler.add("process_%s" % kb, process_kbs,
+												([kb], KB_PATH, KB_PROC_PATH), deps=deps,
+												group="process", pool="process"))
+	stages.extend(process_stages)
+	
+	graph_deps = list(stages) #Don't load anything while KBs may change
 	if "empty graph DB" in setup_to_do:
-		if not empty_graphdb():
-			print("Encountered errors while emptying graph database.")
-			status = False
+		graph_deps.append(scheduler.add("empty_graph", empty_graphdb, group="graph"))
+		stages.append("empty_graph")
 	
-	if "populate graph DB" in setup_to_do or "populate graph DB as test" in setup_to_do:
+	if "populate graph DB" in setup_to_do or "populate graph DB as test" in setup_to_do \
+		or "resume populating graph DB" in setup_to_do:
 		if "populate graph DB as test" in setup_to_do:
 			test_only = True
 		else:
 			test_only = False
-		if not populate_graphdb(test_only):
-			print("Encountered errors while populating graph database.")
-			status = False
-		if not crosslink_graphdb():
-			print("Encountered errors while adding cross-links to graph database.")
-			status = False
+		resume = "resume populating graph DB" in setup_to_do
+		stages.append(scheduler.add("populate_graph", populate_graphdb, (test_only, None, resume),
+									deps=graph_deps, group="graph"))
+		stages.append(scheduler.add("crosslink_graph", crosslink_graphdb,
+									deps=["populate_graph"], group="graph"))
 			
-	return status
+	return stages
 	
 def get_kbs(names, path):
 	'''Retrieves knowledge bases in their full form from various remote 
@@ -191,43 +266,36 @@ def get_kbs(names, path):
 	Takes a list of codes as input.
 	Also requires a Path where they will be written to.'''
 	
-	data_locations = {"don": ("http://ontologies.berkeleybop.org/","doid.obo"),
-					#"m19": ("ftp://nlmpubs.nlm.nih.gov/online/mesh/MESH_FILES/asciimesh/","d2019.bin"), 
-					"i10": ("ftp://ftp.cdc.gov/pub/Health_Statistics/NCHS/Publications/ICD10CM/2019/", "icd10cm_tabular_2019.xml"),
-					"i11": ("https://icd.who.int/browse11/Downloads/", "Download?fileName=simpletabulation.zip"),
-					"reactome1": ("https://reactome.org/download/current/","ReactomePathways.txt"),
-					"reactome2": ("https://reactome.org/download/current/","ReactomePathwaysRelation.txt")
-					}
-	
 	filenames = []
 	status = True #Becomes False upon encountering error
 	
 	for name in names:
-		baseURL, filename = data_locations[name]
-		filepath = baseURL + filename
-		if name in ["i11"]:	#ICD-11 has a specific access procedure for now
-			outfilepath = path / (filename.split("="))[1]
-		else:
-			outfilepath = path / filename
+		with tmetrics.stage("download", kb=name):
+			baseURL, filename = KB_LOCATIONS[name]
+			filepath = baseURL + filename
+			if name in ["i11"]:	#ICD-11 has a specific access procedure for now
+				outfilepath = path / (filename.split("="))[1]
+			else:
+				outfilepath = path / filename
 		
-		print("Downloading from %s" % filepath)
-		try:
-			response = urlopen(filepath)
-			out_file = outfilepath.open("w+b")
-			chunk = 1048576
-			pbar = tqdm(unit="Mb")
-			while 1:
-				data = (response.read(chunk)) #Read one Mb at a time
-				out_file.write(data)
-				if not data:
-					pbar.close()
-					#print("\n%s file download complete." % filename)
-					out_file.close()
-					break
-				pbar.update(1)
-		except urllib.error.URLError as e:
-			print("Encountered an error while downloading %s: %s" % (filename, e))
-			status = False
+			print("Downloading from %s" % filepath)
+			try:
+				response = urlopen(filepath)
+				out_file = outfilepath.open("w+b")
+				chunk = 1048576
+				pbar = tqdm(unit="Mb")
+				while 1:
+					data = (response.read(chunk)) #Read one Mb at a time
+					out_file.write(data)
+					if not data:
+						pbar.close()
+						#print("\n%s file download complete." % filename)
+						out_file.close()
+						break
+					pbar.update(1)
+			except urllib.error.URLError as e:
+				print("Encountered an error while downloading %s: %s" % (filename, e))
+				status = False
 			
 	return status
 	
@@ -240,123 +308,265 @@ def process_kbs(names, inpath, outpath):
 	status = True
 	
 	#Processing methods are KB-specific as formats vary
+	processors = {"don": process_diseaseontology,
+					"m19": process_mesh,
+					"i10": process_icd10cm,
+					"i11": process_icd11mms,
+					"reactome1": process_reactome} #Reactome uses two files; just process one
+	
 	for name in names:
-		if name == "don":
-			if process_diseaseontology(KB_NAMES[name], inpath, outpath):
-				pass
-			else:
-				status = False
-		# if name == "m19":
-			# if process_mesh(KB_NAMES[name], inpath, outpath):
-				# pass
-			# else:
-				# status = False
-		if name == "i10":
-			if process_icd10cm(KB_NAMES[name], inpath, outpath):
-				pass
-			else:
-				status = False
-		if name == "i11":
-			if process_icd11mms(KB_NAMES[name], inpath, outpath):
-				pass
-			else:
+		if name not in processors:
+			continue
+		process = processors[name]
+		with tmetrics.stage(process.__name__, kb=name):
+			if not process(KB_NAMES[name], inpath, outpath):
 				status = False
-		if name == "reactome1": #Reactome uses two files; just process one
-			if process_reactome(KB_NAMES[name], inpath, outpath):
-				pass
-			else:
-				status = False
-		else:
-			pass
+			outfilepath = outpath / (KB_NAMES[name].split(".")[0] + "-proc")
+			if outfilepath.exists():
+				with outfilepath.open() as outfile:
+					tmetrics.add(records_out=sum(1 for line in outfile))
+				record_entry_count(name, outfilepath)
 	
 	return status
 
 def process_diseaseontology(infilename, inpath, outpath):
 	'''Processes the Disease Ontology into relationship format.
-	Takes input from process_kbs.'''
+	Takes input from process_kbs.
+	Works for any ontology in OBO format (see tubduck_obo).
+	Each non-obsolete term is written with all of its tags, with
+	comments and trailing modifiers removed. All terms, relations
+	and other tag values are also written as column-oriented tables,
+	to outpath/<name>-columns/.'''
 	
 	status = True
 	
 	infilepath = inpath / infilename
 	newfilename = (str(infilename.split(".")[0])) + "-proc"
 	outfilepath = outpath / newfilename
+	columnpath = outpath / ((str(infilename.split(".")[0])) + "-columns")
 	print("Processing %s." % infilename)
 	try:
-		pbar = tqdm(unit=" lines")
-		with infilepath.open() as infile:
-			with outfilepath.open("w") as outfile:
-				entry = {}
-				for line in infile:
-					text = line.strip().split(":",1)
-					if text == ["[Term]"]: #start new entry for term
-						if len(entry.keys()) > 0: #If we have a previous entry, write it
-							outfile.write(str(entry) + "\n")
-						entry = {}
-					if text[0] in ["id","name","alt_id","def","subset","synonym","xref","is_a"]:
-						if text[0] in entry.keys(): #Have it already
-							entry[text[0]].append(text[1].strip())
-						else:
-							entry[text[0]] = [text[1].strip()]
-					if text == ["[Typedef]"]: #Don't do anything with these yet
-						if len(entry.keys()) > 0: #Write the last entry
-							outfile.write(str(entry) + "\n")
-						entry = {}
+		pbar = tqdm(unit=" stanzas")
+		with outfilepath.open("w") as outfile:
+			
+			def write_terms(stanzas):
+				'''Writes each term as it passes through.'''
+				for stanza_type, tags, modifiers in stanzas:
+					if stanza_type == "Term" and "id" in tags and not tobo.is_obsolete(tags):
+						outfile.write(str(tags) + "\n")
 					pbar.update(1)
+					yield (stanza_type, tags, modifiers)
+			
+			tobo.write_columns(tobo.iter_tables(write_terms(tobo.iter_stanzas(infilepath))),
+								columnpath)
 				
+		tmetrics.add(records_in=pbar.n)
 		pbar.close()
-	except IOError as e:
+	except (IOError, UnicodeDecodeError) as e:
 		print("Encountered an error while processing %s: %s" % (infilename, e))
 		status = False
 
 	return status
 
-# def process_mesh(infilename, inpath, outpath):
-	# '''Processes MeSH into relationship format.
-	# Takes input from process_kbs.'''
-	
-	# status = True
-	
-	# infilepath = inpath / infilename
-	# newfilename = (str(infilename.split(".")[0])) + "-proc"
-	# outfilepath = outpath / newfilename
-	# print("Processing %s." % infilename)
-	# try:
-		# pbar = tqdm(unit=" lines")
-		# with infilepath.open() as infile:
-			# with outfilepath.open("w") as outfile:
-				# entry = {}
-				# for line in infile:
-					# text = line.strip().split("=",1)
-					# if text == ["*NEWRECORD"]: #start new entry for term
-						# if len(entry.keys()) > 0: #If we have a previous entry, write it
-							# outfile.write(str(entry) + "\n")
-						# entry = {}
-					# if text[0].strip() in ["RECTYPE","MH","AQ","ENTRY","MN","PA","UI"]:
-						# if text[0].strip() in entry.keys(): #Have it already
-							# entry[text[0].strip()].append(text[1].strip())
-						# else:
-							# if text[0].strip() in ["UI"]: #Gotta add prefix for UI
-								# entry[text[0].strip()] = ["MESH:" + text[1].strip()]
-							# else:	
-								# entry[text[0].strip()] = [text[1].strip()]
-					# pbar.update(1)
-				# if len(entry.keys()) > 0: #Write the last entry
-					# outfile.write(str(entry) + "\n")
-					
-		# pbar.close()
-	# except IOError as e:
-		# print("Encountered an error while processing %s: %s" % (infilename, e))
-		# status = False
+def process_mesh(infilename, inpath, outpath):
+	'''Processes MeSH descriptors into relationship format.
+	Takes input from process_kbs.
+	The input file is the ASCII release, read as a stream (see
+	tubduck_mesh). A first pass indexes descriptors by tree number
+	and name; the second writes each descriptor as it is read,
+	with its parents (is_a) from the tree numbers above its own
+	and its pharmacological actions (pa), as lists of IDs.'''
+	
+	status = True
+	
+	infilepath = inpath / infilename
+	newfilename = (str(infilename.split(".")[0])) + "-proc"
+	outfilepath = outpath / newfilename
+	print("Processing %s." % infilename)
+	try:
+		tree_ids, name_ids = tmesh.build_index(infilepath)
+		print("Indexed %s tree numbers." % len(tree_ids))
+		
+		pbar = tqdm(unit=" records")
+		with outfilepath.open("w") as outfile:
+			for record in tmesh.iter_records(infilepath):
+				pbar.update(1)
+				if not tmesh.is_descriptor(record) or "MH" not in record:
+					continue
+				entry = tmesh.descriptor_entry(record, tree_ids, name_ids)
+				outfile.write(str(entry) + "\n")
+				
+		tmetrics.add(records_in=pbar.n)
+		pbar.close()
+	except (IOError, UnicodeDecodeError) as e:
+		print("Encountered an error while processing %s: %s" % (infilename, e))
+		status = False
 
-	# return status
+	return status
 	
+def drop_finished(element):
+	'''Clears a diag or section element of the ICD-10-CM tabular
+	XML once its end has been parsed, and removes any finished diag
+	and section elements before it, so the tree doesn't grow as the
+	file is read. Other siblings are kept, as the name of a diag is
+	read when each of its children is parsed.'''
+	
+	element.clear(keep_tail=True)
+	parent = element.getparent()
+	if parent is not None:
+		for sibling in list(element.itersiblings(preceding=True)):
+			if sibling.tag in ["diag", "section"]:
+				parent.remove(sibling)
+
+def icd10cm_nodes(infilepath, pbar, max_rows=None):
+	'''Parses the ICD-10-CM tabular XML file incrementally.
+	Returns a NodeTable (see tubduck_nodes) with a node for each code,
+	and for each section heading above the top-level codes, in the
+	order they were first seen. Codes are numbered in document order.
+	As codes are nested in their parents, each code's parent is the
+	node of the enclosing diag, or of the section heading.
+	Returns None instead if the table would have more than max_rows
+	nodes, so larger files can be processed with icd10cm_records().'''
+	
+	nodes = tnodes.NodeTable()
+	headings = {} #Rows of section headings, by their titles
+	diag_rows = [] #Rows of the diags enclosing the current one
+	uri_inc = 0
+	
+	for event, element in etree.iterparse(str(infilepath), events=("start", "end"),
+											tag=("desc", "diag", "section")):
+		if element.tag == "diag":
+			if event == "start":
+				diag_rows.append(tnodes.NO_PARENT)
+			else:
+				diag_rows.pop()
+				drop_finished(element) #Children were already seen
+			continue
+		if event == "start":
+			continue
+		if element.tag == "section":
+			drop_finished(element)
+			continue
+		diag = element.getparent()
+		if diag.tag != "diag":
+			continue
+		
+		uri_prefix = "ICD10CM:"
+		uri_number = uri_inc
+		uri_inc = uri_inc+1
+		
+		code = diag[0].text
+		title = diag[1].text
+		parent_code = diag.getparent()[0].text
+		
+		if diag.getparent().tag == "diag":
+			parent = diag_rows[-2]
+		#The parent may be a section heading rather than a code,
+		#but we'd like to capture those, too, so we do that here
+		#It is its own parent for convenience
+		elif len(parent_code) > 7: #Codes are < 7 chars in ICD-10
+			uri_prefix = "i10-"
+			uri_number = uri_inc
+			uri_inc = uri_inc+1
+			
+			parent = headings.get(parent_code)
+			if parent is None:
+				parent = nodes.add(uri_prefix, uri_number, "NA", title)
+				headings[parent_code] = parent
+			nodes.update(parent, uri_prefix, uri_number, title, parent)
+		else:
+			parent = tnodes.NO_PARENT
+		
+		diag_rows[-1] = nodes.add(uri_prefix, uri_number, code, title, parent=parent)
+		if max_rows is not None and len(nodes) > max_rows:
+			return None
+		
+		pbar.update(1)
+	
+	return nodes
+
+def icd10cm_records(infilepath, pbar):
+	'''Parses the ICD-10-CM tabular XML file incrementally, holding
+	nothing per code, for files too large for icd10cm_nodes().
+	Yields a record for each code, and for the section heading above
+	each top-level code, as [code, sequence number, uri, code,
+	title, parent code]. Codes are numbered in document order.'''
+	
+	uri_inc = 0
+	seq = 0
+	
+	for event, element in etree.iterparse(str(infilepath), events=("end",),
+											tag=("desc", "diag", "section")):
+		if element.tag in ["diag", "section"]: #Children were already seen
+			drop_finished(element)
+			continue
+		diag = element.getparent()
+		if diag.tag != "diag":
+			continue
+		
+		uri = "ICD10CM:" + str(uri_inc)
+		uri_inc = uri_inc+1
+		
+		code = diag[0].text
+		title = diag[1].text
+		parent_code = diag.getparent()[0].text
+		
+		#As in icd10cm_nodes(), section headings get entries too
+		if len(parent_code) > 7: #Codes are < 7 chars in ICD-10
+			uri = "i10-" + str(uri_inc)
+			uri_inc = uri_inc+1
+			
+			yield [parent_code, seq, uri, "NA", title, parent_code] #parent is a code
+			seq = seq+1
+		
+		yield [code, seq, uri, code, title, parent_code] #parent is a code
+		seq = seq+1
+		
+		pbar.update(1)
+
+def write_icd10cm_sorted(infilepath, outfile, pbar):
+	'''Writes processed ICD-10-CM entries from icd10cm_records(),
+	resolving parents with external sorts (see tubduck_sort), so
+	memory use doesn't grow with the number of codes: codes are sorted
+	to keep the last entry for each, then sorted again along with
+	their children, so each code comes just before its children.'''
+	
+	def join_records():
+		'''Yields [code, 0, uri] for each code, as a parent,
+		and [parent code, 1, uri, code, title] for each code,
+		as a child.'''
+		records = tsort.external_sort(icd10cm_records(infilepath, pbar))
+		for code, code_records in groupby(records, key=lambda record: record[0]):
+			for record in code_records: #Later entries replace earlier ones
+				pass
+			_, _, uri, codeA, title, parent_code = record
+			yield [code, 0, uri]
+			if parent_code != "None":
+				yield [parent_code, 1, uri, codeA, title]
+	
+	for code, records in groupby(tsort.external_sort(join_records()),
+									key=lambda record: record[0]):
+		uriB = None
+		for record in records:
+			if record[1] == 0:
+				uriB = record[2]
+			elif uriB is not None: #Parents without entries are skipped
+				_, _, uriA, codeA, titleA = record
+				entry = {'id':uriA, 'name':titleA, 'code':codeA, 'is_a':uriB}
+				outfile.write(str(entry) + "\n")
+
 def process_icd10cm(infilename, inpath, outpath):
 	'''Processes 2019 release of ICD-10-CM into relationship format.
 	Takes input from process_kbs.
 	The input file is the "tabular" version in XML format.
 	Uses the hierarchy to form is_a relations.
 	ICD-10 codes don't come with unique identifiers so we generate one,
-	prefixed with the KB's code.'''
+	prefixed with the KB's code.
+	Codes are held in a NodeTable (see icd10cm_nodes()) unless there
+	are more than SORT_RUN_SIZE of them; then the file is parsed again
+	and parents are resolved with external sorts instead (see
+	write_icd10cm_sorted()), so memory use stays bounded. Entries are
+	the same either way, but come in a different order.'''
 	
 	status = True
 	
@@ -366,61 +576,28 @@ def process_icd10cm(infilename, inpath, outpath):
 	print("Processing %s." % infilename)
 	try:
 		pbar = tqdm(unit=" entries")
-		with infilepath.open() as infile:
-			contents = infile.read()
-			soup = BeautifulSoup(contents,'xml')
-			diags = soup.find_all('diag')
-			
-			uri_inc = 0
-			all_nodes = {}
-			
-			for diag in diags:
-				
-				uri = "ICD10CM:" + str(uri_inc)
-				uri_inc = uri_inc+1
-				
-				cont = diag.contents
-				code = (cont[1].contents)[0]
-				title = (cont[3].contents)[0]
-				
-				parent_diag = diag.parent
-				parent_cont = parent_diag.contents
-				parent_code = (parent_cont[1].contents)[0]
-				
-				#The parent may be a section heading rather than a code,
-				#but we'd like to capture those, too, so we do that here
-				#It is its own parent for convenience
-				if len(parent_code) > 7: #Codes are < 7 chars in ICD-10
-					uri = "i10-" + str(uri_inc)
-					uri_inc = uri_inc+1
-					
-					all_nodes[parent_code] = {"uri":uri,"code":"NA","title":title,
-										"parent":parent_code} #parent is a code
-					
-				
-				all_nodes[code] = {"uri":uri,"code":code,"title":title,
-										"parent":parent_code} #parent is a code
-				
-				pbar.update(1)
+		nodes = icd10cm_nodes(infilepath, pbar, tsort.SORT_RUN_SIZE)
 		
 		#Now write
 		with outfilepath.open("w") as outfile:
-			for node in all_nodes:
-				parent_id = all_nodes[node]["parent"]
-				uriA = all_nodes[node]["uri"]
-				codeA = all_nodes[node]["code"]
-				titleA = all_nodes[node]["title"]
-					
-				if parent_id == "None":
-					pass
-				else:
-					uriB = all_nodes[parent_id]["uri"]
-					
-					entry = {'id':uriA, 'name':titleA, 'code':codeA, 'is_a':uriB}
-					outfile.write(str(entry) + "\n")
+			if nodes is None:
+				pbar.close()
+				print("More than %s codes - sorting them on disk." % tsort.SORT_RUN_SIZE)
+				pbar = tqdm(unit=" entries")
+				write_icd10cm_sorted(infilepath, outfile, pbar)
+			else:
+				for node in nodes:
+					if node.parent == tnodes.NO_PARENT:
+						pass
+					else:
+						uriB = nodes.uri(node.parent)
+						
+						entry = {'id':node.uri, 'name':node.title, 'code':node.code, 'is_a':uriB}
+						outfile.write(str(entry) + "\n")
 				
+		tmetrics.add(records_in=pbar.n)
 		pbar.close()
-	except IOError as e:
+	except (IOError, etree.XMLSyntaxError) as e:
 		print("Encountered an error while processing %s: %s" % (infilename, e))
 		status = False
 
@@ -432,6 +609,8 @@ def process_icd11mms(infilename, inpath, outpath):
 	The input file is a ZIP-compressed XLSX file.
 	Converts to triple form.
 	Uses the hierarchy to form is_a relations.
+	Each entry's parent is the most recent entry one level up,
+	so entries are written as they are read.
 	'''
 	
 	status = True
@@ -452,18 +631,13 @@ def process_icd11mms(infilename, inpath, outpath):
 	thelp.convert_xlsx_to_tsv(midfilepath, tabfilepath)
 	
 	try:
-		with tabfilepath.open() as infile:
+		with tabfilepath.open() as infile, outfilepath.open("w") as outfile:
 			pbar = tqdm(unit=" entries")
 			infile.readline() #Skip the header
 		
-			all_nodes = {}
-		
-			node_count = -1
-			previous_level = 0
-			most_recent_id_at_level = {} #levels are keys, node_count is value
+			most_recent_uri_at_level = {} #levels are keys, uri is value
 			
 			for line in infile:
-				node_count = node_count +1
 				
 				splitline = line.split("\t")
 				
@@ -475,7 +649,6 @@ def process_icd11mms(infilename, inpath, outpath):
 					
 				cleanuri = "ICD11MMS:" + cleanuri
 				
-				chapterno = splitline[9]
 				code = splitline[2]
 				title = splitline[4]
 				
@@ -492,52 +665,22 @@ def process_icd11mms(infilename, inpath, outpath):
 						cleantitle = cleantitle + char
 						
 				cleantitle = cleantitle.lstrip()
-				code_and_title = [code,cleantitle]
 				
 				#Now let's figure out what the parent is.
-				#Keep track of the node_count of the previous level was
-				if level == 0:
-					parent = "None"
-				else:
-					parent = most_recent_id_at_level[level - 1]
-				
-				all_nodes[node_count] = {"uri":cleanuri,"code":code,"title":cleantitle,
-								"chapter":chapterno,"parent":parent} #parent is a node_count
-				
-				previous_level = level
-				
-				most_recent_id_at_level[level] = node_count
-				
-				pbar.update(1)
-			
-		#Now write
-		with outfilepath.open("w") as outfile:
-			for node in all_nodes:
-				parent_id = all_nodes[node]["parent"]
-				uriA = all_nodes[node]["uri"]
-				codeA = all_nodes[node]["code"]
-				titleA = all_nodes[node]["title"]
-				chapterA = all_nodes[node]["chapter"]
-					
-				if parent_id == "None":
-					pass
-				else:
-					uriB = all_nodes[parent_id]["uri"]
-					codeB = all_nodes[parent_id]["code"]
-					titleB = all_nodes[parent_id]["title"]
-					chapterB = all_nodes[parent_id]["chapter"]
-					
+				#Keep track of the most recent entry at each level
+				if level > 0:
+					uriB = most_recent_uri_at_level[level - 1]
+					codeA = code
 					if codeA == "":
 						codeA = "NA"
-					if codeB == "":
-						codeB = "NA"
-					
-					#out_string = "%s\t%s\t%s\t%s\tis_a\t%s\t%s\t%s\t%s\t\n" % (uriA, codeA, 
-					#												titleA, chapterA, uriB,
-					#												codeB, titleB, chapterB)
-					entry = {'id':uriA, 'name':titleA, 'code':codeA, 'is_a':uriB}
+					entry = {'id':cleanuri, 'name':cleantitle, 'code':codeA, 'is_a':uriB}
 					outfile.write(str(entry) + "\n")
+				
+				most_recent_uri_at_level[level] = cleanuri
+				
+				pbar.update(1)
 
+		tmetrics.add(records_in=pbar.n)
 		pbar.close()
 		
 	except IOError as e:
@@ -550,6 +693,11 @@ def process_reactome(infilename, inpath, outpath):
 	'''Processes Reactome pathways into relationship format.
 	This requires working with two different files,
 	but we assume both are present and combine into a single file.
+	Pathways may have more than one parent, so is_a is a list;
+	it is ["Reactome:NA"] for pathways without parents.
+	Pathways and relations are each sorted externally (see
+	tubduck_sort) and merge-joined, so memory use doesn't grow
+	with the number of pathways.
 	Takes input from process_kbs.'''
 	
 	status = True
@@ -565,30 +713,36 @@ def process_reactome(infilename, inpath, outpath):
 	
 	try:
 		pbar = tqdm(unit=" lines")
-		with infilepath.open() as infile, relfilepath.open() as relfile:
-			all_nodes = {}
+		
+		def pathways(infile):
 			for line in infile:
 				text = line.strip().split("\t")
 				uri = text[0]
 				description = text[1] + " - " + text[2]
-				all_nodes[uri] = {"description":description, "is_a":"NA"}
 				pbar.update(1)
+				yield [uri, description]
+		
+		def relations(relfile):
 			for line in relfile:
 				text = line.strip().split("\t")
 				uriA = text[0] #parent
 				uriB = text[1] #child
-				all_nodes[uriB]["is_a"] = uriA
-					
-		#Now write
-		with outfilepath.open("w") as outfile:
-			for node in all_nodes:
-				uri = node
+				yield [uriB, uriA]
+		
+		with infilepath.open() as infile, relfilepath.open() as relfile, \
+			outfilepath.open("w") as outfile:
+			nodes = tsort.external_sort(pathways(infile))
+			rels = tsort.external_sort(relations(relfile))
+			for uri, node_records, rel_records in tsort.merge_join(nodes, rels):
 				cleanuri = "Reactome:" + uri
-				description = all_nodes[node]["description"]
-				parent = "Reactome:" + all_nodes[node]["is_a"]
-				entry = {'id':cleanuri, 'name':description, 'is_a':parent}
+				description = node_records[-1][1]
+				parents = sorted(set("Reactome:" + record[1] for record in rel_records))
+				if len(parents) == 0:
+					parents = ["Reactome:NA"]
+				entry = {'id':cleanuri, 'name':description, 'is_a':parents}
 				outfile.write(str(entry) + "\n")
 				
+		tmetrics.add(records_in=pbar.n)
 		pbar.close()
 	except IOError as e:
 		print("Encountered an error while processing %s: %s" % (infilename, e))
@@ -629,6 +783,7 @@ def create_graphdb():
 					"WHERE a.name = 'protein' AND b.name = 'biomolecule' " 
 					"CREATE (a)-[r:is_a]->(b)")
 			tx.commit()
+			tcache.bump_generation()
 	
 			print("Graph DB created: access at http://localhost:7474")
 			status = True
@@ -640,20 +795,26 @@ def create_graphdb():
 	
 	return status
 	
-def graphdb_exists():
-	'''Checks to see if the Neo4j database is available.
+def graphdb_exists(backend=None):
+	'''Checks to see if the graph database is available.
 	Returns True if it appears to exist, even if it's empty,
 	because we don't do anything with the DB here.'''
 	
 	status = False
 	
-	print("Checking to see if a Neo4j database is available.")
+	if backend is None:
+		backend = tgraph.get_backend(cache=query_cache)
+	
+	print("Checking to see if a graph database is available.")
 	
 	try:
-		print("Connecting to Neo4j database at %s " % NEO4J_URI)
-		print("Username: %s " % NEO4J_USER)
-		driver = GraphDatabase.driver(NEO4J_URI, auth=(NEO4J_USER, NEO4J_PASSWORD), encrypted=False)
-		print("Connected to Neo4j database successfully.")
+		if backend.name == "neo4j":
+			print("Connecting to Neo4j database at %s " % NEO4J_URI)
+			print("Username: %s " % NEO4J_USER)
+		else:
+			print("Using the %s graph backend." % backend.name)
+		backend.available()
+		print("Connected to graph database successfully.")
 		status = True
 	except (neobolt.exceptions.DatabaseError, neobolt.exceptions.AuthError) as e:
 		print("** Encountered an error with Neo4j graph DB: %s" % e)
@@ -671,28 +832,248 @@ def graphdb_exists():
 		
 	return status
 	
-def graphdb_stats():
-	'''Gets details about the Neo4j database.
+def graphdb_stats(backend=None):
+	'''Gets details about the graph database: counts of nodes by
+	label and by source KB, and of relations by type (see stats()
+	in tubduck_graph), which Neo4j keeps, so this takes no time
+	however large the graph is.
 	Returns a dict of values.'''
 	
-	graphdb_values = {}
-	
-	driver = GraphDatabase.driver(NEO4J_URI, auth=(NEO4J_USER, NEO4J_PASSWORD), encrypted=False)
+	if backend is None:
+		backend = tgraph.get_backend(cache=query_cache)
 	
-	with driver.session() as session:
-		graph_data = session.run("MATCH ()-->() RETURN count(*)").data()
-		
-	rel_count = graph_data[0]["count(*)"]
-	graphdb_values["rel_count"] = rel_count
+	graphdb_values = backend.stats()
+	graphdb_values["node_count"] = sum(graphdb_values["labels"].values())
+	graphdb_values["rel_count"] = sum(graphdb_values["types"].values())
 	
-	if rel_count < 1:
-		print("Neo4j database is empty.")
+	if graphdb_values["rel_count"] < 1:
+		print("Graph database is empty.")
 	else:
-		print("Neo4j database contains %s relations." % str(graphdb_values["rel_count"]))
+		print("Graph database contains %s nodes and %s relations."
+				% (graphdb_values["node_count"], graphdb_values["rel_count"]))
+		for kind in ["labels", "types"]:
+			print("  " + ", ".join("%s: %s" % (name, count) for name, count
+									in sorted(graphdb_values[kind].items())))
 	
 	return graphdb_values
+
+def count_entries(filepath, first_line=0, end_line=None):
+	'''Counts the distinct IDs of the entries in a range of lines
+	of a processed KB file, as one ID may appear on more than one
+	line (e.g., ICD-10-CM headings). Lines are matched, not parsed.
+	Returns an int.'''
+	
+	ids = set()
+	with filepath.open("rb") as infile:
+		for line in islice(infile, first_line, end_line):
+			match = ENTRY_ID.search(line)
+			if match:
+				ids.add(match.group(2))
+	
+	return len(ids)
+
+def read_entry_count(kb, path=ENTRY_COUNTS_PATH):
+	'''Returns the recorded entry count of a KB's processed file
+	(see record_entry_count()), as a dict of the file's fingerprint
+	and the number of "entries", or None if there isn't one.'''
+	
+	try:
+		with (path / (kb + ".json")).open() as count_file:
+			return json.load(count_file)
+	except (IOError, ValueError):
+		return None
+
+def record_entry_count(kb, filepath, path=ENTRY_COUNTS_PATH):
+	'''Counts the entries of a KB's processed file (see count_entries())
+	and records the count with the file's fingerprint, so it needn't
+	be counted again until the file changes. Each KB has its own
+	file in path, as KBs may be processed in parallel.
+	Returns the count.'''
+	
+	count = count_entries(filepath)
+	write_checkpoints({"file": file_fingerprint(filepath), "entries": count},
+						path / (kb + ".json")) #Also written atomically
+	
+	return count
+
+def kb_record_count(kb, checkpoints):
+	'''Returns the number of processed entries of a KB that should
+	be in the graph DB: those in the range its load checkpoint
+	covers, if it has one for the current processed file, or else
+	all of them. Uses the count recorded in the checkpoint, or when
+	the KB was processed (see record_entry_count()); the file is
+	only counted if neither is for its current version.
+	Returns None if the KB hasn't been processed.'''
+	
+	infilepath = KB_PROC_PATH / (KB_NAMES[kb].split(".")[0] + "-proc")
+	if not infilepath.exists():
+		return None
+	fingerprint = file_fingerprint(infilepath)
+	
+	checkpoint = checkpoints.get(kb)
+	if checkpoint is not None and checkpoint["file"] == fingerprint:
+		if "entries" in checkpoint:
+			return checkpoint["entries"]
+		#Checkpoints written before counts were recorded in them
+		return count_entries(infilepath, checkpoint["first_line"], checkpoint["end_line"])
+	
+	recorded = read_entry_count(kb)
+	if recorded is not None and recorded["file"] == fingerprint:
+		return recorded["entries"]
+	return record_entry_count(kb, infilepath)
+
+def verify_loads(graphdb_values=None, backend=None):
+	'''Compares the number of nodes in the graph DB from each KB
+	with the number of its processed entries (see kb_record_count()),
+	as recorded when each was processed or loaded.
+	Takes values from graphdb_stats(), or gets them.
+	Returns a dict, keyed by KB code, of dicts of the "expected"
+	and "loaded" counts and the "status": one of "complete",
+	"partial", "missing" or "not processed".'''
+	
+	if graphdb_values is None:
+		graphdb_values = graphdb_stats(backend)
+	checkpoints = read_checkpoints()
+	
+	results = {}
+	for kb in KB_NAMES:
+		if kb == "reactome2": #Loaded along with reactome1
+			continue
+		expected = kb_record_count(kb, checkpoints)
+		loaded = graphdb_values["sources"].get(kb, 0)
+		if expected is None:
+			status = "not processed"
+		elif loaded >= expected:
+			status = "complete"
+		elif loaded > 0:
+			status = "partial"
+		else:
+			status = "missing"
+		results[kb] = {"expected": expected, "loaded": loaded, "status": status}
+	
+	return results
+
+def kb_graph_rows(kb, kb_rels):
+	'''Converts processed entries from one KB to rows for the
+	graph backend (see tubduck_graph).
+	Entries missing an ID or name are discarded.
+	Node rows have the KB's code as their source.
+	Returns a tuple of the node label, a list of node rows
+	and a dict of lists of edge rows, keyed by relation type:
+	subclassOf for all KBs, and hasPharmacologicalAction for MeSH.'''
+	
+	if kb == "reactome1":
+		label = "Pathway"
+	else:
+		label = "NamedThing"
+	
+	node_rows = []
+	edge_rows = {"subclassOf": []}
+	source = {"source": kb}
+	if kb == "m19":
+		edge_rows["hasPharmacologicalAction"] = []
+	
+	for entry in kb_rels:
+		try:
+			if kb in OBO_KBS:
+				kb_id1 = entry["id"][0]
+				node_rows.append({"id": kb_id1, "name": entry["name"][0], **source})
+				targets = entry.get("is_a", []) #May be multiple relationships
+			
+			if kb == "m19":
+				#Descriptors with multiple MN codes occupy multiple places
+				#in the MeSH tree, so they may have more than one parent
+				kb_id1 = entry["id"]
+				node_row = {"id": kb_id1, "name": entry["name"], **source}
+				if "description" in entry: #The scope note
+					node_row["description"] = entry["description"]
+				node_rows.append(node_row)
+				targets = entry.get("is_a", [])
+				for action in entry.get("pa", []):
+					edge_rows["hasPharmacologicalAction"].append({"source": kb_id1,
+																	"target": action})
+			
+			if kb in ["i10", "i11"]:
+				kb_id1 = entry["id"]
+				node_rows.append({"id": kb_id1, "name": entry["name"],
+									"description": entry["code"], **source})
+				targets = [entry["is_a"]] if "is_a" in entry.keys() else [] #All codes have one parent at most
+			
+			if kb == "reactome1":
+				kb_id1 = entry["id"]
+				node_rows.append({"id": kb_id1, "name": entry["name"], **source})
+				targets = entry.get("is_a", []) #May be multiple relationships
+				if isinstance(targets, str): #Processed before parents were lists
+					targets = [targets]
+				targets = [target for target in targets 
+							if target not in ["NA", "Reactome:NA"]] #No parent
+			
+			for target in targets:
+				kb_id2 = (target.split("!")[0]).strip()
+				edge_rows["subclassOf"].append({"source": kb_id1, "target": kb_id2})
+		except KeyError: #Discard this entry
+			pass
+	
+	return (label, node_rows, edge_rows)
+
+def write_kb_rows(backend, label, node_rows, edge_rows, source=None):
+	'''Writes node and edge rows from kb_graph_rows() through
+	a graph backend. source is the code of the KB they are from.
+	Returns the number of rows written.'''
+	
+	backend.upsert_nodes(label, node_rows, source)
+	for rel_type, rows in edge_rows.items():
+		backend.upsert_edges(rel_type, label, label, rows)
+	
+	return len(node_rows) + sum(len(rows) for rows in edge_rows.values())
+
+def read_checkpoints(path=CHECKPOINT_PATH):
+	'''Returns the graph DB load checkpoints as a dict, keyed by
+	KB code, or an empty dict if there are none.'''
+	
+	try:
+		with path.open() as checkpoint_file:
+			return json.load(checkpoint_file)
+	except (IOError, ValueError):
+		return {}
+
+def write_checkpoints(checkpoints, path=CHECKPOINT_PATH):
+	'''Writes graph DB load checkpoints. The file is flushed to
+	disk and replaced atomically, so a crash leaves either the
+	previous checkpoints or these.'''
+	
+	path.parent.mkdir(parents=True, exist_ok=True)
+	temppath = path.with_name(path.name + ".tmp")
+	with temppath.open("w") as checkpoint_file:
+		json.dump(checkpoints, checkpoint_file, indent=2)
+		checkpoint_file.flush()
+		os.fsync(checkpoint_file.fileno())
+	os.replace(str(temppath), str(path))
+
+def clear_checkpoints(path=CHECKPOINT_PATH):
+	'''Removes all graph DB load checkpoints.'''
 	
-def populate_graphdb(test_only):
+	if path.exists():
+		path.unlink()
+
+def incomplete_loads(path=CHECKPOINT_PATH):
+	'''Returns list of codes of KBs not yet loaded into the graph DB
+	by a population that was started but did not finish.'''
+	
+	checkpoints = read_checkpoints(path)
+	if len(checkpoints) == 0:
+		return []
+	return [kb for kb in KB_NAMES if kb != "reactome2"
+			and not checkpoints.get(kb, {}).get("done", False)]
+
+def file_fingerprint(filepath):
+	'''Returns the size and modification time of a file, to tell
+	whether it changed since a checkpoint was written.'''
+	
+	stat = filepath.stat()
+	return [stat.st_size, stat.st_mtime_ns]
+
+def populate_graphdb(test_only, backend=None, resume=False):
 	'''Loads entities and relations into graph DB from processed KBs.
 	Most of these form the concept graph: they define conceptual
 	relationships, including "is a" relationships.
@@ -701,17 +1082,36 @@ def populate_graphdb(test_only):
 	symptoms or diagnostics reported within clinical case reports.
 	The input variable test_only is a boolean; if True, a maximum of 100
 	nodes will be populated from each source.
+	Entries are loaded in batches of BATCH_SIZE lines. After each
+	batch is written, the next line to load from each KB is recorded
+	in CHECKPOINT_PATH. If resume is True, loading continues from
+	those lines, skipping KBs already loaded, unless their processed
+	files have changed since. Writes are idempotent, so a batch
+	interrupted before its checkpoint may be loaded again.
+	Constraints and indexes for all node labels are set up first,
+	as the schema describes (see tubduck_schema).
+	Writes through the given graph backend, or the one set by
+	GRAPH_BACKEND (see tubduck_graph).
 	Returns True if all population activities complete without error.'''
 	
 	status = False
 	
-	driver = GraphDatabase.driver(NEO4J_URI, auth=(NEO4J_USER, NEO4J_PASSWORD), encrypted=False)
+	if backend is None:
+		backend = tgraph.get_backend(cache=query_cache)
 	
 	max_node_count = 1000000 #The total number of nodes to create based on a single KB source.
 	if test_only:
 		max_node_count = 100
 	
-	print("Populating graph DB...")
+	if resume:
+		checkpoints = read_checkpoints()
+		print("Resuming graph DB population...")
+	else:
+		checkpoints = {}
+		clear_checkpoints()
+		print("Populating graph DB...")
+	tschema.provision(backend)
+	tcache.bump_generation() #Cached reads may be stale from here on
 	
 	#Load each KB as nodes/relations.
 	#Note that not every dict entry includes a valid relation.
@@ -719,235 +1119,108 @@ def populate_graphdb(test_only):
 	for kb in KB_NAMES:
 		if kb == "reactome2":
 			break
-		kb_rels = []
-		infilename = KB_NAMES[kb].split(".")[0] + "-proc"
-		print("Loading entries from %s..." % infilename)
-		infilepath = KB_PROC_PATH / infilename
-		with infilepath.open('r') as infile:
+		with tmetrics.stage("load", kb=kb):
+			infilename = KB_NAMES[kb].split(".")[0] + "-proc"
+			infilepath = KB_PROC_PATH / infilename
+			fingerprint = file_fingerprint(infilepath)
 			
-			for count, line in enumerate(infile): #Get linecount first
-				pass
-			linecount = count + 1
-			print("File contains %s items." % linecount)
-			infile.seek(0)
+			checkpoint = checkpoints.get(kb)
+			if checkpoint is not None and checkpoint["file"] != fingerprint:
+				print("%s has changed since it was last loaded - loading all of it." % infilename)
+				checkpoint = None
+			if checkpoint is not None and checkpoint["done"]:
+				print("Entries from %s already loaded." % infilename)
+				j = j+1
+				continue
 			
-			i = 0
-			if test_only:	#Jump ahead randomly if testing
-				try:
-					for _ in range(random.randint(1,linecount-100)):
-						next(infile)
-				except StopIteration as e:
-					break
-				pbar = tqdm(unit=" entries", total = max_node_count)
-			else:
-				pbar = tqdm(unit=" entries", total = linecount)
-			for line in infile: #Go line-by-line to be careful
-				kb_rels.append(ast.literal_eval(line.rstrip()))
-				i = i+1
-				pbar.update(1)
-				if i == max_node_count:
-					break
-		pbar.close()
-		
-		print("Loading relevant nodes and relations into graph DB...")
-		# Now we do KB-specific parsing.
-		if kb == "don":
-			pbar = tqdm(unit=" entries added")
-			with driver.session() as session:
-				i = 0
-				try:
-					session.run("CREATE CONSTRAINT ON (a:NamedThing) ASSERT a.id IS UNIQUE")
-				except neobolt.exceptions.ClientError as e:
-					print("\nSetting up constraints and encountered error: %s" % e)
-				for entry in kb_rels:
-					try:
-						name1 = entry["name"][0]
-						kb_id1 = entry["id"][0]
-						session.run("MERGE (a:NamedThing {id:$id}) "
-									"ON CREATE SET a.name = $name, a.creationDate = date() "
-									"ON MATCH SET a.name = $name, a.creationDate = date()",
-									name=name1, id=kb_id1)
-						if "is_a" in entry.keys():
-							targets = entry["is_a"] #May be multiple relationships
-							for target in targets:
-								kb_id2 = (target.split("!")[0]).strip()
-								session.run("MERGE (a:NamedThing {id: $id1}) "
-										"MERGE (b:NamedThing {id: $id2}) "
-										"MERGE (a)-[r:subclassOf {creationDate: date()}]->(b)", id1=kb_id1, id2=kb_id2)
-						i = i+1
-						pbar.update(1)
-						if i == max_node_count:
-							break
-					except KeyError: #Discard this entry
-						pass
-			pbar.close()
+			print("Loading entries from %s..." % infilename)
+			with infilepath.open('r') as infile:
 			
-		# if kb == "m19":
-			# Not currently used
-			# '''Some nodes are added more than once if they have multiple
-			# MN codes (this means they occupy multiple places in the
-			# MeSH tree. Is_a relations are based on MN as well, 
-			# as we don't always know the corresponding entry.'''
-			# pbar = tqdm(unit=" entries added")
-			# with driver.session() as session:
-				# i = 0
-				# session.run("CREATE CONSTRAINT ON (a:NamedThing) ASSERT a.id IS UNIQUE")
-				# for entry in kb_rels:
-					# try:						
-						# name1 = entry["MH"][0]
-						# kb_id1 = entry["UI"][0]
-						# if "MN" in entry.keys():
-							# locs = str(entry["MN"])
-							# session.run("MERGE (a:NamedThing {id:$id}) "
-									# "ON CREATE SET a.name = $name, a.description = $description, a.creationDate = date() "
-									# "ON MATCH SET a.name = $name, a.description = $description, a.creationDate = date()",
-									# name=name1, id=kb_id1, description=locs)
-							# for item in entry["MN"]: #Position in the MeSH tree - may have >1
-								# session.run(statement, {"name": name1, "id": kb_id1 , "description": item})
-								# mn_split = item.split(".")
-								# if len(mn_split) >1: #If this isn't a parent term/code already
-									# mn_parent = ".".join(mn_split[:-1])
-									# session.run("MERGE (b:NamedThing {description:$mn2}) " #
-										# "MERGE (a:NamedThing {description: $mn1})-[r:subclassOf {creationDate: date()}]->(b)", mn1=item, mn2=mn_parent)
-						# if "PA" in entry.keys():
-							# for item in entry["PA"]: #Pharmacologic Action - only present for subset
-								# name2 = item
-								# session.run("MERGE (b:NamedThing {name:$name2}) " #Data isn't sorted, so we create other node if needed 
-										# "MERGE (a:NamedThing {name: $name1})-[r:subclassOf {creationDate: date()}]->(b)", name1=name1, name2=name2)
-						# i = i+1
-						# pbar.update(1)
-						# if i == max_node_count:
-							# break
-					# except KeyError: #Discard this entry
-						# pass
-			# pbar.close()
+				for count, line in enumerate(infile): #Get linecount first
+					pass
+				linecount = count + 1
+				print("File contains %s items." % linecount)
+				infile.seek(0)
 			
-		if kb == "i10":
-			pbar = tqdm(unit=" entries added")
-			with driver.session() as session:
-				i = 0
-				try:
-					session.run("CREATE CONSTRAINT ON (a:NamedThing) ASSERT a.id IS UNIQUE")
-				except neobolt.exceptions.ClientError as e:
-					print("\nSetting up constraints and encountered error: %s" % e)
-				for entry in kb_rels:
-					try:
-						kb_id1 = entry["id"]
-						name1 = entry["name"]
-						code1 = entry["code"]
-						session.run("MERGE (a:NamedThing {id:$id}) "
-									"ON CREATE SET a.name = $name, a.description = $description, a.creationDate = date() "
-									"ON MATCH SET a.name = $name, a.description = $description, a.creationDate = date()",
-									name=name1, id=kb_id1, description=code1)
-						if "is_a" in entry.keys(): #All codes have one parent at most
-							kb_id2 = entry["is_a"]
-							session.run("MERGE (a:NamedThing {id: $id1}) "
-										"MERGE (b:NamedThing {id: $id2}) "
-										"MERGE (a)-[r:subclassOf {creationDate: date()}]->(b)", id1=kb_id1, id2=kb_id2)
-						i = i+1
-						pbar.update(1)
-						if i == max_node_count:
-							break
-					except KeyError: #Discard this entry
-						pass
-			pbar.close()
-		
-		if kb == "i11":
-			pbar = tqdm(unit=" entries added")
-			with driver.session() as session:
-				i = 0
-				try:
-					session.run("CREATE CONSTRAINT ON (a:NamedThing) ASSERT a.id IS UNIQUE")
-				except neobolt.exceptions.ClientError as e:
-					print("\nSetting up constraints and encountered error: %s" % e)
-				for entry in kb_rels:
-					try:
-						kb_id1 = entry["id"]
-						name1 = entry["name"]
-						code1 = entry["code"]
-						session.run("MERGE (a:NamedThing {id:$id}) "
-									"ON CREATE SET a.name = $name, a.description = $description, a.creationDate = date() "
-									"ON MATCH SET a.name = $name, a.description = $description, a.creationDate = date()",
-									name=name1, id=kb_id1, description=code1)
-						if "is_a" in entry.keys(): #All codes have one parent at most
-							kb_id2 = entry["is_a"]
-							session.run("MERGE (a:NamedThing {id: $id1}) "
-										"MERGE (b:NamedThing {id: $id2}) "
-										"MERGE (a)-[r:subclassOf {creationDate: date()}]->(b)", id1=kb_id1, id2=kb_id2)
-						i = i+1
-						pbar.update(1)
-						if i == max_node_count:
-							break
-					except KeyError: #Discard this entry
-						pass
-			pbar.close()
-		
-		if kb == "reactome1":
-			pbar = tqdm(unit=" entries added")
-			with driver.session() as session:
-				i = 0
-				try:
-					session.run("CREATE CONSTRAINT ON (a:Pathway) ASSERT a.id IS UNIQUE")
-				except neobolt.exceptions.ClientError as e:
-					print("\nSetting up constraints and encountered error: %s" % e)
-				for entry in kb_rels:
-					try:
-						kb_id1 = entry["id"]
-						name1 = entry["name"]
-						session.run("MERGE (a:Pathway {id:$id}) "
-									"ON CREATE SET a.name = $name, a.creationDate = date() "
-									"ON MATCH SET a.name = $name, a.creationDate = date()",
-									name=name1, id=kb_id1)
-						if "is_a" in entry.keys(): #All codes have one parent at most
-							kb_id2 = entry["is_a"]
-							if kb_id2 != "NA":
-								session.run("MERGE (a:Pathway {id: $id1}) "
-										"MERGE (b:Pathway {id: $id2}) "
-										"MERGE (a)-[r:subclassOf {creationDate: date()}]->(b)", id1=kb_id1, id2=kb_id2)
-						i = i+1
-						pbar.update(1)
-						if i == max_node_count:
-							break
-					except KeyError: #Discard this entry
-						pass
-			pbar.close()			
+				if checkpoint is None:
+					first_line = 0
+					if test_only:	#Jump ahead randomly if testing
+						first_line = random.randint(1, max(1, linecount-100))
+					end_line = min(first_line + max_node_count, linecount)
+					checkpoint = {"file": fingerprint, "first_line": first_line,
+									"end_line": end_line, "next_line": first_line,
+									"done": False,
+									"entries": count_entries(infilepath, first_line, end_line)}
+				else:
+					print("Continuing from entry %s." % checkpoint["next_line"])
+				checkpoints[kb] = checkpoint
+				write_checkpoints(checkpoints)
+				
+				pbar = tqdm(unit=" entries", total = checkpoint["end_line"] - checkpoint["first_line"],
+							initial = checkpoint["next_line"] - checkpoint["first_line"])
+				lines = islice(infile, checkpoint["next_line"], checkpoint["end_line"])
+				while True:
+					batch = list(islice(lines, tgraph.BATCH_SIZE))
+					if len(batch) == 0:
+						break
+					kb_rels = [ast.literal_eval(line.rstrip()) for line in batch]
+					
+					# Now we do KB-specific parsing.
+					rows_written = write_kb_rows(backend, *kb_graph_rows(kb, kb_rels), source=kb)
+					tmetrics.add(records_in=len(kb_rels), records_out=rows_written)
+					
+					checkpoint["next_line"] = checkpoint["next_line"] + len(batch)
+					write_checkpoints(checkpoints)
+					pbar.update(len(batch))
+				pbar.close()
+			
+			checkpoint["done"] = True
+			write_checkpoints(checkpoints)
 		
 		j = j+1
 		if j == len(KB_NAMES)-1:
 			status = True
+	
+	tcache.bump_generation()
 		
 	return status
 
-def crosslink_graphdb():
+def crosslink_graphdb(backend=None):
 	'''Adds cross-link relations to the graph DB.
 	Needs to happen after population as cross-link targets may not
 	exist yet otherwise.
 	Returns True if completed without errors.'''
 	status = False
 	
-	driver = GraphDatabase.driver(NEO4J_URI, auth=(NEO4J_USER, NEO4J_PASSWORD), encrypted=False)
+	if backend is None:
+		backend = tgraph.get_backend(cache=query_cache)
 	
-	print("Adding cross-links to graph DB...") #Doesn't do anything yet
-	status = True 
+	with tmetrics.stage("crosslink"):
+		print("Adding cross-links to graph DB...") #Doesn't do anything yet
+		tcache.bump_generation()
+		status = True 
 	
 	return status
 
-def empty_graphdb():
+def empty_graphdb(backend=None):
 	'''Clears all entities and relations from the graph DB.
 	Returns True if it completes without error.'''
 	
 	status = False
 	
-	driver = GraphDatabase.driver(NEO4J_URI, auth=(NEO4J_USER, NEO4J_PASSWORD), encrypted=False)
+	if backend is None:
+		backend = tgraph.get_backend(cache=query_cache)
 	
 	print("Will empty all contents from graph DB.")
-	print("Please note that the database can be removed entirely by "
-			"stopping Neo4j and deleting the graph.db file.")
+	if backend.name == "neo4j":
+		print("Please note that the database can be removed entirely by "
+				"stopping Neo4j and deleting the graph.db file.")
 	print("Clearing all contents from graph DB...")
 	
-	with driver.session() as session:
-		session.run("MATCH ()-[r]-() DELETE r")
-		session.run("MATCH (n) DELETE n ")
+	tcache.bump_generation()
+	backend.delete()
+	clear_checkpoints()
+	tcache.bump_generation()
 	
 	print("Complete.")
 	status = True
@@ -0,0 +1,310 @@
+#!/usr/bin/python
+#tubduck_stream.py
+'''
+Streaming knowledge base loads for TUBDUCK.
+
+Usually each KB is downloaded to a file (get_kbs), decompressed,
+processed to another file (process_kbs) and then read again to
+populate the graph DB, each step finishing before the next begins.
+Here, the bytes of a KB flow straight from its source into the graph
+DB, through a pipeline of asyncio stages:
+read - reads chunks of the download (or of a local file)
+decode - decompresses them, if gzipped, and decodes them as UTF-8
+parse - parses entries from the text, as the KB's processing does
+load - writes batches of entries to the graph DB
+Stages are connected by queues holding at most QUEUE_SIZE items, so
+a stage waits when the next one falls behind, and memory use stays
+bounded. Nothing is written to disk, and entries are loaded while the
+rest of the KB is still downloading.
+
+Only KBs whose formats can be parsed in a single pass are streamed
+(see STREAM_KBS). MeSH descriptors are loaded as they arrive, and
+their parents and pharmacological actions once all descriptors have
+been seen. Other KBs are set up as usual.
+'''
+
+import asyncio
+import codecs
+import http.client
+from pathlib import Path
+import zlib
+
+import sqlite3
+
+from urllib.request import urlopen
+import urllib.error
+
+import neobolt.exceptions
+
+from tqdm import *
+
+import tubduck_cache as tcache
+import tubduck_graph as tgraph
+import tubduck_mesh as tmesh
+import tubduck_metrics as tmetrics
+import tubduck_obo as tobo
+import tubduck_schema as tschema
+import tubduck_start as tstart
+
+## Constants
+CHUNK_SIZE = 1 << 20 #Bytes read from the source at a time
+QUEUE_SIZE = 8 #Items held between stages
+
+STREAM_KBS = ["don", "m19"]
+'''
+KBs that may be streamed, as their formats can be parsed in one pass.
+'''
+
+END = None
+'''
+Put on a queue after the last item.
+'''
+
+## Functions
+def obo_entries(chunks):
+	'''Yields the processed entries of an OBO file (see
+	process_diseaseontology()) from chunks of its text.'''
+
+	for stanza_type, tags, modifiers in tobo.parse_stanzas(chunks):
+		if stanza_type == "Term" and "id" in tags and not tobo.is_obsolete(tags):
+			yield tags
+
+def mesh_entries(chunks):
+	'''Yields the processed entries of a MeSH ASCII file (see
+	process_mesh()) from chunks of its text.
+	Each descriptor is first yielded without parents or actions,
+	as they may not have been seen yet. Once all have, descriptors
+	with parents or actions are yielded again, with them.'''
+
+	tree_ids = {}
+	name_ids = {}
+	links = [] #Just what's needed to find parents and actions
+
+	for record in tmesh.parse_records(iter_lines(chunks)):
+		if not tmesh.is_descriptor(record) or "MH" not in record:
+			continue
+		tmesh.index_record(record, tree_ids, name_ids)
+		links.append({field: record[field] for field in ["UI", "MH", "MN", "PA"]
+						if field in record})
+		yield tmesh.descriptor_entry(record, {}, {})
+
+	for record in links:
+		entry = tmesh.descriptor_entry(record, tree_ids, name_ids)
+		if len(entry["is_a"]) > 0 or len(entry["pa"]) > 0:
+			yield entry
+
+def iter_lines(chunks):
+	'''Yields the lines in chunks of text.'''
+
+	rest = ""
+	for chunk in chunks:
+		lines = (rest + chunk).split("\n")
+		rest = lines.pop() #May be cut short
+		for line in lines:
+			yield line
+	if rest:
+		yield rest
+
+async def unless_stopped(stopped, method, *args):
+	'''Awaits a queue method for a worker thread, unless the
+	stopped event is set first, as it is when another stage fails:
+	the stage at the other end of the queue may then never get to it.
+	Raises asyncio.CancelledError if stopped.'''
+
+	operation = asyncio.ensure_future(method(*args))
+	stopping = asyncio.ensure_future(stopped.wait())
+	await asyncio.wait([operation, stopping], return_when=asyncio.FIRST_COMPLETED)
+	stopping.cancel()
+	if not operation.done():
+		operation.cancel()
+		raise asyncio.CancelledError()
+	return operation.result()
+
+def queue_items(queue, loop, stopped):
+	'''Yields items from an asyncio queue, until END, to a worker
+	thread. Waits whenever the queue is empty, until stopped is set.'''
+
+	while True:
+		item = asyncio.run_coroutine_threadsafe(unless_stopped(stopped, queue.get),
+												loop).result()
+		if item is END:
+			return
+		yield item
+
+def put_item(queue, item, loop, stopped):
+	'''Puts an item on an asyncio queue from a worker thread.
+	Waits whenever the queue is full, until stopped is set.'''
+
+	asyncio.run_coroutine_threadsafe(unless_stopped(stopped, queue.put, item), loop).result()
+
+def kb_source(kb, local=False):
+	'''Returns the source of a KB: its URL, or if local is True,
+	the Path of its file in KB_PATH.'''
+
+	if local:
+		return tstart.KB_PATH / tstart.KB_NAMES[kb]
+	baseURL, filename = tstart.KB_LOCATIONS[kb]
+	return baseURL + filename
+
+def open_source(source):
+	'''Opens a URL or a Path for reading bytes.'''
+
+	if isinstance(source, Path):
+		return source.open("rb")
+	return urlopen(source)
+
+async def read_source(source, chunks, chunk_size=CHUNK_SIZE):
+	'''Stage reading a source, putting chunks of bytes on a queue.'''
+
+	loop = asyncio.get_running_loop()
+	infile = await loop.run_in_executor(None, open_source, source)
+	try:
+		while True:
+			data = await loop.run_in_executor(None, infile.read, chunk_size)
+			if not data:
+				break
+			await chunks.put(data)
+	finally:
+		infile.close()
+	await chunks.put(END)
+
+async def decode(chunks, texts, gzipped=False):
+	'''Stage decompressing chunks of bytes, if gzipped is True,
+	and decoding them as UTF-8, putting chunks of text on a queue.
+	Characters split across chunks are decoded whole.
+	Raises zlib.error if gzipped data ends before its end of stream,
+	as it does when a download is cut short.'''
+
+	loop = asyncio.get_running_loop()
+	decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16) if gzipped else None
+	decoder = codecs.getincrementaldecoder("utf-8")()
+
+	def convert(data, final=False):
+		if decompressor is not None:
+			data = decompressor.flush() if final else decompressor.decompress(data)
+			if final and not decompressor.eof:
+				raise zlib.error("Compressed data ended before the end of the stream")
+		return decoder.decode(data, final)
+
+	while True:
+		data = await chunks.get()
+		if data is END:
+			text = convert(b"", final=True)
+		else:
+			text = await loop.run_in_executor(None, convert, data)
+		if text:
+			await texts.put(text)
+		if data is END:
+			break
+	await texts.put(END)
+
+async def parse(kb, texts, batches, stopped, batch_size=tgraph.BATCH_SIZE):
+	'''Stage parsing entries of a KB from chunks of text, putting
+	lists of batch_size entries on a queue. Parsing runs on a worker
+	thread, taking text from the queue as it needs it, and gives up
+	once the stopped event is set.'''
+
+	loop = asyncio.get_running_loop()
+	parsers = {"don": obo_entries,
+				"m19": mesh_entries}
+
+	def parse_batches():
+		batch = []
+		for entry in parsers[kb](queue_items(texts, loop, stopped)):
+			batch.append(entry)
+			if len(batch) == batch_size:
+				put_item(batches, batch, loop, stopped)
+				batch = []
+		if len(batch) > 0:
+			put_item(batches, batch, loop, stopped)
+
+	await loop.run_in_executor(None, parse_batches)
+	await batches.put(END)
+
+async def load(kb, batches, backend, pbar=None):
+	'''Stage loading batches of entries into the graph DB.
+	Returns the number of entries loaded.'''
+
+	loop = asyncio.get_running_loop()
+	count = 0
+
+	while True:
+		batch = await batches.get()
+		if batch is END:
+			break
+		label, node_rows, edge_rows = tstart.kb_graph_rows(kb, batch)
+		rows_written = await loop.run_in_executor(None, tstart.write_kb_rows, backend,
+													label, node_rows, edge_rows, kb)
+		tmetrics.add(records_in=len(batch), records_out=rows_written)
+		count = count + len(batch)
+		if pbar is not None:
+			pbar.update(len(batch))
+
+	return count
+
+async def stream_kb(kb, backend, source, queue_size=QUEUE_SIZE):
+	'''Streams one KB from a source (a URL or Path; see kb_source())
+	into the graph DB, through the read, decode, parse and load
+	stages. Sources ending in .gz are decompressed.
+	If any stage fails, the others are stopped and its error is raised.
+	Returns the number of entries loaded.'''
+
+	chunks = asyncio.Queue(maxsize=queue_size)
+	texts = asyncio.Queue(maxsize=queue_size)
+	batches = asyncio.Queue(maxsize=queue_size)
+	stopped = asyncio.Event()
+	pbar = tqdm(unit=" entries")
+
+	try:
+		results = await asyncio.gather(read_source(source, chunks),
+										decode(chunks, texts, str(source).endswith(".gz")),
+										parse(kb, texts, batches, stopped),
+										load(kb, batches, backend, pbar))
+	except BaseException:
+		stopped.set() #So the parsing thread doesn't wait on the failed stage
+		raise
+	finally:
+		pbar.close()
+
+	return results[-1]
+
+def stream_kbs(kbs=None, local=False, backend=None):
+	'''Streams KBs straight into the graph DB, one at a time,
+	without writing any files.
+	Takes a list of KB codes (default is all in STREAM_KBS).
+	If local is True, streams from the files already in KB_PATH
+	rather than downloading them.
+	Writes through the given graph backend, or the one set by
+	GRAPH_BACKEND (see tubduck_graph).
+	Returns True if all KBs were loaded without error.'''
+
+	status = True
+
+	if kbs is None:
+		kbs = STREAM_KBS
+	if backend is None:
+		backend = tgraph.get_backend(cache=tstart.query_cache)
+
+	tschema.provision(backend)
+	tcache.bump_generation() #Cached reads may be stale from here on
+
+	for kb in kbs:
+		if kb not in STREAM_KBS:
+			print("%s can't be streamed - use setup to load it." % kb)
+			status = False
+			continue
+		source = kb_source(kb, local)
+		print("Streaming %s into graph DB from %s..." % (kb, source))
+		with tmetrics.stage("stream", kb=kb):
+			try:
+				count = asyncio.run(stream_kb(kb, backend, source))
+				print("Loaded %s entries from %s." % (count, kb))
+			except (IOError, urllib.error.URLError, http.client.HTTPException,
+					UnicodeDecodeError, zlib.error, sqlite3.Error, neobolt.exceptions.DatabaseError,
+					neobolt.exceptions.ClientError, neobolt.exceptions.ServiceUnavailable) as e:
+				print("Encountered an error while streaming %s: %s" % (kb, e))
+				status = False
+
+	tcache.bump_generation()
+
+	return status